@@ -0,0 +1,329 @@
+import argparse
+import asyncio
+import contextlib
+import datetime
+import gc
+import itertools
+import json
+import platform
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import time
+import fake_trello
+import storage
+import tasks
+import trello
+
+#Microbenchmarks of the hot paths of the TaskManager, with in-process fakes of the discord channels and interactions and fake_trello.py for trello.
+#python benchmark.py [--only render,persist,sync,notifications] [--sizes 100,1000,10000,100000] [--board-sizes 100,1000,10000]
+#                    [--notifications 100,1000,10000] [--repeat 5] [--output results.json]
+#python benchmark.py --compare old.json new.json [--threshold 0.2] compares the medians of two runs, exits with 1 if any got slower than threshold
+
+GUILD_ID = 1
+
+#Stands in for discord.Message, edits and deletes only count
+class FakeMessage():
+    ids = itertools.count(1)
+
+    def __init__(self, channel, content=None) -> None:
+        self.id = next(self.ids)
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content=None, embed=None, view=None):
+        self.content = content
+        self.channel.counters['edit'] += 1
+        return self
+
+    async def delete(self):
+        self.channel.counters['delete'] += 1
+
+    async def pin(self):
+        pass
+
+class FakeChannel():
+    def __init__(self, channel_id) -> None:
+        self.id = channel_id
+        self.last_message_id = None
+        self.counters = {'send': 0, 'edit': 0, 'delete': 0}
+
+    async def send(self, content=None, embed=None, view=None):
+        message = FakeMessage(self, content)
+        self.last_message_id = message.id
+        self.counters['send'] += 1
+        return message
+
+    async def fetch_message(self, message_id):
+        return FakeMessage(self)
+
+class FakeResponse():
+    def __init__(self, interaction) -> None:
+        self.interaction = interaction
+
+    async def send_message(self, content=None, embed=None, view=None, ephemeral=False):
+        self.interaction.message = await self.interaction.channel.send(content=content, embed=embed, view=view)
+
+    async def edit_message(self, content=None, embed=None, view=None):
+        await self.interaction.message.edit(content=content, embed=embed, view=view)
+
+    async def defer(self, *args, **kwargs):
+        pass
+
+#Stands in for discord.Interaction. The same one is used for every button press of a message
+class FakeInteraction():
+    def __init__(self, channel, guild=None) -> None:
+        self.channel = channel
+        self.guild = guild
+        self.message = None
+        self.extras = {}
+        self.data = {}
+        self.response = FakeResponse(self)
+
+    async def original_response(self):
+        return self.message
+
+#Seconds of every run of every benchmark by name
+class Results():
+    def __init__(self) -> None:
+        self.results = {}
+
+    def add(self, name, size, seconds):
+        result = self.results.setdefault(f'{name}/{size}', {'name': name, 'size': size, 'runs': []})
+        result['runs'].append(seconds)
+
+    #Measures the with block
+    def timed(self, name, size):
+        return Timer(self, name, size)
+
+    def summary(self):
+        summary = {}
+        for key, result in self.results.items():
+            runs = result['runs']
+            summary[key] = result | {'min': min(runs), 'median': statistics.median(runs), 'mean': statistics.fmean(runs), 'per_item': statistics.median(runs)/max(result['size'], 1)}
+        return summary
+
+class Timer():
+    def __init__(self, results, name, size) -> None:
+        self.results = results
+        self.name = name
+        self.size = size
+        self.start = None
+
+    def __enter__(self):
+        gc.collect()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if args[0] is None:
+            self.results.add(self.name, self.size, time.perf_counter() - self.start)
+
+#Tasks like the ones of a busy guild: titles and descriptions of different lengths, a few assignees, some done and some with an end date.
+#The same seed gives the same tasks, so runs can be compared
+def make_tasks(count, seed=0):
+    rng = random.Random(seed)
+    words = ['fix', 'the', 'deploy', 'review', 'pull', 'request', 'meeting', 'notes', 'refactor', 'storage', 'backend', 'a', 'verylongwordthatdoesntfitinacolumnofthetasklist', 'update', 'docs']
+    users = [tasks.Assignee.user(1000 + i) for i in range(50)]
+    roles = [tasks.Assignee.role(f'role{i}') for i in range(5)]
+    today = datetime.datetime(2024, 1, 1)
+    result = []
+    for i in range(count):
+        task = tasks.Task()
+        task.title = f'task {i} ' + ' '.join(rng.choices(words, k=rng.randint(1, 8)))
+        task.description = ' '.join(rng.choices(words, k=rng.randint(0, 40)))
+        task.assignees = tasks.Assignee.freeze(rng.sample(users, rng.randint(0, 3)) + rng.sample(roles, rng.randint(0, 1)))
+        task.done = i % 3 == 0
+        task.start_date = today
+        task.end_date = today + datetime.timedelta(days=rng.randint(1, 60)) if i % 2 == 0 else None
+        result.append(task)
+    return result
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+#TaskListRenderer: write_column, every page with an empty and with a full row cache, and a TaskListMessage browsed with the buttons
+async def bench_render(results, sizes, repeat, loop):
+    channel = FakeChannel(1)
+    for size in sizes:
+        task_list = make_tasks(size)
+        renderer = tasks.TaskListRenderer()
+        texts = [i.get_title() for i in task_list] + [i.get_description() for i in task_list]
+        for _ in range(repeat):
+            with results.timed('write_column', size):
+                for text in texts:
+                    renderer.write_column(text, renderer.max_column_width)
+            renderer.clear()
+            with results.timed('render_pages_cold', size):
+                for _ in renderer.pages(task_list):
+                    pass
+            with results.timed('render_pages_warm', size):
+                for _ in renderer.pages(task_list):
+                    pass
+            renderer.clear()
+            store = tasks.TaskStore(task_list)
+            interaction = FakeInteraction(channel)
+            message = tasks.TaskListMessage(loop, channel, renderer)
+            #The first page, then the next 10
+            with results.timed('list_respond', size):
+                await message.respond(interaction, store.select(tasks.TaskQuery()))
+            with results.timed('list_next_10', size):
+                for _ in range(10):
+                    await message.next_button_callback(interaction)
+
+#TaskManager.persist_tasks and the load of the tasks of a guild, for each storage backend
+async def bench_persist(results, sizes, repeat, loop, workdir, backends):
+    notification_index = tasks.NotificationIndex(loop, f'{workdir}/persist')
+    for backend in backends:
+        for size in sizes:
+            guild_id = f'{backend}{size}'
+            database = storage.TaskDatabase(f'{workdir}/persist/{guild_id}.db') if backend == 'sqlite' else None
+            task_storage = storage.create_storage(backend, guild_id, loop, f'{workdir}/persist', database)
+            #Seeded through the storage, the TaskManager loads the tasks on first access like it does for a guild
+            task_storage.dump(tasks.TaskStore(make_tasks(size)))
+            task_storage.close()
+            task_manager = tasks.TaskManager(loop, GUILD_ID, None, None, task_storage=task_storage, notification_index=notification_index)
+            task_manager.tasks
+            for _ in range(repeat):
+                with results.timed(f'persist_tasks_{backend}', size):
+                    task_manager.persist_tasks()
+                await task_manager.unload()
+                with results.timed(f'load_{backend}', size):
+                    task_manager.tasks
+            await task_manager.unload()
+            if database is not None:
+                database.close()
+
+#Pulls of boards of different sizes into an empty guild, after a few cards change and without changes, and pushes of dirty tasks.
+#The tasks are kept by the base Storage, which writes nothing, so only the reconciliation is measured
+async def bench_sync(results, sizes, repeat, loop, workdir, dirty):
+    fake = fake_trello.FakeTrello(port=free_port())
+    await fake.start()
+    #No rate limits, only the time of the requests to fake_trello
+    session = trello.TrelloSession(scheduler=trello.RequestScheduler(key_limit=(10**9, 1), token_limit=(10**9, 1)))
+    notification_index = tasks.NotificationIndex(loop, f'{workdir}/sync')
+    try:
+        for size in sizes:
+            board = fake.add_board()
+            for task in make_tasks(size):
+                card = {'id': fake.new_id(), 'name': task.get_title(), 'desc': task.get_description(), 'dueComplete': task.is_done(), 'closed': False, 'idBoard': board['id']}
+                board['cards'][card['id']] = card
+                fake.cards[card['id']] = card
+            cards = list(board['cards'])
+            changed = max(1, int(size*dirty))
+            for _ in range(repeat):
+                _trello = trello.Trello('key', 'token', board['shortLink'], session=session, base_url=fake.get_url())
+                task_manager = tasks.TaskManager(loop, GUILD_ID, None, _trello, task_storage=storage.Storage(GUILD_ID), notification_index=notification_index)
+                with results.timed('sync_local_full', size):
+                    await task_manager.sync_local()
+                with results.timed('sync_local_noop', size):
+                    await task_manager.sync_local()
+                #Fewer changed cards than Trello.MAX_CHANGED_CARDS are fetched one by one
+                for card_id in cards[:min(changed, trello.Trello.MAX_CHANGED_CARDS)]:
+                    await fake.update_card(card_id, name=f'{fake.cards[card_id]["name"]}!')
+                with results.timed('sync_local_changed', size):
+                    await task_manager.sync_local()
+                for task in itertools.islice(task_manager.tasks, changed):
+                    task.set_title(f'{task.get_title()}?')
+                with results.timed('sync_trello', size):
+                    await task_manager.sync_trello()
+                board['actions'] = []
+    finally:
+        await session.close()
+        await fake.stop()
+
+#Starting count notifications that are already due, and firing all of them until their messages are sent
+async def bench_notifications(results, sizes, repeat, loop):
+    scheduler = tasks.NotificationScheduler.get(loop)
+    outbox = tasks.Outbox.get(loop)
+    for size in sizes:
+        task_list = make_tasks(size)
+        for task in task_list:
+            task.done = False
+        for _ in range(repeat):
+            channel = FakeChannel(size)
+            notifications = []
+            for task in task_list:
+                notification = tasks.Notification(1, tasks.TimeMeasure.DAY, task, task.get_start_date())
+                notification.next_fire = time.time()
+                notifications.append(notification)
+            fired = scheduler.fired
+            with results.timed('notifications_start', size):
+                for notification in notifications:
+                    notification.run(loop, channel)
+            with results.timed('notifications_fire', size):
+                while scheduler.fired < fired + size:
+                    await asyncio.sleep(0)
+                await outbox.join()
+            for notification in notifications:
+                notification.stop()
+
+async def run(args):
+    loop = asyncio.get_running_loop()
+    #Without pacing, the fake channels answer at once
+    tasks.Outbox.get(loop, rate=10**9, period=1, max_pending=10**9)
+    results = Results()
+    only = args.only.split(',')
+    with tempfile.TemporaryDirectory() as workdir:
+        if 'render' in only:
+            await bench_render(results, args.sizes, args.repeat, loop)
+        if 'persist' in only:
+            await bench_persist(results, args.sizes, args.repeat, loop, workdir, args.backends.split(','))
+        if 'sync' in only:
+            await bench_sync(results, args.board_sizes, args.repeat, loop, workdir, args.dirty)
+        if 'notifications' in only:
+            await bench_notifications(results, args.notifications, args.repeat, loop)
+    return {
+        'meta': {'python': sys.version.split()[0], 'platform': platform.platform(), 'date': datetime.datetime.now(datetime.timezone.utc).isoformat(), 'repeat': args.repeat},
+        'results': results.summary()
+    }
+
+#Returns (key, old median, new median, ratio) of the benchmarks in both runs
+def compare(old, new):
+    rows = []
+    for key, result in new['results'].items():
+        if key in old['results']:
+            rows.append((key, old['results'][key]['median'], result['median'], result['median']/old['results'][key]['median']))
+    return rows
+
+def sizes(text):
+    return [int(i) for i in text.split(',') if i != '']
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--only', default='render,persist,sync,notifications')
+    parser.add_argument('--sizes', type=sizes, default=[100, 1000, 10000, 100000])
+    parser.add_argument('--backends', default='pickle')
+    parser.add_argument('--board-sizes', type=sizes, default=[100, 1000, 10000])
+    parser.add_argument('--dirty', type=float, default=0.1)
+    parser.add_argument('--notifications', type=sizes, default=[100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args()
+    if args.compare is not None:
+        old, new = (json.loads(open(i, 'r').read()) for i in args.compare)
+        regressions = 0
+        for key, old_median, new_median, ratio in compare(old, new):
+            regression = ratio > 1 + args.threshold
+            regressions += regression
+            print(f'{key:40} {old_median*1000:10.3f}ms {new_median*1000:10.3f}ms {ratio:6.2f}x{"  REGRESSION" if regression else ""}')
+        sys.exit(1 if regressions > 0 else 0)
+    #What the bot prints goes to stderr, stdout only has the results
+    with contextlib.redirect_stdout(sys.stderr):
+        report = asyncio.run(run(args))
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=1)
+    else:
+        print(json.dumps(report, indent=1))
+    for key, result in report['results'].items():
+        print(f'{key:40} median {result["median"]*1000:10.3f}ms  min {result["min"]*1000:10.3f}ms', file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,67 @@
 import discord
 from discord.ext.commands import bot, Context
+from discord import app_commands
 import tasks
 import asyncio
 import json
+import shlex
 import trello
+import storage
+import concurrent.futures
+import time
+import datetime
+import random
+import webhook
 class Bot():
-    def __init__(self, prefix:str, token:str, notification_channel_name:str, trello_api_key:str, trello_token:str) -> None:
-        intents = discord.Intents.all()
-        self.bot = bot.Bot(command_prefix=prefix, intents=intents)
+    def __init__(self, prefix:str, token:str, notification_channel_name:str, trello_api_key:str, trello_token:str, storage_backend:str='pickle', journal_compact_threshold:int=1000, sqlite_path:str='tasks/tasks.db', write_behind_interval:float=0, guild_idle_ttl:float=0, max_resident_tasks:int=0, notification_mode:str='single', digest_window:float=5, trello_base_url:str='https://api.trello.com/1', webhook_callback_url:str|None=None, webhook_host:str='0.0.0.0', webhook_port:int=8080, trello_api_secret:str|None=None, auto_sync_interval:float=0, auto_sync_jitter:float=0.1, auto_sync_concurrency:int=2, auto_sync_idle:float=3600, sync_slash_commands:bool=True, outbox_rate:int=5, outbox_period:float=5, outbox_max_pending:int=100, shard_count:int=0, shard_ids:list[int]|None=None, worker_id:int=0, low_memory:bool=False, member_cache_size:int=1024) -> None:
+        options = self.client_options(low_memory)
+        #Workers of a cluster (see cluster.py) connect to shard_ids of shard_count shards and share the files with the other workers
+        if shard_count > 0:
+            self.bot = bot.AutoShardedBot(command_prefix=prefix, shard_count=shard_count, shard_ids=shard_ids, **options)
+        else:
+            self.bot = bot.Bot(command_prefix=prefix, **options)
+        self.shared_files = shard_ids is not None
         self.bot.on_guild_available = self.on_guild_available
+        self.bot.setup_hook = self.setup_hook
+        self.bot.close = self.close_bot
+        tasks.PersistentButton.get_taskmanager = self.get_taskmanager
+        self.members = tasks.MemberResolver(member_cache_size, query=low_memory)
+        tasks.MemberResolver.instance = self.members
         self.token = token
         self.notification_channel_name = notification_channel_name
         self.trello_boards_path = 'guild_trello_boards.json'
         self.trello_api_key = trello_api_key
         self.trello_token = trello_token
+        self.trello_base_url = trello_base_url
+        self.trello_session = trello.TrelloSession()
+        self.trello_sync_state = trello.SyncState()
         self.taskmanagers = {}
+        self.notification_channels = {}
+        self.notification_index = None
+        self.outbox = None
+        self.guild_idle_ttl = guild_idle_ttl
+        self.max_resident_tasks = max_resident_tasks
+        #A single eviction runs at a time, and loads schedule at most one more
+        self.evict_lock = asyncio.Lock()
+        self.evict_pending = False
+        self.notification_mode = notification_mode
+        self.digest_window = digest_window
+        self.storage_backend = storage_backend
+        self.journal_compact_threshold = journal_compact_threshold
+        self.database = storage.TaskDatabase(sqlite_path) if storage_backend == 'sqlite' else None
+        self.write_behind_interval = write_behind_interval
+        self.auto_sync_interval = auto_sync_interval
+        self.auto_sync_jitter = auto_sync_jitter
+        self.auto_sync_concurrency = auto_sync_concurrency
+        self.auto_sync_idle = auto_sync_idle
+        self.sync_slash_commands = sync_slash_commands
+        self.outbox_rate = outbox_rate
+        self.outbox_period = outbox_period
+        self.outbox_max_pending = outbox_max_pending
+        self.persist_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='persist')
+        #Without a public url the boards are only synced by the commands
+        #Every worker of a cluster listens on its own port, webhook_callback_url can contain {worker} and {port} to reach it
+        self.webhook_server = webhook.TrelloWebhookServer(webhook_host, webhook_port + worker_id, webhook_callback_url.format(worker=worker_id, port=webhook_port + worker_id), self.on_trello_action, trello_api_secret) if webhook_callback_url else None
         try:
             self.guild_trello_board = json.loads(open(self.trello_boards_path, 'r').read())
         except:
@@ -31,29 +78,63 @@ class Bot():
         self.unassign()
         self.set_start_date()
         self.set_end_date()
+        self.slash_create_task()
+        self.slash_list_tasks()
+        self.slash_edit_task()
+        self.slash_delete_task()
+        self.slash_set_done()
+        self.slash_set_undone()
+        self.slash_assign()
+        self.slash_unassign()
+        self.slash_notify_every()
+        self.slash_set_start_date()
+        self.slash_set_end_date()
+
+    #discord.py options of the client. low_memory only asks for the events the commands use (guilds with their channels and roles,
+    #messages and their content for the prefix commands) and caches no members, presences or messages. Members are found by name through MemberResolver
+    @staticmethod
+    def client_options(low_memory=False):
+        if not low_memory:
+            return {'intents': discord.Intents.all()}
+        return {
+            'intents': discord.Intents(guilds=True, guild_messages=True, message_content=True),
+            'member_cache_flags': discord.MemberCacheFlags.none(),
+            'chunk_guilds_at_startup': False,
+            'max_messages': None
+        }
 
     def task(self):
         @self.bot.command()
         async def task(context:Context, *args:discord.User|discord.Role):
-            self.taskmanagers[context.guild.id].create_task(context, args)
+            try:
+                self.get_taskmanager(context.guild).create_task(context, args)
+            except ValueError as e:
+                await context.send(str(e))
         return task
 
     def list_tasks(self):
         @self.bot.command()
         async def list_tasks(context:Context, *args):
-            self.taskmanagers[context.guild.id].list_tasks(context)
+            try:
+                for name in tasks.TaskQuery.assignee_names(args):
+                    await self.members.load_member_named(context.guild, name)
+                query = tasks.TaskQuery.parse(args, context.guild, context.author)
+            except ValueError as e:
+                await context.send(str(e))
+                return
+            self.get_taskmanager(context.guild).list_tasks(context, query)
         return list_tasks
 
     def set_done(self):
         @self.bot.command()
         async def set_done(context:Context, *args):
-            self.taskmanagers[context.guild.id].set_done(context, True)
+            self.get_taskmanager(context.guild).set_done(context, True)
         return set_done
 
     def set_undone(self):
         @self.bot.command()
         async def set_undone(context:Context, *args):
-            self.taskmanagers[context.guild.id].set_done(context, False)
+            self.get_taskmanager(context.guild).set_done(context, False)
         return set_undone
 
     def notify_every(self):
@@ -62,59 +143,362 @@ class Bot():
             measure = measure.upper()
             if measure.endswith('S'):
                 measure = measure[:len(measure)-1]
-            self.taskmanagers[context.guild.id].create_notification(context, rate, measure)
+            self.get_taskmanager(context.guild).create_notification(context, rate, measure)
         return notify_every
     
     def assign_trello(self):
         @self.bot.command()
         async def assign_trello(context:Context, trello_board:str|None=None):
-            self.guild_trello_board[str(context.guild.id)] = trello_board
-            self.taskmanagers[context.guild.id].set_trello(trello.Trello(self.trello_api_key, self.trello_token, trello_board) if trello_board is not None else None)
-            with open(self.trello_boards_path ,'w') as file:
-                file.write(json.dumps(self.guild_trello_board))
+            self.guild_trello_board = storage.update_json(self.trello_boards_path, str(context.guild.id), trello_board)
+            self.get_taskmanager(context.guild).set_trello(self.create_trello(trello_board) if trello_board is not None else None)
+            if self.webhook_server is not None:
+                self.webhook_server.unregister(context.guild.id)
+                if trello_board is not None:
+                    await self.watch_trello(context.guild)
         return assign_trello
 
     def sync_local(self):
         @self.bot.command()
         async def sync_local(context:Context):
-            self.taskmanagers[context.guild.id].sync_local()
+            await self.get_taskmanager(context.guild).sync_local()
         return sync_local
 
     def sync_trello(self):
         @self.bot.command()
         async def sync_trello(context:Context):
-            self.taskmanagers[context.guild.id].sync_trello()
+            await self.get_taskmanager(context.guild).sync_trello()
         return sync_trello
 
     def assign(self):
         @self.bot.command()
         async def assign(context:Context, *args:discord.User|discord.Role):
-            self.taskmanagers[context.guild.id].assign_task(context, args)
+            self.get_taskmanager(context.guild).assign_task(context, args)
         return assign
 
     def unassign(self):
         @self.bot.command()
         async def unassign(context:Context, *args:discord.User|discord.Role):
-            self.taskmanagers[context.guild.id].unassign_task(context, args)
+            self.get_taskmanager(context.guild).unassign_task(context, args)
         return unassign
 
     def set_start_date(self):
         @self.bot.command()
         async def set_start_date(context:Context, start_date):
-            self.taskmanagers[context.guild.id].set_start_date(context, start_date)
+            self.get_taskmanager(context.guild).set_start_date(context, start_date)
         return set_start_date
 
     def set_end_date(self):
         @self.bot.command()
         async def set_end_date(context:Context, end_date):
-            self.taskmanagers[context.guild.id].set_end_date(context, end_date)
+            self.get_taskmanager(context.guild).set_end_date(context, end_date)
         return set_end_date
 
+    #Slash commands. The task argument autocompletes from the title index of the guild and takes the task_id of the chosen task
+    async def task_autocomplete(self, interaction:discord.Interaction, current:str):
+        taskmanager = self.get_taskmanager(interaction.guild)
+        return [app_commands.Choice(name=(title or '-')[:100], value=task_id) for task_id, title in taskmanager.search_tasks(current, 25)]
+
+    #Returns the TaskManager and the task of a slash command, answering the interaction if the task doesn't exist
+    async def slash_task(self, interaction:discord.Interaction, value:str):
+        taskmanager = self.get_taskmanager(interaction.guild)
+        task = taskmanager.resolve_task(value)
+        if task is None:
+            await interaction.response.send_message(f'Task "{value}" not found', ephemeral=True)
+        return taskmanager, task
+
+    def slash_create_task(self):
+        @self.bot.tree.command(name='task', description='Creates a task')
+        @app_commands.describe(assignee='User or role the task is assigned to, you if empty')
+        @app_commands.guild_only()
+        async def slash_create_task(interaction:discord.Interaction, assignee:discord.Member|discord.Role|None=None):
+            taskmanager = self.get_taskmanager(interaction.guild)
+            await interaction.response.send_modal(taskmanager.create_modal([taskmanager.assignee_key(assignee if assignee is not None else interaction.user)]))
+        return slash_create_task
+
+    def slash_list_tasks(self):
+        @self.bot.tree.command(name='list_tasks', description='Lists the tasks')
+        @app_commands.describe(query='Filters like assignee:me done:false due<25/12/2026 sort:end_date limit:10')
+        @app_commands.guild_only()
+        async def slash_list_tasks(interaction:discord.Interaction, query:str|None=None):
+            try:
+                args = shlex.split(query) if query is not None else []
+                for name in tasks.TaskQuery.assignee_names(args):
+                    await self.members.load_member_named(interaction.guild, name)
+                task_query = tasks.TaskQuery.parse(args, interaction.guild, interaction.user)
+            except ValueError as e:
+                await interaction.response.send_message(str(e), ephemeral=True)
+                return
+            await self.get_taskmanager(interaction.guild).respond_task_list(interaction, task_query)
+        return slash_list_tasks
+
+    def slash_edit_task(self):
+        @self.bot.tree.command(name='edit', description='Edits a task')
+        @app_commands.autocomplete(task=self.task_autocomplete)
+        @app_commands.guild_only()
+        async def slash_edit_task(interaction:discord.Interaction, task:str):
+            taskmanager, task = await self.slash_task(interaction, task)
+            if task is not None:
+                await interaction.response.send_modal(taskmanager.edit_modal(task))
+        return slash_edit_task
+
+    def slash_delete_task(self):
+        @self.bot.tree.command(name='delete', description='Deletes a task')
+        @app_commands.autocomplete(task=self.task_autocomplete)
+        @app_commands.guild_only()
+        async def slash_delete_task(interaction:discord.Interaction, task:str):
+            taskmanager, task = await self.slash_task(interaction, task)
+            if task is not None:
+                taskmanager.delete_task(task.get_task_id())
+                await interaction.response.send_message(f'Task "{task.get_title()}" deleted', ephemeral=True)
+        return slash_delete_task
+
+    def slash_set_done(self):
+        @self.bot.tree.command(name='set_done', description='Marks a task as done')
+        @app_commands.autocomplete(task=self.task_autocomplete)
+        @app_commands.guild_only()
+        async def slash_set_done(interaction:discord.Interaction, task:str):
+            taskmanager, task = await self.slash_task(interaction, task)
+            if task is not None:
+                taskmanager.set_task_done(task, True)
+                await interaction.response.send_message(f'Task "{task.get_title()}" done', ephemeral=True)
+        return slash_set_done
+
+    def slash_set_undone(self):
+        @self.bot.tree.command(name='set_undone', description='Marks a task as not done')
+        @app_commands.autocomplete(task=self.task_autocomplete)
+        @app_commands.guild_only()
+        async def slash_set_undone(interaction:discord.Interaction, task:str):
+            taskmanager, task = await self.slash_task(interaction, task)
+            if task is not None:
+                taskmanager.set_task_done(task, False)
+                await interaction.response.send_message(f'Task "{task.get_title()}" not done', ephemeral=True)
+        return slash_set_undone
+
+    def slash_assign(self):
+        @self.bot.tree.command(name='assign', description='Assigns a task to a user or role')
+        @app_commands.describe(assignee='User or role, you if empty')
+        @app_commands.autocomplete(task=self.task_autocomplete)
+        @app_commands.guild_only()
+        async def slash_assign(interaction:discord.Interaction, task:str, assignee:discord.Member|discord.Role|None=None):
+            taskmanager, task = await self.slash_task(interaction, task)
+            if task is not None:
+                taskmanager.assign(task, [taskmanager.assignee_key(assignee if assignee is not None else interaction.user)])
+                await interaction.response.send_message(f'Task "{task.get_title()}" assigned', ephemeral=True)
+        return slash_assign
+
+    def slash_unassign(self):
+        @self.bot.tree.command(name='unassign', description='Unassigns a task from a user or role')
+        @app_commands.describe(assignee='User or role, you if empty')
+        @app_commands.autocomplete(task=self.task_autocomplete)
+        @app_commands.guild_only()
+        async def slash_unassign(interaction:discord.Interaction, task:str, assignee:discord.Member|discord.Role|None=None):
+            taskmanager, task = await self.slash_task(interaction, task)
+            if task is not None:
+                taskmanager.unassign(task, [taskmanager.assignee_key(assignee if assignee is not None else interaction.user)])
+                await interaction.response.send_message(f'Task "{task.get_title()}" unassigned', ephemeral=True)
+        return slash_unassign
+
+    def slash_notify_every(self):
+        @self.bot.tree.command(name='notify_every', description='Reminds the assignees of a task periodically')
+        @app_commands.choices(measure=[app_commands.Choice(name=i.lower()+'s', value=i) for i in ('SECOND', 'MINUTE', 'HOUR', 'DAY')])
+        @app_commands.autocomplete(task=self.task_autocomplete)
+        @app_commands.guild_only()
+        async def slash_notify_every(interaction:discord.Interaction, task:str, rate:app_commands.Range[int, 1], measure:app_commands.Choice[str]):
+            taskmanager, task = await self.slash_task(interaction, task)
+            if task is not None:
+                taskmanager.notify_task(task, rate, measure.value)
+                await interaction.response.send_message(f'Task "{task.get_title()}" reminded every {rate} {measure.name}', ephemeral=True)
+        return slash_notify_every
+
+    def slash_set_start_date(self):
+        @self.bot.tree.command(name='set_start_date', description='Sets the start date of a task')
+        @app_commands.describe(date='dd/mm/yyyy')
+        @app_commands.autocomplete(task=self.task_autocomplete)
+        @app_commands.guild_only()
+        async def slash_set_start_date(interaction:discord.Interaction, task:str, date:str):
+            taskmanager, task = await self.slash_task(interaction, task)
+            if task is not None:
+                try:
+                    taskmanager.set_task_start_date(task, date)
+                except ValueError:
+                    await interaction.response.send_message('The date must be dd/mm/yyyy', ephemeral=True)
+                    return
+                await interaction.response.send_message(f'Task "{task.get_title()}" starts on {date}', ephemeral=True)
+        return slash_set_start_date
+
+    def slash_set_end_date(self):
+        @self.bot.tree.command(name='set_end_date', description='Sets the end date of a task')
+        @app_commands.describe(date='dd/mm/yyyy')
+        @app_commands.autocomplete(task=self.task_autocomplete)
+        @app_commands.guild_only()
+        async def slash_set_end_date(interaction:discord.Interaction, task:str, date:str):
+            taskmanager, task = await self.slash_task(interaction, task)
+            if task is not None:
+                try:
+                    datetime.datetime.strptime(date, '%d/%m/%Y')
+                except ValueError:
+                    await interaction.response.send_message('The date must be dd/mm/yyyy', ephemeral=True)
+                    return
+                taskmanager.set_task_end_date(task, date)
+                await interaction.response.send_message(f'Task "{task.get_title()}" ends on {date}', ephemeral=True)
+        return slash_set_end_date
+
+    async def setup_hook(self):
+        self.outbox = tasks.Outbox.get(asyncio.get_event_loop(), rate=self.outbox_rate, period=self.outbox_period, max_pending=self.outbox_max_pending)
+        #Buttons of menus sent before a restart are dispatched by their custom_id
+        self.bot.add_dynamic_items(tasks.PersistentButton, tasks.PersistentValues)
+        self.notification_index = tasks.NotificationIndex(asyncio.get_event_loop(), mode=self.notification_mode, digest_window=self.digest_window, shared=self.shared_files)
+        if self.guild_idle_ttl > 0 or self.max_resident_tasks > 0:
+            self.bot.loop.create_task(self.evict_loop())
+        if self.webhook_server is not None:
+            await self.webhook_server.start()
+        if self.auto_sync_interval > 0:
+            self.bot.loop.create_task(self.auto_sync_loop())
+        #Registering the slash commands is rate limited by discord, it can be turned off once they are registered
+        if self.sync_slash_commands:
+            try:
+                await self.bot.tree.sync()
+            except discord.DiscordException as e:
+                print(e)
+
+    #TaskManagers aren't created here, only the notifications of the guild are started
     async def on_guild_available(self, guild):
         notification_channel = discord.utils.get(guild.channels, name=self.notification_channel_name)
-        trello_id = self.guild_trello_board.get(str(guild.id), None)
-        trello_board = trello.Trello(self.trello_api_key, self.trello_token, trello_id) if trello_id is not None else None
-        self.taskmanagers[guild.id] = tasks.TaskManager(asyncio.get_event_loop(), guild.id, notification_channel, trello_board)
+        self.notification_channels[guild.id] = notification_channel
+        if guild.id in self.taskmanagers:
+            self.taskmanagers[guild.id].notification_channel = notification_channel
+        if not self.notification_index.has_guild(guild.id):
+            #First start with the index, the tasks of the guild have to be read once
+            taskmanager = self.get_taskmanager(guild)
+            self.notification_index.seed(guild.id, taskmanager.tasks)
+        self.notification_index.start(guild.id, notification_channel)
+        if self.webhook_server is not None and self.guild_trello_board.get(str(guild.id), None) is not None:
+            self.bot.loop.create_task(self.watch_trello(guild))
+
+    #Registers the webhook of the board of the guild, then pulls what changed while the bot was offline
+    async def watch_trello(self, guild):
+        try:
+            with trello.priority(trello.RequestScheduler.BACKGROUND):
+                taskmanager = self.get_taskmanager(guild)
+                await self.webhook_server.register(guild.id, taskmanager.trello)
+                await taskmanager.sync_local()
+        except Exception as e:
+            print(e)
+
+    async def on_trello_action(self, guild_id, action):
+        guild = self.bot.get_guild(guild_id)
+        if guild is not None:
+            with trello.priority(trello.RequestScheduler.BACKGROUND):
+                self.get_taskmanager(guild).apply_trello_action(action)
+
+    def create_trello(self, board_id) -> trello.Trello:
+        return trello.Trello(self.trello_api_key, self.trello_token, board_id, session=self.trello_session, sync_state=self.trello_sync_state, base_url=self.trello_base_url)
+
+    #Returns the TaskManager of the guild, creating it on first use. Its tasks are loaded when first accessed
+    def get_taskmanager(self, guild) -> tasks.TaskManager:
+        taskmanager = self.taskmanagers.get(guild.id, None)
+        if taskmanager is None:
+            notification_channel = self.notification_channels.get(guild.id, None)
+            if notification_channel is None:
+                notification_channel = discord.utils.get(guild.channels, name=self.notification_channel_name)
+            trello_id = self.guild_trello_board.get(str(guild.id), None)
+            trello_board = self.create_trello(trello_id) if trello_id is not None else None
+            loop = asyncio.get_event_loop()
+            task_storage = storage.create_storage(self.storage_backend, guild.id, loop, database=self.database, write_behind_interval=self.write_behind_interval, executor=self.persist_executor, journal_compact_threshold=self.journal_compact_threshold)
+            taskmanager = tasks.TaskManager(loop, guild.id, notification_channel, trello_board, task_storage=task_storage, notification_index=self.notification_index)
+            self.taskmanagers[guild.id] = taskmanager
+        taskmanager.touch()
+        #Only loading the tasks of a guild, which the caller does on first access, adds resident tasks. Other uses are left to evict_loop
+        if self.max_resident_tasks > 0 and not taskmanager.is_loaded() and not self.evict_pending:
+            self.evict_pending = True
+            self.bot.loop.create_task(self.evict())
+        return taskmanager
+
+    #Unloads guilds idle for longer than guild_idle_ttl, then the least recently used ones until the loaded tasks fit in max_resident_tasks.
+    #The most recently used guild is never unloaded
+    async def evict(self):
+        async with self.evict_lock:
+            self.evict_pending = False
+            loaded = sorted([i for i in self.taskmanagers.values() if i.is_loaded() and not i.is_syncing()], key=lambda i: i.last_used)
+            if len(loaded) == 0:
+                return
+            loaded.pop()
+            now = time.monotonic()
+            resident = sum(i.loaded_count() for i in loaded)
+            for taskmanager in loaded:
+                idle = self.guild_idle_ttl > 0 and now - taskmanager.last_used > self.guild_idle_ttl
+                over_budget = self.max_resident_tasks > 0 and resident > self.max_resident_tasks
+                if not idle and not over_budget:
+                    continue
+                resident -= taskmanager.loaded_count()
+                try:
+                    await taskmanager.unload()
+                except Exception as e:
+                    print(e)
+
+    async def evict_loop(self):
+        interval = min(self.guild_idle_ttl, 60) if self.guild_idle_ttl > 0 else 60
+        while True:
+            await asyncio.sleep(interval)
+            await self.evict()
     
+    #Syncs every guild linked to a board each auto_sync_interval seconds, auto_sync_concurrency guilds at a time.
+    #Guilds without commands or interactions in the last auto_sync_idle seconds are skipped
+    async def auto_sync_loop(self):
+        semaphore = asyncio.Semaphore(self.auto_sync_concurrency)
+        while True:
+            await asyncio.sleep(self.auto_sync_interval)
+            now = time.monotonic()
+            guilds = []
+            for guild_id, board in list(self.guild_trello_board.items()):
+                guild = self.bot.get_guild(int(guild_id))
+                taskmanager = self.taskmanagers.get(int(guild_id), None)
+                if board is None or guild is None:
+                    continue
+                if self.auto_sync_idle > 0 and (taskmanager is None or now - taskmanager.last_used > self.auto_sync_idle):
+                    continue
+                guilds.append(guild)
+            await asyncio.gather(*[self.auto_sync(guild, semaphore) for guild in guilds])
+
+    #Guilds start at a random point of the first auto_sync_jitter part of the interval so their requests don't arrive together
+    async def auto_sync(self, guild, semaphore):
+        await asyncio.sleep(random.uniform(0, self.auto_sync_interval * self.auto_sync_jitter))
+        async with semaphore:
+            try:
+                with trello.priority(trello.RequestScheduler.BACKGROUND):
+                    taskmanager = self.get_taskmanager(guild)
+                    await taskmanager.sync_local()
+                    await taskmanager.sync_trello()
+            except Exception as e:
+                print(e)
+
+    #Closes what needs the event loop before discord closes it
+    async def close_bot(self):
+        if self.webhook_server is not None:
+            await self.webhook_server.stop()
+        if self.outbox is not None:
+            try:
+                await asyncio.wait_for(self.outbox.join(), 5)
+            except asyncio.TimeoutError:
+                print(f'{self.outbox.get_pending()} messages were not sent')
+        await self.trello_session.close()
+        await type(self.bot).close(self.bot)
+
     def start(self):
-        self.bot.run(token=self.token)
+        try:
+            self.bot.run(token=self.token)
+        finally:
+            self.close()
+
+    #Final flush of every guild once the bot stops. Writes still running in the executor end first
+    def close(self):
+        self.persist_executor.shutdown(wait=True)
+        for taskmanager in self.taskmanagers.values():
+            try:
+                taskmanager.close()
+            except Exception as e:
+                print(e)
+        if self.database is not None:
+            self.database.close()
+        if self.notification_index is not None:
+            self.notification_index.persist()
@@ -0,0 +1,141 @@
+import aiohttp
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import time
+import bot
+
+#Worker process of a cluster, one bot connected to shard_ids of the shard_count shards.
+#Only the first worker registers the slash commands
+def run_worker(cfg, worker_id, shard_count, shard_ids):
+    cfg = cfg | {'sync_slash_commands': cfg.get('sync_slash_commands', True) and worker_id == 0}
+    _bot = bot.Bot(**cfg, shard_count=shard_count, shard_ids=shard_ids, worker_id=worker_id)
+    try:
+        _bot.start()
+    except KeyboardInterrupt:
+        pass
+
+#Number of shards discord recommends for the bot
+def recommended_shards(token):
+    async def fetch():
+        async with aiohttp.ClientSession() as session:
+            async with session.get('https://discord.com/api/v10/gateway/bot', headers={'Authorization': f'Bot {token}'}) as response:
+                response.raise_for_status()
+                return (await response.json())['shards']
+    return asyncio.run(fetch())
+
+#Runs the bot in several processes. discord sends the events of a guild to shard (guild_id >> 22) % shard_count, so each guild,
+#with its tasks, trello board and notifications, belongs to the one worker connected to its shard. The workers share the storage files.
+#Workers that exit are started again after an exponential backoff. A worker that exits more than max_restarts times within
+#restart_window seconds is dropped and the shards are dealt again among the remaining workers
+class Supervisor():
+    def __init__(self, cfg, workers, shard_count, max_restarts=5, restart_window=300, backoff=1, max_backoff=60, stop_timeout=30) -> None:
+        self.cfg = cfg
+        self.shard_count = shard_count
+        self.max_restarts = max_restarts
+        self.restart_window = restart_window
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stop_timeout = stop_timeout
+        #Ids of the workers that are kept running
+        self.workers = list(range(workers))
+        self.shards = {}
+        self.processes = {}
+        #worker id -> times it exited within restart_window
+        self.exits = {}
+        #worker id -> time.monotonic() of its next start
+        self.starts = {}
+        self.context = multiprocessing.get_context('spawn')
+
+    #Shards are dealt round robin, the i-th worker gets shards i, i+n, i+2n...
+    def assign(self):
+        return {worker_id: list(range(i, self.shard_count, len(self.workers))) for i, worker_id in enumerate(self.workers)}
+
+    def start_worker(self, worker_id):
+        process = self.context.Process(target=run_worker, args=(self.cfg, worker_id, self.shard_count, self.shards[worker_id]), name=f'worker-{worker_id}')
+        process.start()
+        self.processes[worker_id] = process
+        print(f'worker {worker_id} started with shards {self.shards[worker_id]}, pid {process.pid}')
+
+    #The worker is stopped like with ctrl+c, so it flushes its guilds before another worker takes them
+    def stop_worker(self, worker_id):
+        process = self.processes.pop(worker_id, None)
+        if process is None:
+            return
+        if process.is_alive():
+            if os.name == 'nt':
+                process.terminate()
+            else:
+                os.kill(process.pid, signal.SIGINT)
+            process.join(self.stop_timeout)
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+    #Workers whose shards change are stopped before any of them starts again, a guild is never handled by two workers
+    def rebalance(self):
+        shards = self.assign()
+        changed = [i for i in self.workers if shards[i] != self.shards.get(i, None)]
+        for worker_id in changed:
+            self.stop_worker(worker_id)
+        self.shards = shards
+        for worker_id in changed:
+            self.starts[worker_id] = time.monotonic()
+
+    #Method to restart the workers that exited. Returns False once no worker is left
+    def check(self):
+        now = time.monotonic()
+        for worker_id, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            self.processes.pop(worker_id)
+            exits = [i for i in self.exits.get(worker_id, []) if now - i < self.restart_window] + [now]
+            self.exits[worker_id] = exits
+            print(f'worker {worker_id} exited with code {process.exitcode}')
+            if len(exits) > self.max_restarts:
+                print(f'worker {worker_id} exited {len(exits)} times in {self.restart_window} seconds, its shards go to the other workers')
+                self.workers.remove(worker_id)
+                self.starts.pop(worker_id, None)
+                if len(self.workers) == 0:
+                    return False
+                self.rebalance()
+            else:
+                self.starts[worker_id] = now + min(self.max_backoff, self.backoff * 2**(len(exits)-1))
+        for worker_id, start in list(self.starts.items()):
+            if start <= now:
+                self.starts.pop(worker_id)
+                self.start_worker(worker_id)
+        return True
+
+    def run(self, interval=1):
+        self.shards = self.assign()
+        for worker_id in self.workers:
+            self.start_worker(worker_id)
+        try:
+            while self.check():
+                time.sleep(interval)
+            print('every worker was dropped')
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        for worker_id in list(self.processes):
+            self.stop_worker(worker_id)
+
+#cfg is the bot configuration with the cluster_ keys. cluster_workers 0 starts a worker per cpu, shard_count 0 asks discord how many shards the bot needs
+def main(cfg):
+    cfg = dict(cfg)
+    workers = cfg.pop('cluster_workers', 0) or os.cpu_count()
+    max_restarts = cfg.pop('cluster_max_restarts', 5)
+    restart_window = cfg.pop('cluster_restart_window', 300)
+    shard_count = cfg.pop('shard_count', 0) or recommended_shards(cfg['token'])
+    #Every worker needs at least one shard
+    shard_count = max(shard_count, workers)
+    Supervisor(cfg, workers, shard_count, max_restarts, restart_window).run()
+
+if __name__ == "__main__":
+    main(json.loads(open('./cfg.json', 'r').read()))
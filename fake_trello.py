@@ -0,0 +1,240 @@
+from aiohttp import web
+import aiohttp
+import asyncio
+import base64
+import datetime
+import hashlib
+import hmac
+import itertools
+import json
+import sys
+
+#Local stand in of the parts of the trello api the bot uses: board cards and actions, cards and webhooks.
+#Changes made through the methods or the /fake routes are recorded as actions and posted to the registered webhooks like trello does.
+#Run it with python fake_trello.py [port] [board ...] and set "trello_base_url": "http://127.0.0.1:<port>/1" in cfg.json
+class FakeTrello():
+    def __init__(self, host:str = '127.0.0.1', port:int = 8765, api_secret:str|None = None) -> None:
+        self.host = host
+        self.port = port
+        self.api_secret = api_secret
+        self.ids = itertools.count(int(datetime.datetime.now().timestamp()) << 64)
+        #Board id -> {'id', 'shortLink', 'cards': {card id: card}, 'actions': [newest first]}
+        self.boards = {}
+        self.cards = {}
+        self.webhooks = {}
+        #(method, path) of every api request
+        self.requests = []
+        self.runner = None
+        self.session = None
+
+    #Ids grow like trello ones so cards and actions can be paged with before
+    def new_id(self):
+        return '%024x' % next(self.ids)
+
+    def get_url(self):
+        return f'http://{self.host}:{self.port}/1'
+
+    def add_board(self, short_link:str|None = None):
+        board = {'id': self.new_id(), 'cards': {}, 'actions': []}
+        board['shortLink'] = short_link if short_link is not None else board['id'][-8:]
+        self.boards[board['id']] = board
+        return board
+
+    def get_board(self, board_id):
+        for board in self.boards.values():
+            if board_id in (board['id'], board['shortLink']):
+                return board
+        return None
+
+    async def create_card(self, board_id, name, desc = ''):
+        board = self.get_board(board_id)
+        card = {'id': self.new_id(), 'name': name, 'desc': desc, 'dueComplete': False, 'closed': False, 'idBoard': board['id']}
+        board['cards'][card['id']] = card
+        self.cards[card['id']] = card
+        await self._add_action(board, 'createCard', {'id': card['id'], 'name': name})
+        return card
+
+    async def update_card(self, card_id, **fields):
+        card = self.cards[card_id]
+        old = {k: card[k] for k in fields.keys()}
+        card.update(fields)
+        await self._add_action(self.boards[card['idBoard']], 'updateCard', {'id': card_id, 'name': card['name']} | fields, old=old)
+        return card
+
+    async def delete_card(self, card_id):
+        card = self.cards.pop(card_id)
+        board = self.boards[card['idBoard']]
+        board['cards'].pop(card_id)
+        await self._add_action(board, 'deleteCard', {'id': card_id})
+
+    async def _add_action(self, board, action_type, card, **data):
+        action = {
+            'id': self.new_id(),
+            'type': action_type,
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'data': {'card': card, 'board': {'id': board['id'], 'shortLink': board['shortLink']}} | data
+        }
+        board['actions'].insert(0, action)
+        for webhook in [i for i in self.webhooks.values() if i['idModel'] == board['id']]:
+            await self._post_action(webhook, board, action)
+
+    async def _post_action(self, webhook, board, action):
+        body = json.dumps({'action': action, 'model': {'id': board['id'], 'shortLink': board['shortLink']}}).encode()
+        headers = {'Content-Type': 'application/json'}
+        if self.api_secret:
+            digest = hmac.new(self.api_secret.encode(), body + webhook['callbackURL'].encode(), hashlib.sha1).digest()
+            headers['X-Trello-Webhook'] = base64.b64encode(digest).decode()
+        try:
+            async with self.session.post(webhook['callbackURL'], data=body, headers=headers) as response:
+                await response.read()
+        except aiohttp.ClientError as e:
+            print(e)
+
+    def _fields(self, item, request):
+        fields = request.query.get('fields', None)
+        if fields is None:
+            return item
+        fields = fields.split(',')
+        return {k: v for k, v in item.items() if k == 'id' or k in fields}
+
+    #Newest first, limit items before the id in before
+    def _page(self, items, request):
+        if 'before' in request.query:
+            items = [i for i in items if i['id'] < request.query['before']]
+        return items[:int(request.query.get('limit', 1000))]
+
+    @web.middleware
+    async def record(self, request, handler):
+        if request.path.startswith('/1/'):
+            self.requests.append((request.method, request.path))
+        return await handler(request)
+
+    async def board_handler(self, request):
+        board = self.get_board(request.match_info['board'])
+        if board is None:
+            return web.Response(status=404)
+        return web.json_response(self._fields({'id': board['id'], 'shortLink': board['shortLink']}, request))
+
+    async def cards_handler(self, request):
+        board = self.get_board(request.match_info['board'])
+        if board is None:
+            return web.Response(status=404)
+        cards = sorted([i for i in board['cards'].values() if not i['closed']], key=lambda i: i['id'], reverse=True)
+        return web.json_response([self._fields(i, request) for i in self._page(cards, request)])
+
+    async def actions_handler(self, request):
+        board = self.get_board(request.match_info['board'])
+        if board is None:
+            return web.Response(status=404)
+        actions = board['actions']
+        if 'since' in request.query:
+            since = datetime.datetime.fromisoformat(request.query['since'])
+            actions = [i for i in actions if datetime.datetime.fromisoformat(i['date']) > since]
+        if 'filter' in request.query:
+            types = request.query['filter'].split(',')
+            actions = [i for i in actions if i['type'] in types]
+        return web.json_response([self._fields(i, request) for i in self._page(actions, request)])
+
+    async def card_handler(self, request):
+        card = self.cards.get(request.match_info['card'], None)
+        if card is None:
+            return web.Response(status=404)
+        return web.json_response(self._fields(card, request))
+
+    async def card_update_handler(self, request):
+        if request.match_info['card'] not in self.cards:
+            return web.Response(status=404)
+        fields = {}
+        for k, v in request.query.items():
+            if k in ('name', 'desc'):
+                fields[k] = v
+            elif k in ('dueComplete', 'closed'):
+                fields[k] = v == 'true'
+        return web.json_response(await self.update_card(request.match_info['card'], **fields))
+
+    async def webhooks_handler(self, request):
+        return web.json_response(list(self.webhooks.values()))
+
+    #Like trello, the callback url has to answer a HEAD request before the webhook is created
+    async def webhook_create_handler(self, request):
+        board = self.get_board(request.query.get('idModel', ''))
+        if board is None:
+            return web.Response(status=400, text='invalid idModel')
+        try:
+            async with self.session.head(request.query['callbackURL']) as response:
+                if response.status != 200:
+                    return web.Response(status=400, text='callback url did not answer 200')
+        except aiohttp.ClientError:
+            return web.Response(status=400, text='callback url unreachable')
+        webhook = {'id': self.new_id(), 'idModel': board['id'], 'callbackURL': request.query['callbackURL'], 'description': request.query.get('description', ''), 'active': True}
+        self.webhooks[webhook['id']] = webhook
+        return web.json_response(webhook)
+
+    async def webhook_delete_handler(self, request):
+        if self.webhooks.pop(request.match_info['webhook'], None) is None:
+            return web.Response(status=404)
+        return web.json_response({})
+
+    #/fake routes change the boards as a trello user would. Bodies are json: {"name": ..., "desc": ..., "dueComplete": ...}
+    async def fake_create_handler(self, request):
+        if self.get_board(request.match_info['board']) is None:
+            return web.Response(status=404)
+        data = await request.json()
+        return web.json_response(await self.create_card(request.match_info['board'], data.get('name', ''), data.get('desc', '')))
+
+    async def fake_update_handler(self, request):
+        if request.match_info['card'] not in self.cards:
+            return web.Response(status=404)
+        return web.json_response(await self.update_card(request.match_info['card'], **(await request.json())))
+
+    async def fake_delete_handler(self, request):
+        if request.match_info['card'] not in self.cards:
+            return web.Response(status=404)
+        await self.delete_card(request.match_info['card'])
+        return web.json_response({})
+
+    def create_app(self):
+        app = web.Application(middlewares=[self.record])
+        app.router.add_get('/1/boards/{board}', self.board_handler)
+        app.router.add_get('/1/boards/{board}/cards', self.cards_handler)
+        app.router.add_get('/1/boards/{board}/actions', self.actions_handler)
+        app.router.add_get('/1/cards/{card}', self.card_handler)
+        app.router.add_put('/1/cards/{card}', self.card_update_handler)
+        app.router.add_get('/1/tokens/{token}/webhooks', self.webhooks_handler)
+        app.router.add_post('/1/webhooks', self.webhook_create_handler)
+        app.router.add_delete('/1/webhooks/{webhook}', self.webhook_delete_handler)
+        app.router.add_post('/fake/boards/{board}/cards', self.fake_create_handler)
+        app.router.add_put('/fake/cards/{card}', self.fake_update_handler)
+        app.router.add_delete('/fake/cards/{card}', self.fake_delete_handler)
+        return app
+
+    async def start(self):
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        self.runner = web.AppRunner(self.create_app(), access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+        if self.session is not None:
+            await self.session.close()
+
+async def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    fake = FakeTrello(port=port)
+    for short_link in (sys.argv[2:] or ['fakeboard']):
+        fake.add_board(short_link)
+    await fake.start()
+    print(f'fake trello on {fake.get_url()}, boards: {", ".join(i["shortLink"] for i in fake.boards.values())}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await fake.stop()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,581 @@
+from aiohttp import web
+import argparse
+import asyncio
+import collections
+import datetime
+import itertools
+import json
+import os
+import random
+import tempfile
+import time
+import discord
+import benchmark
+import bot
+import fake_trello
+
+#Replays a burst of command and interaction traffic against the whole bot. bot.Bot runs as usual, but discord.py talks to a local fake of
+#the discord api (FakeDiscord) and receives its gateway events from FakeGateway, and the trello boards are fake_trello.py.
+#Every operation is what a user does from the command to the last answer of the bot:
+#  task: !task, the create button, the modal submitted
+#  edit: !task, the edit button, a task chosen in the select menu, the modal submitted with a new title
+#  assign / set_done: !assign or !set_done, a task chosen in the select menu
+#  list_tasks: !list_tasks
+#  sync_local / sync_trello: the command on a guild linked to a trello board
+#It reports the throughput, latency percentiles of each operation, the lag of the event loop and the api requests made per operation.
+#python load_replay.py [--guilds 20] [--operations 1000] [--rate 100] [--mix task=3,edit=1,assign=2,set_done=2,list_tasks=3,sync_local=0.2]
+#                      [--trace trace.jsonl] [--save-trace trace.jsonl] [--config cfg.json] [--output report.json]
+#A trace is a json line per operation: {"at": seconds, "op": "assign", "guild": 0, "channel": 1, "user": 3, "pick": [0, 2], "title": "..."}
+
+def snowflake(i):
+    return str((1 << 40) + i)
+
+def percentiles(values):
+    if len(values) == 0:
+        return {'count': 0}
+    values = sorted(values)
+    rank = lambda p: values[min(len(values)-1, int(p*len(values)))]
+    return {'count': len(values), 'p50': rank(0.5), 'p90': rank(0.9), 'p99': rank(0.99), 'max': values[-1], 'mean': sum(values)/len(values)}
+
+#Local stand in of the discord api routes the bot uses. Messages are answered with what was sent, every request is counted by route
+#and can be waited for with expect()
+class FakeDiscord():
+    def __init__(self, user, application_id, host='127.0.0.1', port=8766) -> None:
+        self.user = user
+        self.application_id = application_id
+        self.host = host
+        self.port = port
+        self.ids = itertools.count(1 << 50)
+        self.messages = {}
+        #Interaction id -> message it answered with
+        self.responses = {}
+        self.counters = collections.Counter()
+        #[predicate, future] in the order they were made
+        self.waiters = []
+        self.runner = None
+
+    def new_id(self):
+        return str(next(self.ids))
+
+    def get_url(self):
+        return f'http://{self.host}:{self.port}/api/v10'
+
+    #Future with the first request, after now, for which predicate(request) is True. request is {'route', 'match', 'body', 'response'}
+    def expect(self, predicate):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append([predicate, future])
+        return future
+
+    def _notify(self, request):
+        for waiter in self.waiters:
+            predicate, future = waiter
+            if not future.done() and predicate(request):
+                future.set_result(request)
+                self.waiters.remove(waiter)
+                return
+
+    def message(self, channel_id, body, message_id=None):
+        message = {
+            'id': message_id or self.new_id(), 'channel_id': channel_id, 'author': self.user, 'content': body.get('content') or '',
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(), 'edited_timestamp': None, 'tts': False, 'mention_everyone': False,
+            'mentions': [], 'mention_roles': [], 'attachments': [], 'embeds': body.get('embeds') or [], 'components': body.get('components') or [],
+            'pinned': False, 'type': 0, 'flags': body.get('flags') or 0
+        }
+        self.messages[message['id']] = message
+        return message
+
+    @web.middleware
+    async def record(self, request, handler):
+        body = await request.json() if request.can_read_body else None
+        route = f'{request.method} {request.match_info.route.resource.canonical if request.match_info.route.resource is not None else request.path}'
+        self.counters[route] += 1
+        response = await handler(request, body)
+        self._notify({'route': route, 'match': dict(request.match_info), 'body': body, 'response': response})
+        if response is None:
+            return web.Response(status=204)
+        #discord.py only decodes the body when the content type is exactly application/json, like discord sends it
+        return web.Response(body=json.dumps(response).encode(), headers={'Content-Type': 'application/json'})
+
+    async def me_handler(self, request, body):
+        return self.user
+
+    async def application_handler(self, request, body):
+        return {'id': self.application_id, 'name': 'tasks', 'description': '', 'icon': None, 'bot_public': True, 'bot_require_code_grant': False, 'verify_key': '0'*64, 'owner': self.user, 'flags': 0}
+
+    async def commands_handler(self, request, body):
+        return [i | {'id': self.new_id(), 'application_id': self.application_id, 'version': '1'} for i in body or []]
+
+    async def send_handler(self, request, body):
+        return self.message(request.match_info['channel'], body)
+
+    async def edit_handler(self, request, body):
+        message = self.messages.get(request.match_info['message'], None)
+        if message is None:
+            raise web.HTTPNotFound()
+        return self.message(message['channel_id'], {k: v for k, v in message.items() if k in ('content', 'embeds', 'components')} | body, message['id'])
+
+    async def delete_handler(self, request, body):
+        if self.messages.pop(request.match_info['message'], None) is None:
+            raise web.HTTPNotFound()
+        return None
+
+    #Messages sent as the response of an interaction are kept as its original response
+    async def callback_handler(self, request, body):
+        interaction = {'id': request.match_info['interaction'], 'type': 2}
+        data = body.get('data') or {}
+        if body['type'] in (4, 7):
+            message = self.message(data.get('channel_id', '0'), data)
+            self.responses[request.match_info['token']] = message
+            return {'interaction': interaction | {'response_message_id': message['id']}, 'resource': {'type': body['type'], 'message': message}}
+        return {'interaction': interaction, 'resource': {'type': body['type']}}
+
+    async def original_handler(self, request, body):
+        message = self.responses.get(request.match_info['token'], None)
+        if message is None:
+            raise web.HTTPNotFound()
+        if request.method == 'PATCH':
+            message = self.message(message['channel_id'], message | body, message['id'])
+        return message
+
+    async def other_handler(self, request, body):
+        return {}
+
+    def create_app(self):
+        app = web.Application(middlewares=[self.record])
+        app.router.add_get('/api/v10/users/@me', self.me_handler)
+        app.router.add_get('/api/v10/oauth2/applications/@me', self.application_handler)
+        app.router.add_put('/api/v10/applications/{application}/commands', self.commands_handler)
+        app.router.add_post('/api/v10/channels/{channel}/messages', self.send_handler)
+        app.router.add_patch('/api/v10/channels/{channel}/messages/{message}', self.edit_handler)
+        app.router.add_delete('/api/v10/channels/{channel}/messages/{message}', self.delete_handler)
+        app.router.add_post('/api/v10/interactions/{interaction}/{token}/callback', self.callback_handler)
+        app.router.add_route('GET', '/api/v10/webhooks/{application}/{token}/messages/@original', self.original_handler)
+        app.router.add_route('PATCH', '/api/v10/webhooks/{application}/{token}/messages/@original', self.original_handler)
+        app.router.add_route('*', '/api/v10/{tail:.*}', self.other_handler)
+        return app
+
+    async def start(self):
+        self.runner = web.AppRunner(self.create_app(), access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+#Gives the client the events the discord gateway would send: READY, a GUILD_CREATE per guild, then the messages and interactions of the trace.
+#Guild i has the channels general-0...general-n, the notification channel and the users 0...n, every member is sent so no chunking is needed
+class FakeGateway():
+    def __init__(self, client, user, application_id, notification_channel_name, guilds, channels, users) -> None:
+        self.client = client
+        self.user = user
+        self.application_id = application_id
+        self.notification_channel_name = notification_channel_name
+        self.guilds = guilds
+        self.channels = channels
+        self.users = users
+        self.ids = itertools.count(1 << 51)
+
+    def new_id(self):
+        return str(next(self.ids))
+
+    def guild_id(self, guild):
+        return snowflake(1000 + guild)
+
+    def channel_id(self, guild, channel):
+        return snowflake(100000 + guild*100 + channel)
+
+    def user_payload(self, user):
+        return {'id': snowflake(10000000 + user), 'username': f'user{user}', 'global_name': f'User {user}', 'discriminator': '0', 'avatar': None}
+
+    def member_payload(self, user):
+        return {'roles': [], 'joined_at': '2024-01-01T00:00:00+00:00', 'deaf': False, 'mute': False, 'flags': 0}
+
+    def guild_payload(self, guild):
+        guild_id = self.guild_id(guild)
+        channels = [{'id': self.channel_id(guild, i), 'type': 0, 'name': f'general-{i}', 'position': i, 'permission_overwrites': []} for i in range(self.channels)]
+        channels.append({'id': self.channel_id(guild, 99), 'type': 0, 'name': self.notification_channel_name, 'position': self.channels, 'permission_overwrites': []})
+        members = [self.member_payload(i) | {'user': self.user_payload(i)} for i in range(self.users)] + [self.member_payload(None) | {'user': self.user}]
+        return {
+            'id': guild_id, 'name': f'guild {guild}', 'owner_id': self.user_payload(0)['id'], 'member_count': len(members), 'large': False, 'unavailable': False,
+            'roles': [{'id': guild_id, 'name': '@everyone', 'permissions': '8', 'position': 0, 'color': 0, 'hoist': False, 'managed': False, 'mentionable': False}],
+            'channels': channels, 'members': members, 'presences': [], 'voice_states': [], 'emojis': [], 'stickers': [], 'threads': [], 'features': []
+        }
+
+    def dispatch(self, event, data):
+        self.client._connection.parsers[event](data)
+
+    async def connect(self):
+        #Every GUILD_CREATE is sent at once, there is no need to wait for more
+        self.client._connection.guild_ready_timeout = 0
+        self.dispatch('READY', {'v': 10, 'user': self.user, 'guilds': [{'id': self.guild_id(i), 'unavailable': True} for i in range(self.guilds)], 'session_id': 'replay', 'resume_gateway_url': 'ws://127.0.0.1', 'application': {'id': self.application_id, 'flags': 0}})
+        for i in range(self.guilds):
+            self.dispatch('GUILD_CREATE', self.guild_payload(i))
+        await self.client.wait_until_ready()
+
+    #discord.py only dispatches the components of a message or modal once it has read the response that created them,
+    #like a user only sees them then. Waits until the view of message_id or the modal custom_id is there
+    async def wait_for_view(self, message_id=None, modal=None):
+        store = self.client._connection._view_store
+        while (message_id is not None and int(message_id) not in store._views) or (modal is not None and modal not in store._modals):
+            await asyncio.sleep(0.001)
+
+    #Returns the id of the message
+    def message(self, guild, channel, user, content):
+        data = {
+            'id': self.new_id(), 'channel_id': self.channel_id(guild, channel), 'guild_id': self.guild_id(guild), 'author': self.user_payload(user),
+            'member': self.member_payload(user), 'content': content, 'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(), 'edited_timestamp': None,
+            'tts': False, 'mention_everyone': False, 'mentions': [], 'mention_roles': [], 'attachments': [], 'embeds': [], 'pinned': False, 'type': 0
+        }
+        self.dispatch('MESSAGE_CREATE', data)
+        return data['id']
+
+    #Payload of an interaction, type 3 for a button or select of message, type 5 for a modal submit
+    def interaction(self, guild, channel, user, interaction_type, data, message=None):
+        payload = {
+            'id': self.new_id(), 'application_id': self.application_id, 'type': interaction_type, 'token': f'token{self.new_id()}', 'version': 1,
+            'guild_id': self.guild_id(guild), 'channel_id': self.channel_id(guild, channel), 'channel': {'id': self.channel_id(guild, channel), 'type': 0, 'guild_id': self.guild_id(guild), 'name': f'general-{channel}', 'position': channel, 'permission_overwrites': []},
+            'member': self.member_payload(user) | {'user': self.user_payload(user), 'permissions': '8'}, 'data': data, 'app_permissions': '8',
+            'locale': 'en-US', 'guild_locale': 'en-US', 'entitlements': [], 'authorizing_integration_owners': {}, 'context': 0, 'attachment_size_limit': 8388608
+        }
+        if message is not None:
+            payload['message'] = message | {'guild_id': self.guild_id(guild)}
+        return payload
+
+#Components of a message or modal payload, the ones in action rows or labels included
+def components(payload):
+    for component in payload.get('components', []) or []:
+        yield component
+        yield from components(component)
+        if 'component' in component:
+            yield component['component']
+
+class LoadReplay():
+    OPERATIONS = ('task', 'edit', 'assign', 'set_done', 'list_tasks', 'sync_local', 'sync_trello')
+
+    def __init__(self, args) -> None:
+        self.args = args
+        self.user = {'id': snowflake(1), 'username': 'tasks', 'discriminator': '0', 'avatar': None, 'bot': True}
+        self.application_id = snowflake(2)
+        self.discord = FakeDiscord(self.user, self.application_id, port=args.discord_port)
+        self.trello = fake_trello.FakeTrello(port=args.trello_port)
+        self.bot = None
+        self.gateway = None
+        self.latencies = collections.defaultdict(list)
+        self.failures = collections.Counter()
+        self.lag = []
+        #Message id of a prefix command -> future of its command_completion
+        self.commands = {}
+        self.cfg = json.loads(open(args.config, 'r').read()) if args.config is not None else {}
+
+    def create_bot(self):
+        cfg = {
+            'prefix': '!', 'token': 'replay', 'notification_channel_name': 'notifications', 'trello_api_key': 'key', 'trello_token': 'token',
+            'trello_base_url': self.trello.get_url(), 'sync_slash_commands': False
+        }
+        cfg |= self.cfg
+        cfg['trello_base_url'] = self.trello.get_url()
+        for key in [i for i in cfg if i.startswith('cluster_')]:
+            cfg.pop(key)
+        _bot = bot.Bot(**cfg)
+        #Guilds linked to a trello board, each with its own board of --cards cards
+        for guild in range(self.args.guilds):
+            if guild < self.args.trello_guilds:
+                board = self.trello.add_board()
+                for i in range(self.args.cards):
+                    card = {'id': self.trello.new_id(), 'name': f'card {i}', 'desc': '', 'dueComplete': False, 'closed': False, 'idBoard': board['id']}
+                    board['cards'][card['id']] = card
+                    self.trello.cards[card['id']] = card
+                _bot.guild_trello_board[snowflake(1000 + guild)] = board['shortLink']
+        return _bot
+
+    async def on_command_completion(self, context):
+        future = self.commands.pop(context.message.id, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    async def on_command_error(self, context, error):
+        future = self.commands.pop(context.message.id, None)
+        if future is not None and not future.done():
+            future.set_exception(error)
+
+    async def start(self):
+        discord.http.Route.BASE = self.discord.get_url()
+        await self.discord.start()
+        await self.trello.start()
+        self.bot = self.create_bot()
+        self.bot.bot.add_listener(self.on_command_completion)
+        self.bot.bot.add_listener(self.on_command_error)
+        await self.bot.bot.login('replay')
+        self.gateway = FakeGateway(self.bot.bot, self.user, self.application_id, self.bot.notification_channel_name, self.args.guilds, self.args.channels, self.args.users)
+        await self.gateway.connect()
+        for guild in self.bot.bot.guilds:
+            taskmanager = self.bot.get_taskmanager(guild)
+            for task in benchmark.make_tasks(self.args.tasks, guild.id):
+                taskmanager.tasks.add(task)
+            taskmanager.persist_tasks()
+
+    async def stop(self):
+        if self.bot is not None:
+            await self.bot.bot.close()
+            self.bot.close()
+        await self.trello.stop()
+        await self.discord.stop()
+
+    #The first message the bot sends in the channel for which kind(message) is True, messages of the same kind are matched in order
+    def expect_message(self, channel_id, kind):
+        return self.discord.expect(lambda i: i['route'] == 'POST /api/v10/channels/{channel}/messages' and i['match']['channel'] == channel_id and kind(i['response']))
+
+    def expect_delete(self, message_id):
+        return self.discord.expect(lambda i: i['route'] == 'DELETE /api/v10/channels/{channel}/messages/{message}' and i['match']['message'] == message_id)
+
+    def expect_callback(self, interaction_id):
+        return self.discord.expect(lambda i: i['route'] == 'POST /api/v10/interactions/{interaction}/{token}/callback' and i['match']['interaction'] == interaction_id)
+
+    async def command(self, event, content):
+        future = asyncio.get_running_loop().create_future()
+        message_id = self.gateway.message(event['guild'], event['channel'], event['user'], content)
+        self.commands[int(message_id)] = future
+        await future
+
+    async def op_task(self, event):
+        channel_id = self.gateway.channel_id(event['guild'], event['channel'])
+        sent = self.expect_message(channel_id, lambda i: any(str(j.get('custom_id', '')).startswith('task:create:') for j in components(i)))
+        self.gateway.message(event['guild'], event['channel'], event['user'], '!task')
+        message = (await sent)['response']
+        button = next(i for i in components(message) if str(i.get('custom_id', '')).startswith('task:create:'))
+        interaction = self.gateway.interaction(event['guild'], event['channel'], event['user'], 3, {'custom_id': button['custom_id'], 'component_type': 2}, message)
+        modal = self.expect_callback(interaction['id'])
+        self.gateway.dispatch('INTERACTION_CREATE', interaction)
+        modal = (await modal)['body']['data']
+        await self.gateway.wait_for_view(modal=modal['custom_id'])
+        values = {'title': event.get('title', 'replayed task'), 'description': event.get('description', ''), 'start_date': '', 'end_date': ''}
+        rows = [{'type': 1, 'components': [{'type': 4, 'custom_id': i['custom_id'], 'value': values.get(i['custom_id'], '')}]} for i in components(modal) if i.get('type') == 4]
+        interaction = self.gateway.interaction(event['guild'], event['channel'], event['user'], 5, {'custom_id': modal['custom_id'], 'components': rows})
+        submitted = self.expect_callback(interaction['id'])
+        self.gateway.dispatch('INTERACTION_CREATE', interaction)
+        await submitted
+
+    #Opens the edit menu from the task message, picks a task and renames it through the edit modal
+    async def op_edit(self, event):
+        channel_id = self.gateway.channel_id(event['guild'], event['channel'])
+        sent = self.expect_message(channel_id, lambda i: any(str(j.get('custom_id', '')).startswith('task:edit:') for j in components(i)))
+        self.gateway.message(event['guild'], event['channel'], event['user'], '!task')
+        message = (await sent)['response']
+        button = next(i for i in components(message) if str(i.get('custom_id', '')).startswith('task:edit:'))
+        sent = self.expect_message(channel_id, lambda i: any(j.get('type') == 3 and not j.get('disabled', False) for j in components(i)))
+        self.gateway.dispatch('INTERACTION_CREATE', self.gateway.interaction(event['guild'], event['channel'], event['user'], 3, {'custom_id': button['custom_id'], 'component_type': 2}, message))
+        message = (await sent)['response']
+        select = next(i for i in components(message) if i.get('type') == 3 and not i.get('disabled', False))
+        options = [i['value'] for i in select['options']]
+        task_id = options[event.get('pick', [0])[0] % len(options)]
+        await self.gateway.wait_for_view(message['id'])
+        interaction = self.gateway.interaction(event['guild'], event['channel'], event['user'], 3, {'custom_id': select['custom_id'], 'component_type': 3, 'values': [task_id]}, message)
+        modal = self.expect_callback(interaction['id'])
+        self.gateway.dispatch('INTERACTION_CREATE', interaction)
+        modal = (await modal)['body']['data']
+        await self.gateway.wait_for_view(modal=modal['custom_id'])
+        title = event.get('title', 'replayed task')
+        values = {i['custom_id']: i.get('value', '') or '' for i in components(modal) if i.get('type') == 4} | {'title': title}
+        rows = [{'type': 1, 'components': [{'type': 4, 'custom_id': k, 'value': v}]} for k, v in values.items()]
+        interaction = self.gateway.interaction(event['guild'], event['channel'], event['user'], 5, {'custom_id': modal['custom_id'], 'components': rows})
+        submitted = self.expect_callback(interaction['id'])
+        self.gateway.dispatch('INTERACTION_CREATE', interaction)
+        await submitted
+        task = self.bot.taskmanagers[int(self.gateway.guild_id(event['guild']))].get_task(task_id)
+        if task is None or task.get_title() != title:
+            raise RuntimeError(f'task {task_id} was not edited')
+
+    #Chooses the options in event['pick'] of the select menu, or cancels the menu if it has no tasks
+    async def op_select(self, event, command):
+        channel_id = self.gateway.channel_id(event['guild'], event['channel'])
+        sent = self.expect_message(channel_id, lambda i: any(j.get('type') == 3 and not j.get('disabled', False) or str(j.get('custom_id', '')).startswith('task:cancel:') for j in components(i)))
+        self.gateway.message(event['guild'], event['channel'], event['user'], command)
+        message = (await sent)['response']
+        select = next((i for i in components(message) if i.get('type') == 3 and not i.get('disabled', False)), None)
+        if select is not None:
+            options = [i['value'] for i in select['options']]
+            data = {'custom_id': select['custom_id'], 'component_type': 3, 'values': list(dict.fromkeys(options[i % len(options)] for i in event.get('pick', [0])))}
+        else:
+            data = {'custom_id': next(i['custom_id'] for i in components(message) if str(i.get('custom_id', '')).startswith('task:cancel:') or i.get('label') == 'Cancel'), 'component_type': 2}
+        await self.gateway.wait_for_view(message['id'])
+        deleted = self.expect_delete(message['id'])
+        self.gateway.dispatch('INTERACTION_CREATE', self.gateway.interaction(event['guild'], event['channel'], event['user'], 3, data, message))
+        await deleted
+
+    async def op_assign(self, event):
+        await self.op_select(event, '!assign')
+
+    async def op_set_done(self, event):
+        await self.op_select(event, '!set_done')
+
+    async def op_list_tasks(self, event):
+        channel_id = self.gateway.channel_id(event['guild'], event['channel'])
+        sent = self.expect_message(channel_id, lambda i: i['content'].startswith('`|Title'))
+        self.gateway.message(event['guild'], event['channel'], event['user'], '!list_tasks')
+        await sent
+
+    async def op_sync_local(self, event):
+        await self.command(event, '!sync_local')
+
+    async def op_sync_trello(self, event):
+        await self.command(event, '!sync_trello')
+
+    async def run_operation(self, event, start):
+        operation = getattr(self, f'op_{event["op"]}')
+        try:
+            await asyncio.wait_for(operation(event), self.args.timeout)
+        except Exception as e:
+            self.failures[f'{event["op"]}: {type(e).__name__}'] += 1
+            return
+        #Counted from the time the trace says the operation starts, so operations that wait for the loop count that wait too
+        self.latencies[event['op']].append(time.perf_counter() - start)
+
+    async def measure_lag(self, interval=0.01):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.lag.append(loop.time() - expected)
+
+    #Each kind of operation once, alone, to count the api requests it makes
+    async def calibrate(self, operations):
+        calls = {}
+        for index, operation in enumerate(operations):
+            guild = 0 if operation not in ('sync_local', 'sync_trello') or self.args.trello_guilds > 0 else None
+            if guild is None:
+                continue
+            discord_before, trello_before = self.discord.counters.copy(), len(self.trello.requests)
+            await self.run_operation({'op': operation, 'guild': guild, 'channel': 0, 'user': index % self.args.users, 'pick': [0], 'title': f'calibration {operation}'}, time.perf_counter())
+            await self.bot.outbox.join()
+            await asyncio.sleep(0.1)
+            discord_calls = self.discord.counters - discord_before
+            calls[operation] = {'discord': dict(discord_calls), 'discord_total': sum(discord_calls.values()), 'trello_total': len(self.trello.requests) - trello_before}
+        self.latencies.clear()
+        self.failures.clear()
+        return calls
+
+    async def replay(self, trace):
+        calibration = await self.calibrate(sorted(set(i['op'] for i in trace), key=self.OPERATIONS.index))
+        discord_before, trello_before = self.discord.counters.copy(), len(self.trello.requests)
+        lag = asyncio.get_running_loop().create_task(self.measure_lag())
+        started = time.perf_counter()
+        running = []
+        for event in trace:
+            delay = started + event['at']/self.args.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            running.append(asyncio.get_running_loop().create_task(self.run_operation(event, started + event['at']/self.args.speed)))
+        await asyncio.gather(*running)
+        duration = time.perf_counter() - started
+        lag.cancel()
+        await self.bot.outbox.join()
+        discord_calls = self.discord.counters - discord_before
+        completed = sum(len(i) for i in self.latencies.values())
+        return {
+            'operations': len(trace),
+            'completed': completed,
+            'failed': sum(self.failures.values()),
+            'failures': dict(self.failures),
+            'duration': duration,
+            'throughput': completed/duration,
+            'latency': {'all': percentiles([j for i in self.latencies.values() for j in i])} | {k: percentiles(self.latencies[k]) for k in self.OPERATIONS if k in self.latencies},
+            'loop_lag': percentiles(self.lag),
+            'api_calls': {
+                'discord': dict(discord_calls),
+                'discord_per_operation': sum(discord_calls.values())/max(completed, 1),
+                'trello_per_operation': (len(self.trello.requests) - trello_before)/max(completed, 1),
+                'calibration': calibration
+            },
+            'outbox': self.bot.outbox.get_counters(),
+            'trello_scheduler': self.bot.trello_session.scheduler.get_counters()
+        }
+
+#Operations arriving at rate per second (poisson), spread over guilds, channels and users. sync operations only go to guilds with a board
+def synthetic_trace(args):
+    rng = random.Random(args.seed)
+    mix = {k: float(v) for k, v in (i.split('=') for i in args.mix.split(','))}
+    if args.trello_guilds == 0:
+        mix = {k: v for k, v in mix.items() if k not in ('sync_local', 'sync_trello')}
+    operations, weights = list(mix.keys()), list(mix.values())
+    trace = []
+    at = 0
+    for _ in range(args.operations):
+        at += rng.expovariate(args.rate)
+        operation = rng.choices(operations, weights)[0]
+        guild = rng.randrange(args.trello_guilds) if operation in ('sync_local', 'sync_trello') else rng.randrange(args.guilds)
+        trace.append({'at': round(at, 6), 'op': operation, 'guild': guild, 'channel': rng.randrange(args.channels), 'user': rng.randrange(args.users), 'pick': rng.sample(range(25), rng.randint(1, 3)), 'title': f'task {rng.randrange(10**6)}'})
+    return trace
+
+def print_report(report):
+    print(f'{report["completed"]}/{report["operations"]} operations in {report["duration"]:.2f}s, {report["throughput"]:.1f} operations/s')
+    for name, failures in report['failures'].items():
+        print(f'  failed {name}: {failures}')
+    print(f'{"latency":12} {"count":>6} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} {"max ms":>9}   discord/trello calls alone')
+    for name, latency in report['latency'].items():
+        if latency['count'] == 0:
+            continue
+        calls = report['api_calls']['calibration'].get(name, None)
+        calls = f'{calls["discord_total"]}/{calls["trello_total"]}' if calls is not None else ''
+        print(f'{name:12} {latency["count"]:6} {latency["p50"]*1000:9.1f} {latency["p90"]*1000:9.1f} {latency["p99"]*1000:9.1f} {latency["max"]*1000:9.1f}   {calls}')
+    lag = report['loop_lag']
+    if lag['count'] > 0:
+        print(f'event loop lag: p50 {lag["p50"]*1000:.1f}ms p99 {lag["p99"]*1000:.1f}ms max {lag["max"]*1000:.1f}ms')
+    print(f'{report["api_calls"]["discord_per_operation"]:.2f} discord and {report["api_calls"]["trello_per_operation"]:.2f} trello requests per operation')
+    for route, count in sorted(report['api_calls']['discord'].items(), key=lambda i: -i[1]):
+        print(f'  {count:7} {route}')
+
+async def run(args, trace):
+    replay = LoadReplay(args)
+    cwd = os.getcwd()
+    #The bot writes its files in the working directory
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            await replay.start()
+            report = await replay.replay(trace)
+        finally:
+            await replay.stop()
+            os.chdir(cwd)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--guilds', type=int, default=20)
+    parser.add_argument('--channels', type=int, default=2)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--tasks', type=int, default=100, help='tasks of every guild before the replay')
+    parser.add_argument('--trello-guilds', type=int, default=2, help='the first guilds are linked to a fake trello board')
+    parser.add_argument('--cards', type=int, default=200)
+    parser.add_argument('--operations', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=100, help='operations per second of the synthetic trace')
+    parser.add_argument('--mix', default='task=3,edit=1,assign=2,set_done=2,list_tasks=3,sync_local=0.2,sync_trello=0.1')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trace', help='replays a trace instead of a synthetic one')
+    parser.add_argument('--save-trace')
+    parser.add_argument('--speed', type=float, default=1, help='the trace is replayed this many times faster')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds an operation can take before it counts as failed')
+    parser.add_argument('--config', help='bot configuration, like cfg.json')
+    parser.add_argument('--discord-port', type=int, default=8766)
+    parser.add_argument('--trello-port', type=int, default=8767)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+    if args.trace is not None:
+        trace = [json.loads(i) for i in open(args.trace, 'r') if i.strip() != '']
+        args.guilds = max([args.guilds] + [i['guild']+1 for i in trace])
+        args.channels = max([args.channels] + [i['channel']+1 for i in trace])
+        args.users = max([args.users] + [i['user']+1 for i in trace])
+    else:
+        trace = synthetic_trace(args)
+    if args.save_trace is not None:
+        with open(args.save_trace, 'w') as file:
+            file.writelines(json.dumps(i) + '\n' for i in trace)
+    report = asyncio.run(run(args, trace))
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=1)
+    print_report(report)
+
+if __name__ == "__main__":
+    main()
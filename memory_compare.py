@@ -0,0 +1,87 @@
+import argparse
+import asyncio
+import gc
+import json
+import tracemalloc
+import discord
+import bot
+import tasks
+
+#Compares the memory discord.py keeps for a synthetic large guild with the default options and with low_memory.
+#The guild arrives as a GUILD_CREATE with every member and presence, like after the member chunking of the default options,
+#then --messages messages are received. In low memory mode --member-cache-size names are resolved into the MemberResolver.
+#python memory_compare.py [--members 50000] [--roles 200] [--channels 500] [--messages 1000] [--json]
+
+def snowflake(i):
+    return str((1 << 40) + i)
+
+def user(i):
+    return {'id': snowflake(1000000 + i), 'username': f'user{i}', 'global_name': f'User {i}', 'discriminator': '0', 'avatar': 'a' * 32}
+
+def guild_payload(members, roles, channels):
+    return {
+        'id': snowflake(1),
+        'name': 'synthetic guild',
+        'owner_id': snowflake(1000000),
+        'member_count': members,
+        'large': True,
+        'unavailable': False,
+        'roles': [{'id': snowflake(1) if i == 0 else snowflake(100 + i), 'name': '@everyone' if i == 0 else f'role {i}', 'permissions': '0', 'position': i, 'color': 0, 'hoist': False, 'managed': False, 'mentionable': True} for i in range(roles)],
+        'channels': [{'id': snowflake(10000 + i), 'type': 0, 'name': f'channel-{i}', 'position': i, 'permission_overwrites': []} for i in range(channels)],
+        'members': [{'user': user(i), 'nick': f'nick {i}' if i % 3 == 0 else None, 'roles': [snowflake(100 + 1 + i % (roles-1))], 'joined_at': '2024-01-01T00:00:00+00:00', 'deaf': False, 'mute': False, 'flags': 0} for i in range(members)],
+        'presences': [{'user': {'id': snowflake(1000000 + i)}, 'status': 'online', 'client_status': {'desktop': 'online'}, 'activities': [{'name': 'a game', 'type': 0}]} for i in range(members)],
+        'voice_states': [],
+        'emojis': [],
+        'stickers': [],
+        'threads': [],
+        'features': [],
+    }
+
+def message_payload(i, channels):
+    return {'id': snowflake(5000000 + i), 'channel_id': snowflake(10000 + i % channels), 'guild_id': snowflake(1), 'author': user(i), 'content': f'!list_tasks assignee:user{i}', 'timestamp': '2024-01-01T00:00:00+00:00', 'edited_timestamp': None, 'tts': False, 'mention_everyone': False, 'mentions': [], 'mention_roles': [], 'attachments': [], 'embeds': [], 'pinned': False, 'type': 0, 'member': {'roles': [], 'joined_at': '2024-01-01T00:00:00+00:00', 'deaf': False, 'mute': False, 'flags': 0}}
+
+#Bytes allocated by the client state after receiving the guild and the messages
+async def measure(low_memory, args):
+    payload = guild_payload(args.members, args.roles, args.channels)
+    messages = [message_payload(i, args.channels) for i in range(args.messages)]
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    client = discord.Client(**bot.Bot.client_options(low_memory))
+    state = client._connection
+    state.user = discord.ClientUser(state=state, data={'id': snowflake(0), 'username': 'bot', 'discriminator': '0', 'avatar': None})
+    state.parse_guild_create(payload)
+    for message in messages:
+        state.parse_message_create(message)
+    resolver = tasks.MemberResolver(args.member_cache_size, query=low_memory)
+    if low_memory:
+        for i in range(min(args.member_cache_size, args.members)):
+            resolver._put(int(payload['id']), f'user{i}', 1000000 + i)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    guild = client.get_guild(int(payload['id']))
+    result = {'bytes': used, 'cached_members': len(guild.members), 'cached_messages': len(state._messages or []), 'resolver_names': len(resolver.names)}
+    del client, state, guild, resolver
+    return result
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--members', type=int, default=50000)
+    parser.add_argument('--roles', type=int, default=200)
+    parser.add_argument('--channels', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--member-cache-size', type=int, default=1024)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+    results = {'default': await measure(False, args), 'low_memory': await measure(True, args)}
+    if args.json:
+        print(json.dumps(results))
+        return
+    print(f'{args.members} members, {args.roles} roles, {args.channels} channels, {args.messages} messages')
+    for mode, result in results.items():
+        print(f'{mode:>10}: {result["bytes"]/2**20:8.1f} MiB, {result["cached_members"]} members and {result["cached_messages"]} messages cached, {result["resolver_names"]} resolver names')
+    print(f'low_memory uses {results["low_memory"]["bytes"]/results["default"]["bytes"]:.1%} of the default')
+
+if __name__ == "__main__":
+    asyncio.run(main())
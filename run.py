@@ -1,10 +1,14 @@
 import bot
 import asyncio
+import cluster
 import json
 asyncio.new_event_loop()
 if __name__ == "__main__":
     cfg = json.loads(open('./cfg.json', 'r').read())
-    _bot = bot.Bot(**cfg)
+    if cfg.get('cluster_workers', 0) > 0:
+        cluster.main(cfg)
+        exit()
+    _bot = bot.Bot(**{k: v for k, v in cfg.items() if not k.startswith('cluster_')})
     try:
         _bot.start()
     except (Exception, KeyboardInterrupt) as e:
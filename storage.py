@@ -0,0 +1,582 @@
+import os
+import sys
+import json
+import pickle
+import sqlite3
+import asyncio
+import datetime
+import threading
+import contextlib
+import uuid
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+#Base class for task storages. Every storage persists the tasks of a single guild.
+#put and delete receive the changed task and the whole task list, so storages that can only write everything at once can still work.
+#Methods must be overwritten
+class Storage():
+    def __init__(self, guild_id) -> None:
+        self.guild_id = guild_id
+
+    # Method to load the tasks of the guild. Must return a list of tasks
+    def load(self) -> list:
+        return []
+
+    # Method to persist a created or modified task
+    def put(self, task, tasks):
+        self.batch([('put', task)], tasks)()
+
+    # Method to persist the deletion of a task
+    def delete(self, task, tasks):
+        self.batch([('delete', task)], tasks)()
+
+    # Method to persist the whole task list
+    def dump(self, tasks):
+        self.batch(None, tasks)()
+
+    # Method to persist several changes at once. changes is a list of ('put', task) or ('delete', task), None means the whole task list.
+    # Everything that reads the tasks happens here, in the event loop. It returns a function that does the blocking writes, so it can run in an executor.
+    # Must be overwritten
+    def batch(self, changes, tasks):
+        return lambda: None
+
+    # Method to release files, connections...
+    def close(self):
+        pass
+
+    # Method to wait until every change is written
+    async def drain(self):
+        pass
+
+    # Method to tell if some changes aren't written yet, like after a drain that failed
+    def is_dirty(self):
+        return False
+
+    # Method to query (task_id, title) pairs in creation order without loading the tasks, limit of them from offset on.
+    # Storages without indexes return None and the TaskManager filters the tasks it holds
+    def query(self, done:bool|None=None, assignee=None, title:str|None=None, offset:int=0, limit:int|None=None):
+        return None
+
+    #Tasks pickled before task ids existed don't have one. Returns True if any id was assigned
+    def _ensure_ids(self, tasks):
+        assigned = False
+        for task in tasks:
+            if getattr(task, 'task_id', None) is None:
+                task.task_id = uuid.uuid4().hex
+                assigned = True
+        return assigned
+
+#Whole task list pickled into <persist_dir>/<guild_id>.tasks on every change
+class PickleStorage(Storage):
+    def __init__(self, guild_id, persist_dir='tasks') -> None:
+        super().__init__(guild_id)
+        self.persist_dir = persist_dir if persist_dir[-1] != '/' else persist_dir[:len(persist_dir)-1]
+        self.snapshot_path = f'{self.persist_dir}/{self.guild_id}.tasks'
+        try:
+            os.makedirs(self.persist_dir)
+        except:
+            pass
+
+    def _load_snapshot(self):
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as file:
+                return pickle.load(file)
+        return []
+
+    def load(self):
+        tasks = self._load_snapshot()
+        if self._ensure_ids(tasks):
+            self.dump(tasks)
+        return tasks
+
+    def put(self, task, tasks):
+        self.dump(tasks)
+
+    def delete(self, task, tasks):
+        self.dump(tasks)
+
+    def batch(self, changes, tasks):
+        data = pickle.dumps(list(tasks))
+        return lambda: self._write_snapshot(data)
+
+    #The snapshot is written to a temporary file and renamed, so a crash never leaves a half written snapshot
+    def _write_snapshot(self, data):
+        temp_path = f'{self.snapshot_path}.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.snapshot_path)
+
+#Snapshot plus an append-only log in <persist_dir>/<guild_id>.journal
+#Every change appends a ('put', task_id, task) or ('delete', task_id) record to the log.
+#Once the log has compact_threshold records it is rotated to <guild_id>.journal.old and folded into a new snapshot in the executor.
+class JournalStorage(PickleStorage):
+    def __init__(self, guild_id, loop, persist_dir='tasks', compact_threshold=1000) -> None:
+        super().__init__(guild_id, persist_dir)
+        self.loop = loop
+        self.compact_threshold = compact_threshold
+        self.journal_path = f'{self.persist_dir}/{self.guild_id}.journal'
+        self.rotated_path = f'{self.journal_path}.old'
+        self.journal_file = None
+        self.records = 0
+        self.compaction = None
+        self.compaction_lock = threading.Lock()
+
+    #Reads every complete record of a log. A record cut by a crash ends the replay and is truncated away
+    @staticmethod
+    def _read_records(path, truncate=False):
+        records = []
+        if not os.path.exists(path):
+            return records
+        with open(path, 'rb') as file:
+            offset = 0
+            while True:
+                try:
+                    records.append(pickle.load(file))
+                    offset = file.tell()
+                except EOFError:
+                    break
+                except Exception as e:
+                    print(e)
+                    if truncate:
+                        with open(path, 'r+b') as log:
+                            log.truncate(offset)
+                    break
+        return records
+
+    @staticmethod
+    def _replay(tasks, records):
+        tasks = {task.task_id: task for task in tasks}
+        for record in records:
+            if record[0] == 'put':
+                tasks[record[1]] = record[2]
+            elif record[0] == 'delete':
+                tasks.pop(record[1], None)
+        return list(tasks.values())
+
+    def load(self):
+        tasks = self._load_snapshot()
+        if self._ensure_ids(tasks):
+            self._write_snapshot(pickle.dumps(tasks))
+        tasks = self._replay(tasks, self._read_records(self.rotated_path))
+        records = self._read_records(self.journal_path, truncate=True)
+        self.records = len(records)
+        return self._replay(tasks, records)
+
+    @staticmethod
+    def _record(change, task):
+        return (change, task.task_id, task) if change == 'put' else (change, task.task_id)
+
+    def _append(self, data, count):
+        if self.journal_file is None:
+            self.journal_file = open(self.journal_path, 'ab')
+        self.journal_file.write(data)
+        self.journal_file.flush()
+        self.records += count
+
+    def put(self, task, tasks):
+        self._append(pickle.dumps(self._record('put', task)), 1)
+        if self.records >= self.compact_threshold:
+            self.compact()
+
+    def delete(self, task, tasks):
+        self._append(pickle.dumps(self._record('delete', task)), 1)
+        if self.records >= self.compact_threshold:
+            self.compact()
+
+    def batch(self, changes, tasks):
+        if changes is None:
+            data = pickle.dumps(list(tasks))
+            return lambda: self._write_dump(data)
+        data = b''.join(pickle.dumps(self._record(change, task)) for change, task in changes)
+        def write():
+            self._append(data, len(changes))
+            #Already outside the event loop, so the log is folded right away
+            if self.records >= self.compact_threshold:
+                self._rotate()
+                self._compact()
+        return write
+
+    #Full rewrite: the log is no longer needed once the snapshot has been replaced
+    def _write_dump(self, data):
+        self._wait_compaction()
+        self._close_journal()
+        self._write_snapshot(data)
+        for path in (self.rotated_path, self.journal_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.records = 0
+
+    #Method to fold the log into the snapshot without blocking the event loop
+    def compact(self):
+        if self.compaction is not None and not self.compaction.done():
+            return
+        if not os.path.exists(self.journal_path):
+            return
+        self._rotate()
+        self.compaction = self.loop.run_in_executor(None, self._compact)
+
+    def _rotate(self):
+        #A previous compaction didn't finish (crash), fold it before rotating again
+        self._compact()
+        self._close_journal()
+        os.replace(self.journal_path, self.rotated_path)
+        self.records = 0
+
+    def _compact(self):
+        with self.compaction_lock:
+            if not os.path.exists(self.rotated_path):
+                return
+            tasks = self._replay(self._load_snapshot(), self._read_records(self.rotated_path))
+            self._write_snapshot(pickle.dumps(tasks))
+            os.remove(self.rotated_path)
+
+    #Blocks until a running compaction ends
+    def _wait_compaction(self):
+        self._compact()
+        self.compaction = None
+
+    def _close_journal(self):
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.journal_file = None
+
+    def close(self):
+        self._close_journal()
+
+#SQLite database shared by every guild. Tasks, assignees and notifications have their own tables
+class TaskDatabase():
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS tasks (
+        task_id TEXT PRIMARY KEY,
+        guild_id INTEGER NOT NULL,
+        title TEXT,
+        description TEXT,
+        done INTEGER NOT NULL DEFAULT 0,
+        start_date TEXT,
+        end_date TEXT,
+        trello_id TEXT,
+        dirty_fields TEXT
+    );
+    CREATE INDEX IF NOT EXISTS tasks_guild ON tasks(guild_id);
+    CREATE INDEX IF NOT EXISTS tasks_guild_done ON tasks(guild_id, done);
+    CREATE INDEX IF NOT EXISTS tasks_guild_end_date ON tasks(guild_id, end_date);
+    CREATE TABLE IF NOT EXISTS assignees (
+        task_id TEXT NOT NULL REFERENCES tasks(task_id) ON DELETE CASCADE,
+        guild_id INTEGER NOT NULL,
+        assignee TEXT NOT NULL,
+        PRIMARY KEY (task_id, assignee)
+    );
+    CREATE INDEX IF NOT EXISTS assignees_guild_assignee ON assignees(guild_id, assignee);
+    CREATE TABLE IF NOT EXISTS notifications (
+        task_id TEXT PRIMARY KEY REFERENCES tasks(task_id) ON DELETE CASCADE,
+        guild_id INTEGER NOT NULL,
+        rate INTEGER NOT NULL,
+        measure INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS notifications_guild ON notifications(guild_id);
+    '''
+
+    def __init__(self, path='tasks/tasks.db') -> None:
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory != '':
+            os.makedirs(directory, exist_ok=True)
+        #The connection is shared with the write behind executor, every use must hold the lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.executescript(self.SCHEMA)
+        #Databases created before dirty_fields existed
+        columns = [i[1] for i in self.connection.execute('PRAGMA table_info(tasks)')]
+        if 'dirty_fields' not in columns:
+            self.connection.execute('ALTER TABLE tasks ADD COLUMN dirty_fields TEXT')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+#Tasks stored as rows of a TaskDatabase. Only the changed task is written on every change
+class SQLiteStorage(Storage):
+    def __init__(self, guild_id, database:TaskDatabase) -> None:
+        super().__init__(guild_id)
+        self.database = database
+
+    @staticmethod
+    def _date_to_sql(date):
+        if date is None:
+            return None
+        return date.isoformat() if isinstance(date, (datetime.datetime, datetime.date)) else str(date)
+
+    @staticmethod
+    def _date_from_sql(date):
+        if date is None:
+            return None
+        try:
+            return datetime.datetime.fromisoformat(date)
+        except ValueError:
+            return date
+
+    def load(self):
+        import tasks
+        connection = self.database.connection
+        loaded = {}
+        with self.database.lock:
+            task_rows = connection.execute('SELECT task_id, title, description, done, start_date, end_date, trello_id, dirty_fields FROM tasks WHERE guild_id = ? ORDER BY rowid', (self.guild_id,)).fetchall()
+            assignee_rows = connection.execute('SELECT task_id, assignee FROM assignees WHERE guild_id = ? ORDER BY rowid', (self.guild_id,)).fetchall()
+            notification_rows = connection.execute('SELECT task_id, rate, measure FROM notifications WHERE guild_id = ?', (self.guild_id,)).fetchall()
+        for task_id, title, description, done, start_date, end_date, trello_id, dirty_fields in task_rows:
+            task = tasks.Task()
+            task.task_id = task_id
+            task.title = title
+            task.description = description
+            task.done = bool(done)
+            task.start_date = self._date_from_sql(start_date)
+            task.end_date = self._date_from_sql(end_date)
+            task.trello_id = trello_id
+            task.dirty_fields = set(dirty_fields.split(',')) if dirty_fields else None
+            loaded[task_id] = task
+        assignees = {}
+        for task_id, assignee in assignee_rows:
+            assignees.setdefault(task_id, []).append(assignee)
+        for task_id, task_assignees in assignees.items():
+            loaded[task_id].set_assignees(task_assignees)
+        for task_id, rate, measure in notification_rows:
+            task = loaded[task_id]
+            task.set_notification(tasks.Notification(rate, measure, task, None))
+        return list(loaded.values())
+
+    #Returns the rows of a task: (task row, assignee rows, notification row or None)
+    def _rows(self, task):
+        task_row = (task.task_id, self.guild_id, getattr(task, 'title', None), getattr(task, 'description', None), int(task.is_done()),
+            self._date_to_sql(task.get_start_date()), self._date_to_sql(task.get_end_date()), task.get_trello_id(), ','.join(sorted(task.get_dirty_fields())))
+        assignee_rows = [(task.task_id, self.guild_id, str(i)) for i in task.get_assignees()]
+        notification = task.get_notification()
+        notification_row = (task.task_id, self.guild_id, notification.rate, notification.measure) if notification is not None else None
+        return task_row, assignee_rows, notification_row
+
+    def _write(self, puts, deletes, full):
+        with self.database.lock, self.database.connection as connection:
+            if full:
+                connection.execute('DELETE FROM tasks WHERE guild_id = ?', (self.guild_id,))
+            connection.executemany('DELETE FROM tasks WHERE task_id = ?', [(i,) for i in deletes])
+            for task_row, assignee_rows, notification_row in puts:
+                connection.execute('''INSERT INTO tasks (task_id, guild_id, title, description, done, start_date, end_date, trello_id, dirty_fields) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(task_id) DO UPDATE SET title = excluded.title, description = excluded.description, done = excluded.done,
+                    start_date = excluded.start_date, end_date = excluded.end_date, trello_id = excluded.trello_id, dirty_fields = excluded.dirty_fields''', task_row)
+                connection.execute('DELETE FROM assignees WHERE task_id = ?', (task_row[0],))
+                connection.executemany('INSERT OR IGNORE INTO assignees (task_id, guild_id, assignee) VALUES (?, ?, ?)', assignee_rows)
+                if notification_row is not None:
+                    connection.execute('INSERT OR REPLACE INTO notifications (task_id, guild_id, rate, measure) VALUES (?, ?, ?, ?)', notification_row)
+                else:
+                    connection.execute('DELETE FROM notifications WHERE task_id = ?', (task_row[0],))
+
+    def batch(self, changes, tasks):
+        if changes is None:
+            self._ensure_ids(tasks)
+            puts = [self._rows(task) for task in tasks]
+            deletes = []
+        else:
+            puts = [self._rows(task) for change, task in changes if change == 'put']
+            deletes = [task.task_id for change, task in changes if change == 'delete']
+        return lambda: self._write(puts, deletes, changes is None)
+
+    def query(self, done=None, assignee=None, title=None, offset=0, limit=None):
+        sql = 'SELECT task_id, title FROM tasks WHERE guild_id = ?'
+        parameters = [self.guild_id]
+        if done is not None:
+            sql += ' AND done = ?'
+            parameters.append(int(done))
+        if assignee is not None:
+            sql += ' AND task_id IN (SELECT task_id FROM assignees WHERE guild_id = ? AND assignee = ?)'
+            parameters += [self.guild_id, str(assignee)]
+        if title is not None:
+            sql += ' AND instr(lower(title), ?) > 0'
+            parameters.append(title.lower())
+        #A negative LIMIT has no limit
+        sql += ' ORDER BY rowid LIMIT ? OFFSET ?'
+        parameters += [limit if limit is not None else -1, offset]
+        with self.database.lock:
+            return self.database.connection.execute(sql, parameters).fetchall()
+
+#Wraps another storage and writes its changes at most once every interval seconds in an executor.
+#Changes to the same task between two flushes are coalesced, only the last one is written
+class WriteBehindStorage(Storage):
+    def __init__(self, task_storage:Storage, loop, interval=5, executor=None) -> None:
+        super().__init__(task_storage.guild_id)
+        self.storage = task_storage
+        self.loop = loop
+        self.interval = interval
+        self.executor = executor
+        self.changes = {}
+        self.full = False
+        #TaskStore of the pending changes, only kept until they are taken so an unloaded guild can be freed
+        self.tasks = None
+        self.handle = None
+        self.flushing = None
+
+    def is_dirty(self):
+        return self.full or len(self.changes) > 0
+
+    def load(self):
+        return self.storage.load()
+
+    def put(self, task, tasks):
+        self.changes[task.task_id] = ('put', task)
+        self.tasks = tasks
+        self._schedule()
+
+    def delete(self, task, tasks):
+        self.changes[task.task_id] = ('delete', task)
+        self.tasks = tasks
+        self._schedule()
+
+    def dump(self, tasks):
+        self.full = True
+        self.changes = {}
+        self.tasks = tasks
+        self._schedule()
+
+    #Pending changes are not in the wrapped storage yet, so the TaskManager has to answer from memory
+    def query(self, done=None, assignee=None, title=None, offset=0, limit=None):
+        if self.is_dirty():
+            return None
+        return self.storage.query(done=done, assignee=assignee, title=title, offset=offset, limit=limit)
+
+    def _schedule(self):
+        if self.handle is None and self.flushing is None:
+            self.handle = self.loop.call_later(self.interval, self._start_flush)
+
+    def _start_flush(self):
+        self.handle = None
+        self.flushing = self.loop.create_task(self.flush())
+
+    def _take_batch(self):
+        write = self.storage.batch(None if self.full else list(self.changes.values()), self.tasks)
+        self.changes = {}
+        self.full = False
+        self.tasks = None
+        return write
+
+    async def flush(self):
+        if not self.is_dirty():
+            self.flushing = None
+            return
+        changes, full, tasks = self.changes, self.full, self.tasks
+        write = self._take_batch()
+        try:
+            await self.loop.run_in_executor(self.executor, write)
+        except Exception as e:
+            print(e)
+            #Put the failed changes back, newer changes of the same task win
+            self.tasks = self.tasks if self.tasks is not None else tasks
+            self.full = self.full or full
+            if not self.full:
+                changes.update(self.changes)
+                self.changes = changes
+        self.flushing = None
+        if self.is_dirty():
+            self._schedule()
+
+    async def drain(self, attempts=3):
+        while (self.is_dirty() or self.flushing is not None) and attempts > 0:
+            if self.handle is not None:
+                self.handle.cancel()
+                self.handle = None
+            if self.flushing is None:
+                self.flushing = self.loop.create_task(self.flush())
+                attempts -= 1
+            await asyncio.shield(self.flushing)
+
+    #Blocking flush of everything that is pending, used on shutdown when the event loop may be gone
+    def flush_now(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if self.is_dirty():
+            self._take_batch()()
+
+    def close(self):
+        self.flush_now()
+        self.tasks = None
+        self.storage.close()
+
+#One-shot migration of every <persist_dir>/<guild_id>.tasks pickle (and its journal) into a TaskDatabase.
+#Migrated files are renamed to <guild_id>.tasks.migrated so a second run doesn't duplicate them
+def migrate_pickles(persist_dir='tasks', database_path='tasks/tasks.db'):
+    database = TaskDatabase(database_path)
+    migrated = []
+    for file in sorted(os.listdir(persist_dir)):
+        if not file.endswith('.tasks'):
+            continue
+        guild_id = int(file[:len(file)-len('.tasks')])
+        journal = JournalStorage(guild_id, None, persist_dir)
+        guild_tasks = journal.load()
+        SQLiteStorage(guild_id, database).dump(guild_tasks)
+        os.replace(journal.snapshot_path, f'{journal.snapshot_path}.migrated')
+        for path in (journal.rotated_path, journal.journal_path):
+            if os.path.exists(path):
+                os.replace(path, f'{path}.migrated')
+        migrated.append((guild_id, len(guild_tasks)))
+    database.close()
+    return migrated
+
+#Lock shared by the processes of a cluster, held on <path>.lock while a file they all write is read and replaced
+@contextlib.contextmanager
+def file_lock(path):
+    with open(f'{path}.lock', 'a+') as file:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        else:
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+            else:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+#Sets key in the json object stored in path and returns the whole object. The file is read again under the lock,
+#so keys written by other processes are kept
+def update_json(path, key, value):
+    with file_lock(path):
+        try:
+            with open(path, 'r') as file:
+                data = json.loads(file.read())
+        except (OSError, ValueError):
+            data = {}
+        data[key] = value
+        with open(f'{path}.tmp', 'w') as file:
+            file.write(json.dumps(data))
+        os.replace(f'{path}.tmp', path)
+    return data
+
+def create_storage(backend, guild_id, loop, persist_dir='tasks', database:TaskDatabase|None=None, write_behind_interval=0, executor=None, **kwargs) -> Storage:
+    if backend == 'sqlite':
+        task_storage = SQLiteStorage(guild_id, database)
+    elif backend == 'journal':
+        task_storage = JournalStorage(guild_id, loop, persist_dir, kwargs.get('journal_compact_threshold', 1000))
+    else:
+        task_storage = PickleStorage(guild_id, persist_dir)
+    if write_behind_interval > 0:
+        return WriteBehindStorage(task_storage, loop, write_behind_interval, executor)
+    return task_storage
+
+def main():
+    #python storage.py migrate [persist_dir] [database_path]
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate':
+        for guild_id, count in migrate_pickles(*sys.argv[2:4]):
+            print(f'{guild_id}: {count} tasks migrated')
+    else:
+        print('usage: python storage.py migrate [persist_dir] [database_path]')
+
+if __name__ == "__main__":
+    main()
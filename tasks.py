@@ -1,12 +1,22 @@
 #Imports
 from collections.abc import Iterable
-import pickle
 import asyncio
 import discord
-import os
 import datetime
 import trello
 import math
+import uuid
+import time
+import heapq
+import bisect
+import collections
+import re
+import itertools
+import os
+import urllib.parse
+import pickle
+import weakref
+import storage
 
 #Class to handle messages
 
@@ -25,6 +35,7 @@ class Message():
         self.channel = channel
         self.discord_message = None
         self.extra = None
+        self.outbox = Outbox.get(loop)
 
     #Method to bind callbacks to buttons. This buttons variable name must end with _button . Example: play_button
     #button must be a string or an Iterable containing strings. This strings have to be the button variable name.
@@ -67,26 +78,35 @@ class Message():
     def set_extra(self, **kwargs):
         self.extra = kwargs
 
-    #Method to send the message
+    #Method to send the message through the outbox of its channel. Returns a future with the discord message, None if it failed
     def _send(self, content:Content|None, delete_last = True): 
         if content:
-            if self.discord_message is not None and delete_last:
-                asyncio.run_coroutine_threadsafe(self.discord_message.delete(), loop=self.loop)
-            asyncio.run_coroutine_threadsafe(self.channel.send(content=content.content, embed=content.embed , view=content.view), loop=self.loop).add_done_callback(self.future_callback)
+            return self.outbox.put(self, Outbox.SEND, content, delete_last)
+
+    #Like _send, but waits for room in the outbox of a full channel instead of dropping the message
+    async def _send_wait(self, content:Content|None, delete_last = True):
+        if content:
+            return await self.outbox.put_wait(self, Outbox.SEND, content, delete_last)
 
     def _update(self, content:Content|None):
         if content:
-            if self.discord_message is not None:
-                asyncio.run_coroutine_threadsafe(self.discord_message.edit(content=content.content, embed=content.embed , view=content.view), loop=self.loop).add_done_callback(self.future_callback)
+            return self.outbox.put(self, Outbox.EDIT, content)
 
-    #Delete message
-    def delete(self):
-        asyncio.run_coroutine_threadsafe(self.discord_message.delete(), loop=self.loop)
+    #Method to send the message as the response to an interaction
+    async def _respond(self, interaction, content:Content|None, ephemeral = False):
+        if content:
+            await interaction.response.send_message(content=content.content, embed=content.embed, view=content.view, ephemeral=ephemeral)
+            self.discord_message = await interaction.original_response()
 
-    #Callback to handle the future from the _send method and set self.discord_message
-    def future_callback(self, future): 
-        self.discord_message = future.result()
+    #Method to edit the message an interaction comes from as the response to it, one request instead of a delete and a send
+    async def _edit_response(self, interaction, content:Content|None):
+        if content:
+            await interaction.response.edit_message(content=content.content, embed=content.embed, view=content.view)
+            self.discord_message = interaction.message
 
+    #Delete message
+    def delete(self):
+        return self.outbox.put(self, Outbox.DELETE)
 
     # Method to update message. Must be overwritten
     def update(self, *args, **kwargs): 
@@ -99,6 +119,366 @@ class Message():
     def send(self) -> None:
         pass
 
+#A send, edit or delete of a Message waiting in an Outbox
+class OutboxOperation():
+    __slots__ = ('kind', 'message', 'content', 'delete_last', 'future', 'queued_at')
+
+    def __init__(self, kind, message, content, delete_last, future) -> None:
+        self.kind = kind
+        self.message = message
+        self.content = content
+        self.delete_last = delete_last
+        self.future = future
+        self.queued_at = time.monotonic()
+
+class ChannelQueue():
+    def __init__(self, bucket) -> None:
+        self.bucket = bucket
+        self.operations = collections.deque()
+        #Message -> its last operation that hasn't started, the one new operations of the message are merged into
+        self.pending = {}
+        self.worker = None
+        #Futures of the put_wait calls waiting for room in the queue
+        self.waiters = collections.deque()
+
+#Given to on_error when an operation is dropped because its channel has max_pending waiting operations
+class OutboxFull(Exception):
+    def __init__(self, operation, pending) -> None:
+        super().__init__(f'{pending} messages waiting, {operation.kind} dropped')
+        self.operation = operation
+
+#Outgoing messages of an event loop. Every channel has a queue served in order by one worker, paced by a bucket of rate requests every period seconds
+#(discord allows 5 messages every 5 seconds in a channel). Operations of a message that haven't started are merged:
+#repeated edits keep the latest content, a delete followed by a send is a single send that replaces the message, and a send that replaces
+#the newest message of the channel is done as an edit. A channel with max_pending waiting operations drops new ones and gives them to
+#on_error as OutboxFull, put_wait waits for room instead. Failures are given to on_error and counted, the futures of the operations
+#always end with the discord message or None
+class Outbox():
+    SEND = 'send'
+    EDIT = 'edit'
+    DELETE = 'delete'
+    outboxes = {}
+
+    #The arguments are only used when the outbox of the loop is created
+    @classmethod
+    def get(cls, loop, **kwargs):
+        if loop not in cls.outboxes:
+            cls.outboxes[loop] = cls(loop, **kwargs)
+        return cls.outboxes[loop]
+
+    def __init__(self, loop, rate=5, period=5, max_pending=100, max_retries=3, on_error=None) -> None:
+        self.loop = loop
+        self.rate = rate
+        self.period = period
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.on_error = on_error if on_error is not None else self.print_error
+        self.queues = {}
+        self.counters = {'queued': 0, 'sent': 0, 'edited': 0, 'deleted': 0, 'coalesced': 0, 'dropped': 0, 'failed': 0, 'retried': 0, 'rate_limited': 0}
+        self.max_wait = 0
+
+    def print_error(self, channel, error):
+        print(f'channel {getattr(channel, "id", None)}: {error}')
+
+    def get_queue(self, channel) -> ChannelQueue:
+        queue = self.queues.get(channel.id, None)
+        if queue is None:
+            queue = ChannelQueue(trello.TokenBucket(self.rate, self.period))
+            self.queues[channel.id] = queue
+        return queue
+
+    #Method to queue an operation of a message. Returns a future with the discord message once it's done
+    def put(self, message, kind, content=None, delete_last=False):
+        queue = self.get_queue(message.channel)
+        operation = queue.pending.get(message, None)
+        if operation is not None:
+            merged = self._merge(queue, operation, kind, content, delete_last)
+            if merged is not None:
+                self.counters['coalesced'] += 1
+                return merged
+        future = self.loop.create_future()
+        operation = OutboxOperation(kind, message, content, delete_last, future)
+        if len(queue.operations) >= self.max_pending:
+            self.counters['dropped'] += 1
+            self.on_error(message.channel, OutboxFull(operation, len(queue.operations)))
+            future.set_result(None)
+            return future
+        queue.operations.append(operation)
+        queue.pending[message] = operation
+        self.counters['queued'] += 1
+        if queue.worker is None or queue.worker.done():
+            queue.worker = self.loop.create_task(self._run(message.channel, queue))
+        return future
+
+    #Like put, but waits while the channel has max_pending waiting operations instead of dropping the new one. Returns the future of put
+    async def put_wait(self, message, kind, content=None, delete_last=False):
+        queue = self.get_queue(message.channel)
+        while len(queue.operations) >= self.max_pending:
+            waiter = self.loop.create_future()
+            queue.waiters.append(waiter)
+            await waiter
+        return self.put(message, kind, content, delete_last)
+
+    #Merges a new operation into the waiting one of the same message. Returns the future of the merged operation or None if they can't be merged
+    def _merge(self, queue, operation, kind, content, delete_last):
+        if kind == self.EDIT:
+            if operation.kind != self.DELETE:
+                operation.content = content
+            return operation.future
+        if kind == self.SEND:
+            #A send that keeps the last message is a new message
+            if not delete_last:
+                return None
+            if operation.kind == self.SEND:
+                operation.content = content
+            else:
+                operation.kind, operation.content, operation.delete_last = self.SEND, content, True
+            return operation.future
+        if operation.kind == self.SEND and not (operation.delete_last and operation.message.discord_message is not None):
+            #The message was never sent, nothing to delete
+            queue.operations.remove(operation)
+            queue.pending.pop(operation.message)
+            operation.future.set_result(None)
+            return operation.future
+        operation.kind, operation.content = self.DELETE, None
+        return operation.future
+
+    async def _run(self, channel, queue):
+        while len(queue.operations) > 0:
+            operation = queue.operations.popleft()
+            if queue.pending.get(operation.message, None) is operation:
+                queue.pending.pop(operation.message)
+            #Room for one of the put_wait calls
+            while len(queue.waiters) > 0:
+                waiter = queue.waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    break
+            self.max_wait = max(self.max_wait, time.monotonic() - operation.queued_at)
+            result = None
+            try:
+                result = await self._execute(channel, queue, operation)
+            except Exception as e:
+                self.counters['failed'] += 1
+                self.on_error(channel, e)
+            if not operation.future.done():
+                operation.future.set_result(result)
+
+    async def _execute(self, channel, queue, operation):
+        message = operation.message
+        content = operation.content
+        last = message.discord_message
+        if operation.kind == self.DELETE or (operation.kind == self.SEND and operation.delete_last and last is not None):
+            if last is not None and operation.kind == self.SEND and getattr(channel, 'last_message_id', None) == last.id:
+                try:
+                    message.discord_message = await self._request(queue, lambda: last.edit(content=content.content, embed=content.embed, view=content.view)) or last
+                    self.counters['edited'] += 1
+                    return message.discord_message
+                except discord.NotFound:
+                    pass
+            elif last is not None:
+                try:
+                    await self._request(queue, last.delete)
+                    self.counters['deleted'] += 1
+                except discord.NotFound:
+                    pass
+            message.discord_message = None
+            if operation.kind == self.DELETE:
+                return None
+        if operation.kind == self.EDIT:
+            if last is None:
+                return None
+            try:
+                message.discord_message = await self._request(queue, lambda: last.edit(content=content.content, embed=content.embed, view=content.view)) or last
+            except discord.NotFound:
+                #Deleted by someone else, there is nothing left to update
+                message.discord_message = None
+                return None
+            self.counters['edited'] += 1
+            return message.discord_message
+        message.discord_message = await self._request(queue, lambda: channel.send(content=content.content, embed=content.embed, view=content.view))
+        self.counters['sent'] += 1
+        return message.discord_message
+
+    #Waits for the bucket of the channel, then makes the request. 429s that discord.py gives up on pause the channel and are retried
+    async def _request(self, queue, request):
+        attempt = 0
+        while True:
+            delay = queue.bucket.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            queue.bucket.take()
+            try:
+                return await request()
+            except (discord.RateLimited, discord.HTTPException) as e:
+                if isinstance(e, discord.HTTPException) and e.status != 429 or attempt >= self.max_retries:
+                    raise
+                retry_after = getattr(e, 'retry_after', None) or float(getattr(getattr(e, 'response', None), 'headers', {}).get('Retry-After', 1))
+                self.counters['rate_limited'] += 1
+                self.counters['retried'] += 1
+                queue.bucket.pause(retry_after)
+                attempt += 1
+
+    #Waits until every queued operation is done
+    async def join(self):
+        while True:
+            workers = [i.worker for i in self.queues.values() if i.worker is not None and not i.worker.done()]
+            if len(workers) == 0:
+                return
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    def get_pending(self):
+        return sum(len(i.operations) for i in self.queues.values())
+
+    def get_counters(self):
+        return self.counters | {'pending': self.get_pending(), 'channels': len(self.queues), 'max_wait': self.max_wait}
+
+#Interned set of assignees, the values of the Assignee.sets WeakValueDictionary so a set no task uses anymore leaves it.
+#A subclass so it's never the frozenset key of its own entry, it's pickled as a plain frozenset
+class AssigneeSet(frozenset):
+    __slots__ = ()
+
+    def __reduce__(self):
+        return (frozenset, (list(self),))
+
+#Assignee of a task, a user id or a role name (roles have always been stored by name).
+#Assignees are interned: get() returns the same instance for the same assignee, so tasks share them and they compare by identity.
+#The sets of assignees of the tasks are interned too with freeze(), while some task holds them
+class Assignee():
+    __slots__ = ('kind', 'value')
+    USER = 'User'
+    ROLE = 'Role'
+    table = {}
+    EMPTY = AssigneeSet()
+    sets = weakref.WeakValueDictionary({frozenset(): EMPTY})
+
+    def __init__(self, kind, value) -> None:
+        self.kind = kind
+        self.value = value
+
+    @classmethod
+    def get(cls, kind, value):
+        if kind != cls.ROLE:
+            kind, value = cls.USER, int(value)
+        assignee = cls.table.get((kind, value), None)
+        if assignee is None:
+            assignee = cls.table[(kind, value)] = cls(kind, value)
+        return assignee
+
+    @classmethod
+    def user(cls, user_id):
+        return cls.get(cls.USER, user_id)
+
+    @classmethod
+    def role(cls, name):
+        return cls.get(cls.ROLE, name)
+
+    #Assignee of a discord user, member or role
+    @classmethod
+    def from_target(cls, target):
+        return cls.role(target.name) if isinstance(target, discord.Role) else cls.user(target.id)
+
+    #Reads the 'User:<id>' and 'Role:<name>' strings tasks were stored with
+    @classmethod
+    def parse(cls, text):
+        if isinstance(text, Assignee):
+            return text
+        kind, value = text.split(':', 1)
+        return cls.get(kind, value)
+
+    @classmethod
+    def freeze(cls, assignees:Iterable):
+        #Keyed by a plain frozenset, the keys of a WeakValueDictionary are strong references
+        key = frozenset(cls.parse(i) for i in assignees)
+        interned = cls.sets.get(key, None)
+        if interned is None:
+            interned = cls.sets[key] = AssigneeSet(key)
+        return interned
+
+    def is_role(self):
+        return self.kind == self.ROLE
+
+    def mention(self):
+        return self.value if self.is_role() else f'<@{self.value}>'
+
+    def sort_key(self):
+        return (self.kind, str(self.value))
+
+    #Unpickled assignees are interned again
+    def __reduce__(self):
+        return (Assignee.parse, (str(self),))
+
+    def __str__(self):
+        return f'{self.kind}:{self.value}'
+
+    def __repr__(self):
+        return f'Assignee({self})'
+
+#Lookups of guild members by name. discord.py finds them in its member cache, in the low memory mode nothing is cached and
+#query=True asks discord for the members whose name starts with the text. Found ids are kept in a LRU of size names per process
+class MemberResolver():
+    instance = None
+
+    @classmethod
+    def get(cls):
+        if cls.instance is None:
+            cls.instance = cls()
+        return cls.instance
+
+    def __init__(self, size=1024, query=False, timeout=2) -> None:
+        self.size = size
+        self.query = query
+        self.timeout = timeout
+        #(guild id, lowercase name) -> user id, least recently used first. Names discord didn't find are kept as 0
+        self.names = collections.OrderedDict()
+        self.counters = {'hits': 0, 'misses': 0, 'queries': 0}
+
+    #Mentions and ids aren't names
+    @staticmethod
+    def is_name(text):
+        text = text.strip()
+        return text != '' and not text.startswith('<') and not text.isdigit() and text.lower() != 'me'
+
+    #Returns the id of the member called name (user name, global name or nickname) if it's cached, None otherwise
+    def get_member_named(self, guild, name):
+        member = guild.get_member_named(name)
+        if member is not None:
+            return member.id
+        user_id = self.names.get((guild.id, name.lower()), None)
+        if user_id is not None:
+            self.names.move_to_end((guild.id, name.lower()))
+            self.counters['hits'] += 1
+        return user_id or None
+
+    def _put(self, guild_id, name, user_id):
+        self.names[(guild_id, name.lower())] = user_id
+        self.names.move_to_end((guild_id, name.lower()))
+        while len(self.names) > self.size:
+            self.names.popitem(last=False)
+
+    #Method to look up a member that isn't cached, afterwards get_member_named finds it
+    async def load_member_named(self, guild, name):
+        name = name.strip().lstrip('@')
+        if guild is None or not self.is_name(name):
+            return None
+        user_id = self.get_member_named(guild, name)
+        if user_id is not None or not self.query or (guild.id, name.lower()) in self.names:
+            return user_id
+        self.counters['misses'] += 1
+        self.counters['queries'] += 1
+        try:
+            members = await asyncio.wait_for(guild.query_members(query=name, limit=5, cache=False), self.timeout)
+        except (asyncio.TimeoutError, discord.DiscordException) as e:
+            print(e)
+            return None
+        for member in members:
+            for member_name in (member.name, member.global_name, member.nick):
+                if member_name is not None:
+                    self._put(guild.id, member_name, member.id)
+        if (guild.id, name.lower()) not in self.names:
+            self._put(guild.id, name, 0)
+        return self.names[(guild.id, name.lower())] or None
+
 class CustomModal(discord.ui.Modal):
     def __init__(self, title=''):
         super().__init__(title=title)
@@ -136,17 +516,16 @@ class TaskModal(CustomModal):
             self.end_date.default = ''
         return self
 
-class TaskListMessage(Message):
-    def __init__(self, loop, channel=None):
-        super().__init__(loop, channel)
-        self.view = discord.ui.View()
-        self.previous_button = discord.ui.Button(label='<')
-        self.next_button = discord.ui.Button(label='>')
-        self.max_column_width = 40
-        self.page_index = 0
-        self.tasks = []
-        self.pages = []
-        self.bind_button(('previous', 'next'), (self.previous_button_callback, self.next_button_callback))
+#Renders the task list. The rows of every task are cached until one of the fields they show changes,
+#so listing again only renders the tasks that changed
+class TaskListRenderer():
+    def __init__(self, max_column_width = 40, max_page_length = 2000) -> None:
+        self.max_column_width = max_column_width
+        self.max_page_length = max_page_length
+        self.header = '`|Title' + ' '*(max_column_width-len('title')) + '|Description' + ' '*(max_column_width-len('description')) + '|Is Done' + '|Start Date' + '|End Date  ' + '|Assignees' + '|`\n'
+        #task_id -> (fields shown, rendered rows)
+        self.cache = {}
+
     def write_column(self, text, max_width):
         text = text.split(' ')
         line = ''
@@ -168,108 +547,376 @@ class TaskListMessage(Message):
         lines.append(line)
         return lines
 
-    def _gen_pages(self, tasks):
-        pages = []
-        content = '`'
-        content+='|Title' + ' '*(self.max_column_width-len('title')) +'|Description' + ' '*(self.max_column_width-len('description')) + '|Is Done' + '|Start Date' + '|End Date  ' + '|Assignees' + '|`\n'
-        for task in tasks:
-            task_text = ''
-            description = task.get_description() if task.get_description() != "" and task.get_description() is not None else "-"
-            description_list = self.write_column(description, self.max_column_width)
-            title_list = self.write_column(task.get_title(), self.max_column_width)
-            assignees = []
-            for i in task.get_assignees():
-                data = i.split(":")
-                assignees.append(f'{data[1]}') if data[0] == 'Role' else assignees.append(f'<@{data[1]}>')
-            assignees = " ".join(assignees)
-            max_length = max(len(description_list), len(title_list))
-            for i in range(max_length):
-                line = ''
-                for j in (title_list, description_list):
-                    try:
-                        line+='|' + j[i] + ' '*(self.max_column_width-len(j[i]))
-                    except Exception as e:
-                        line+= '|' + ' '*self.max_column_width
-                if i==0:
-                    start_date = task.get_start_date().strftime('%d/%m/%Y')
-                    end_date = task.get_end_date()
-                    end_date = end_date.strftime('%d/%m/%Y') if end_date is not None else '-'
-                    line='`'+line + '|' + f'{task.is_done()}' + ' '*(len('is done') - len(str(task.is_done()))) + '|' + start_date + ' '*(len('start date')-len(start_date)) + '|' + end_date + ' '*(10-len(end_date)) +'|`' + assignees + '\n'
-                else:
-                    line='`'+line+'|`'+'\n'
-                task_text+=line
-            if len(content)+len(task_text)>2000:
-                pages.append(content)
-                content = '`'
-                content+='|Title' + ' '*(self.max_column_width-len('title')) +'|Description' + ' '*(self.max_column_width-len('description')) + '|Is Done' + '|Start Date' + '|End Date  ' + '|Assignees' + '|`\n'
+    @staticmethod
+    def _format_date(date):
+        return date.strftime('%d/%m/%Y') if isinstance(date, datetime.date) else '-'
+
+    @staticmethod
+    def _key(task):
+        return (task.get_title(), task.get_description(), task.is_done(), task.get_start_date(), task.get_end_date(), task.get_assignees())
+
+    def render(self, task):
+        key = self._key(task)
+        cached = self.cache.get(task.get_task_id(), None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        text = self._render(task)
+        self.cache[task.get_task_id()] = (key, text)
+        return text
+
+    def _render(self, task):
+        description = task.get_description() if task.get_description() != "" and task.get_description() is not None else "-"
+        columns = (self.write_column(task.get_title(), self.max_column_width), self.write_column(description, self.max_column_width))
+        assignees = [i.mention() for i in task.get_sorted_assignees()]
+        start_date = self._format_date(task.get_start_date())
+        end_date = self._format_date(task.get_end_date())
+        lines = []
+        #A task never takes more than a page, the rows that don't fit are cut
+        length = len(self.header)
+        for i in range(max(len(j) for j in columns)):
+            line = ''.join('|' + (j[i] if i < len(j) else '').ljust(self.max_column_width) for j in columns)
+            if i == 0:
+                line = ''.join(('`', line, '|', str(task.is_done()).ljust(len('is done')), '|', start_date.ljust(len('start date')), '|', end_date.ljust(10), '|`', ' '.join(assignees), '\n'))
             else:
-                content+=task_text
-        if pages[len(pages)-1] != content:
-            pages.append(content)
-        return pages
-
-    def _build(self, page, overwrite):
+                line = ''.join(('`', line, '|`\n'))
+            length += len(line)
+            if length > self.max_page_length and i > 0:
+                break
+            lines.append(line)
+        return ''.join(lines)
+
+    def forget(self, task_id):
+        self.cache.pop(task_id, None)
+
+    def clear(self):
+        self.cache = {}
+
+    #Generates (page, is_last) pairs. Tasks are only rendered when the page they are in is generated
+    def pages(self, tasks):
+        parts = [self.header]
+        length = len(self.header)
+        for task in tasks:
+            text = self.render(task)
+            if length + len(text) > self.max_page_length and len(parts) > 1:
+                yield ''.join(parts), False
+                parts = [self.header]
+                length = len(self.header)
+            parts.append(text)
+            length += len(text)
+        yield ''.join(parts), True
+
+#The same view is kept while the list is browsed, pages are changed by editing the message
+class TaskListMessage(Message):
+    def __init__(self, loop, channel=None, renderer:TaskListRenderer|None = None):
+        super().__init__(loop, channel)
         self.view = discord.ui.View()
-        self.page_index = page
-        self.previous_button.disabled = False
-        self.next_button.disabled = False
-        if page == 0:
-            self.previous_button.disabled = True
-        if page == len(self.pages)-1:
-            self.next_button.disabled = True
-        if self.pages == [] or overwrite:
-            self.pages = self._gen_pages(self.tasks)
+        self.previous_button = discord.ui.Button(label='<')
+        self.next_button = discord.ui.Button(label='>')
         self.view.add_item(self.previous_button)
         self.view.add_item(self.next_button)
-        content = self.pages[page]
+        self.renderer = renderer if renderer is not None else TaskListRenderer()
+        self.page_index = 0
+        self.tasks = []
+        #Pages generated so far, the next ones are generated when the user gets to them
+        self.pages = []
+        self.page_generator = None
+        self.last_page = None
+        self.bind_button(('previous', 'next'), (self.previous_button_callback, self.next_button_callback))
+
+    def _get_page(self, page):
+        while len(self.pages) <= page and self.last_page is None:
+            content, is_last = next(self.page_generator)
+            self.pages.append(content)
+            if is_last:
+                self.last_page = len(self.pages)-1
+        return self.pages[min(page, len(self.pages)-1)]
+
+    def _build(self, page, overwrite):
+        if self.page_generator is None or overwrite:
+            self.pages = []
+            self.last_page = None
+            self.page_generator = self.renderer.pages(self.tasks)
+        content = self._get_page(page)
+        self.page_index = min(page, len(self.pages)-1)
+        self.previous_button.disabled = self.page_index == 0
+        self.next_button.disabled = self.page_index == self.last_page
         return Message.Content(content=content, view=self.view)
 
     def send(self, tasks, page=0, overwrite=False, delete_last = True):
+        if tasks is not self.tasks:
+            overwrite = True
         self.tasks = tasks
         return self._send(self._build(page, overwrite), delete_last)
+
+    async def respond(self, interaction, tasks):
+        self.tasks = tasks
+        await self._respond(interaction, self._build(0, True))
     
     async def next_button_callback(self, interaction):
-        self.send(self.tasks, self.page_index+1)
+        await self._edit_response(interaction, self._build(self.page_index+1, False))
 
     async def previous_button_callback(self, interaction):
-        self.send(self.tasks, self.page_index-1)
+        await self._edit_response(interaction, self._build(self.page_index-1, False))
+
+#Filters of the task select menu. Every field is optional
+class TaskFilterModal(CustomModal):
+    title_input = discord.ui.TextInput(label='Title contains', custom_id='title', required=False)
+    assignee_input = discord.ui.TextInput(label='Assignee', custom_id='assignee', placeholder='@user, user name or role name', required=False)
+    done_input = discord.ui.TextInput(label='Done', custom_id='done', placeholder='yes / no (empty for both)', required=False, max_length=5)
+
+    def set_data(self, title:str|None, assignee:Assignee|None, done:bool|None):
+        self.title_input.default = title if title is not None else ''
+        self.assignee_input.default = assignee.mention() if assignee is not None else ''
+        self.done_input.default = {True: 'yes', False: 'no', None: ''}[done]
+        return self
 
+    #Returns the filters as the TaskManager queries take them: {'title': str|None, 'assignee': Assignee|None, 'done': bool|None}
+    @staticmethod
+    def get_filters(interaction):
+        values = TaskFilterModal.get_values(interaction)
+        done = values.get('done', '').lower()
+        return {
+            'title': values.get('title', '') or None,
+            'assignee': TaskFilterModal.parse_assignee(values.get('assignee', ''), interaction.guild),
+            'done': True if done in ('yes', 'y', 'true', 'done') else False if done in ('no', 'n', 'false', 'undone') else None
+        }
+
+    #Text of every field by custom_id
+    @staticmethod
+    def get_values(interaction):
+        values = {}
+        for i in interaction.data.get('components', []):
+            for j in i.get('components', []):
+                values[j.get('custom_id')] = j.get('value', '').strip()
+        return values
+
+    #Mentions and ids are users, names are looked up in the guild members and roles
+    @staticmethod
+    def parse_assignee(text, guild = None):
+        text = text.strip()
+        if text == '':
+            return None
+        if text.startswith('<@&') and text.endswith('>'):
+            role = guild.get_role(int(text[3:-1])) if guild is not None and text[3:-1].isdigit() else None
+            return Assignee.role(role.name) if role is not None else None
+        if text.startswith('<@') and text.endswith('>'):
+            text = text[2:-1].lstrip('!')
+        if text.isdigit():
+            return Assignee.user(text)
+        text = text.lstrip('@')
+        if guild is not None:
+            user_id = MemberResolver.get().get_member_named(guild, text)
+            if user_id is not None:
+                return Assignee.user(user_id)
+        return Assignee.role(text)
+
+    #Role mentions and role names. None if the guild has no such role
+    @staticmethod
+    def parse_role(text, guild = None):
+        text = text.strip()
+        if text.startswith('<@&') and text.endswith('>'):
+            return TaskFilterModal.parse_assignee(text, guild)
+        text = text.lstrip('@')
+        if text == '' or (guild is not None and discord.utils.get(guild.roles, name=text) is None):
+            return None
+        return Assignee.role(text)
+
+#Select menu over any number of tasks, PAGE_SIZE options at a time.
+#options(done, assignee, title, offset, limit) returns at most limit (label, value) pairs matching the filters from offset on, only the page shown is queried
 class TaskSelectMessage(Message):
     #max values: https://discordpy.readthedocs.io/en/stable/interactions/api.html?highlight=select#discord.ui.Select
-    def __init__(self, loop, channel=None, max_values = 25):
+    PAGE_SIZE = 25
+
+    def __init__(self, loop, channel=None, max_values = 25, options = None):
         super().__init__(loop, channel)
         self.view = discord.ui.View()
         self.max_values = max_values
+        self.options = options
+        self.filters = {'done': None, 'assignee': None, 'title': None}
+        #Offset of the first task of the page shown
+        self.offset = 0
         self.task_selector_select = discord.ui.Select(max_values=max_values)
-        self.cancel_button = discord.ui.Button(label='Cancel')
-    
-    def _build(self, items):
+        self.previous_button = discord.ui.Button(label='<', row=1)
+        self.next_button = discord.ui.Button(label='>', row=1)
+        self.filter_button = discord.ui.Button(label='Filter', row=1)
+        self.cancel_button = discord.ui.Button(label='Cancel', row=1)
+        for i in (self.task_selector_select, self.previous_button, self.next_button, self.filter_button, self.cancel_button):
+            self.view.add_item(i)
+        self.bind_button(('previous', 'next', 'filter'), (self.previous_button_callback, self.next_button_callback, self.filter_button_callback))
+
+    def set_filters(self, **filters):
+        self.filters.update(filters)
+
+    def _build(self, offset):
+        offset = max(offset, 0)
+        #One more than a page tells if there is a next one
+        items = self.options(**self.filters, offset=offset, limit=self.PAGE_SIZE+1)
+        if len(items) == 0 and offset > 0:
+            #The tasks of the page were deleted since it was shown
+            offset = 0
+            items = self.options(**self.filters, offset=offset, limit=self.PAGE_SIZE+1)
+        self.offset = offset
+        has_next = len(items) > self.PAGE_SIZE
         #items must be a list with pairs of (label, value)
-        self.view = discord.ui.View()
-        self.task_selector_select.max_values = len(items) if len(items) < self.max_values else self.max_values
-        self.task_selector_select.options = [discord.SelectOption(label = label, value=value) for label,value in (items)]
-        self.view.add_item(self.task_selector_select)
-        self.view.add_item(self.cancel_button)
+        items = items[:self.PAGE_SIZE]
+        if len(items) > 0:
+            self.task_selector_select.options = [discord.SelectOption(label=(label or '-')[:100], value=value) for label, value in items]
+            self.task_selector_select.max_values = min(len(items), self.max_values)
+            self.task_selector_select.disabled = False
+        else:
+            self.task_selector_select.options = [discord.SelectOption(label='No tasks', value='-')]
+            self.task_selector_select.max_values = 1
+            self.task_selector_select.disabled = True
+        self.task_selector_select.placeholder = f'Tasks {offset+1}-{offset+len(items)}, page {offset//self.PAGE_SIZE+1}' if len(items) > 0 else 'No tasks'
+        self.previous_button.disabled = offset == 0
+        self.next_button.disabled = not has_next
         return Message.Content(view = self.view)
 
-    def send(self, items): 
-        self._send(self._build(items))
+    def send(self):
+        self._send(self._build(0))
+
+    async def next_button_callback(self, interaction):
+        await self._edit_response(interaction, self._build(self.offset+self.PAGE_SIZE))
+
+    async def previous_button_callback(self, interaction):
+        await self._edit_response(interaction, self._build(self.offset-self.PAGE_SIZE))
+
+    async def filter_button_callback(self, interaction):
+        modal = TaskFilterModal(title='FILTER TASKS')
+        modal.set_data(**self.filters)
+        modal.set_submit_callback(self.filter_modal_callback)
+        await interaction.response.send_modal(modal)
+
+    async def filter_modal_callback(self, interaction):
+        await MemberResolver.get().load_member_named(interaction.guild, TaskFilterModal.get_values(interaction).get('assignee', ''))
+        self.filters = TaskFilterModal.get_filters(interaction)
+        await self._edit_response(interaction, self._build(0))
 
 class NotificationMessage(Message):
     def __init__(self, loop, channel=None):
         super().__init__(loop, channel)
 
     def _build(self, task):
-        assignees = []
-        for i in task.get_assignees():
-            data = i.split(":")
-            assignees.append(f'{data[1]}') if data[0] == 'Role' else assignees.append(f'<@{data[1]}>')
+        assignees = [i.mention() for i in task.get_sorted_assignees()]
         end_date = f'before {task.get_end_date().strftime("%d/%m/%Y")}' if task.get_end_date() is not None else ''
         content = f'# TASK {task.get_title()} is not done\n## finish this task {end_date}\n{task.get_description()}\n{' '.join(assignees)}'
         return Message.Content(content = content)
 
+    #Reminders wait for room in the outbox, they aren't sent again if dropped
     def send(self, task):
-        self._send(self._build(task))
+        return self.loop.create_task(self._send_wait(self._build(task)))
+
+#Several reminders in one message. _build splits the tasks in as many messages as needed to stay under max_length
+class DigestMessage(Message):
+    def __init__(self, loop, channel=None, max_length=2000):
+        super().__init__(loop, channel)
+        self.max_length = max_length
+
+    def _line(self, task):
+        assignees = [i.mention() for i in task.get_sorted_assignees()]
+        end_date = f' before {task.get_end_date().strftime("%d/%m/%Y")}' if task.get_end_date() is not None else ''
+        return f'- **{task.get_title()}**{end_date} {' '.join(assignees)}'
+
+    def _build(self, tasks, title='# TASKS NOT DONE', max_messages=None):
+        contents = []
+        lines = [title]
+        length = len(title)
+        for index, task in enumerate(tasks):
+            line = self._line(task)[:self.max_length-len(title)-1]
+            if length + len(line) + 1 > self.max_length:
+                if max_messages is not None and len(contents) == max_messages-1:
+                    more = f'and {len(tasks)-index} more'
+                    while length + len(more) + 1 > self.max_length:
+                        length -= len(lines.pop()) + 1
+                    lines.append(more)
+                    break
+                contents.append(Message.Content(content='\n'.join(lines)))
+                lines = [title]
+                length = len(title)
+            lines.append(line)
+            length += len(line) + 1
+        contents.append(Message.Content(content='\n'.join(lines)))
+        return contents
+
+    async def send(self, tasks):
+        for content in self._build(tasks):
+            await self._send_wait(content, delete_last=False)
+
+#Collects the reminders of a notification channel that are due within window seconds and sends them together.
+#In pinned mode a single pinned message listing the outstanding tasks is edited instead
+class NotificationDigest():
+    def __init__(self, loop, channel, window=5, pinned=False, pinned_id=None, on_pinned=None) -> None:
+        self.loop = loop
+        self.channel = channel
+        self.window = window
+        self.pinned = pinned
+        self.pinned_id = pinned_id
+        self.on_pinned = on_pinned
+        self.message = DigestMessage(loop, channel)
+        #Sent and edited through the outbox like the other messages, its discord_message is the pinned message once fetched or sent
+        self.pinned_message = DigestMessage(loop, channel)
+        self.pending = {}
+        self.outstanding = {}
+        self.handle = None
+        #A flush can take longer than the window, the next one waits so the pinned message isn't sent twice
+        self.lock = asyncio.Lock()
+
+    def add(self, task):
+        self.pending[task.get_task_id()] = task
+        if self.handle is None:
+            self.handle = self.loop.call_later(self.window, self._start_flush)
+
+    #Keeps the pinned list up to date when a task changes, is done or deleted
+    def update(self, task):
+        if task.get_task_id() in self.outstanding:
+            self.outstanding[task.get_task_id()] = task
+
+    def remove(self, task_id):
+        self.pending.pop(task_id, None)
+        if self.outstanding.pop(task_id, None) is not None and self.handle is None:
+            self.handle = self.loop.call_later(self.window, self._start_flush)
+
+    def _start_flush(self):
+        self.handle = None
+        self.loop.create_task(self.flush())
+
+    async def flush(self):
+        async with self.lock:
+            await self._flush()
+
+    async def _flush(self):
+        pending = list(self.pending.values())
+        self.pending = {}
+        if not self.pinned:
+            if len(pending) > 0:
+                await self.message.send(pending)
+            return
+        for task in pending:
+            self.outstanding[task.get_task_id()] = task
+        self.outstanding = {k: v for k, v in self.outstanding.items() if not v.is_done()}
+        content = self.pinned_message._build(list(self.outstanding.values()), title='# OUTSTANDING TASKS', max_messages=1)[0]
+        try:
+            if self.pinned_message.discord_message is None and self.pinned_id is not None:
+                self.pinned_message.discord_message = await self.channel.fetch_message(self.pinned_id)
+        except Exception as e:
+            print(e)
+            self.pinned_id = None
+        #The outbox gives None when the pinned message is gone or the edit failed, then a new one is pinned
+        if self.pinned_message.discord_message is not None and await self.pinned_message._update(content) is not None:
+            return
+        sent = await (await self.pinned_message._send_wait(content, delete_last=False))
+        if sent is None:
+            #The outbox already reported the failure, the next flush tries again
+            if self.handle is None:
+                self.handle = self.loop.call_later(self.window, self._start_flush)
+            return
+        self.pinned_id = sent.id
+        try:
+            await sent.pin()
+        except Exception as e:
+            print(e)
+        if self.on_pinned is not None:
+            self.on_pinned(self.channel.id, self.pinned_id)
 
 class TimeMeasure():
     SECOND = 1
@@ -277,40 +924,330 @@ class TimeMeasure():
     HOUR = MINUTE*60
     DAY = HOUR*24
 
+#Single timer for every notification of an event loop. Keeps a min heap of [fire_at, sequence, key, interval, callback] entries,
+#fire_at is a unix timestamp so it can be persisted. Cancelled entries are only marked (key = None) and skipped when they reach the top.
+#callback is called when the entry is due, returning False removes the entry, anything else schedules it again after interval seconds
+class NotificationScheduler():
+    schedulers = {}
+
+    @classmethod
+    def get(cls, loop):
+        if loop not in cls.schedulers:
+            cls.schedulers[loop] = cls(loop)
+        return cls.schedulers[loop]
+
+    def __init__(self, loop) -> None:
+        self.loop = loop
+        self.heap = []
+        self.entries = {}
+        self.sequence = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.runner = None
+        self.fired = 0
+
+    def schedule(self, key, interval, callback, fire_at=None):
+        self.cancel(key)
+        entry = [fire_at if fire_at is not None else time.time() + interval, next(self.sequence), key, interval, callback]
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry)
+        if self.heap[0] is entry:
+            self.wakeup.set()
+        if self.runner is None or self.runner.done():
+            self.runner = self.loop.create_task(self._run())
+
+    def cancel(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            entry[2] = None
+            #Rebuild the heap once most of it are cancelled entries
+            if len(self.heap) > 64 and len(self.heap) > 2*len(self.entries):
+                self.heap = list(self.entries.values())
+                heapq.heapify(self.heap)
+
+    def next_fire(self, key):
+        entry = self.entries.get(key, None)
+        return entry[0] if entry is not None else None
+
+    def __len__(self):
+        return len(self.entries)
+
+    async def _run(self):
+        while True:
+            while len(self.heap) > 0 and self.heap[0][2] is None:
+                heapq.heappop(self.heap)
+            timeout = self.heap[0][0] - time.time() if len(self.heap) > 0 else None
+            if timeout is None or timeout > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            entry = heapq.heappop(self.heap)
+            fire_at, _, key, interval, callback = entry
+            try:
+                keep = callback()
+            except Exception as e:
+                print(e)
+                keep = True
+            self.fired += 1
+            if entry[2] is None:
+                continue
+            if keep is False:
+                self.entries.pop(key, None)
+                continue
+            #A late timer (long pause, restart) fires once and continues from now
+            now = time.time()
+            entry = [fire_at + interval if fire_at + interval > now else now + interval, next(self.sequence), key, interval, callback]
+            self.entries[key] = entry
+            heapq.heappush(self.heap, entry)
+
 class Notification():
     def __init__(self, rate, measure, task, start_date) -> None:
         self.rate = rate
         self.measure = measure
         self.task = task
         self.start_date = start_date
+        self.next_fire = None
+        self.scheduler = None
+        self.channel = None
+
+    #The scheduler and the channel can't be pickled, the next fire time is kept so a restart doesn't reset the interval
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        scheduler = state.pop('scheduler', None)
+        state.pop('channel', None)
+        state.pop('digest', None)
+        state.pop('future', None)
+        if scheduler is not None and scheduler.next_fire(self) is not None:
+            state['next_fire'] = scheduler.next_fire(self)
+        return state
+
+    def _notify(self):
+        if self.task.is_done():
+            self.scheduler = None
+            self.on_notification_end()
+            return False
+        if getattr(self, 'digest', None) is not None:
+            self.digest.add(self.task)
+        else:
+            message = NotificationMessage(self.scheduler.loop, self.channel)
+            message.send(self.task)
+        self.on_notify()
 
-    async def _run(self, loop, channel):
-        while True:
-            await asyncio.sleep(self.rate*self.measure)
-            if not self.task.is_done():
-                message = NotificationMessage(loop, channel)
-                message.send(self.task)
-                self.on_notify()
-
-    def run(self, loop, channel):
-        asyncio.run_coroutine_threadsafe(self._run(loop, channel), loop=loop).add_done_callback(self.on_notification_end)
+    def is_running(self):
+        return getattr(self, 'scheduler', None) is not None
+
+    def run(self, loop, channel, digest:NotificationDigest|None = None):
+        self.stop()
+        self.channel = channel
+        self.digest = digest
+        self.scheduler = NotificationScheduler.get(loop)
+        self.scheduler.schedule(self, self.rate*self.measure, self._notify, getattr(self, 'next_fire', None))
+
+    def stop(self):
+        if self.is_running():
+            self.scheduler.cancel(self)
+            self.scheduler = None
+            self.on_notification_end()
     
     def on_notify(self):
         pass
     
-    def on_notification_end(self, future):
+    def on_notification_end(self):
         pass
 
+#Process wide index of the tasks that have a notification. It keeps a small copy of each of those tasks,
+#so reminders keep firing while the TaskManager of the guild isn't loaded. Stored in <persist_dir>/notifications.index
+#Tasks that are done or deleted leave the index, and with it the scheduler
+#mode is 'single' (a message per reminder), 'digest' (reminders due within digest_window seconds are sent together) or 'pinned' (a pinned message is edited)
+#shared is for the workers of a cluster: each one only reads and writes the guilds it owns, the file is merged under a lock
+class NotificationIndex():
+    def __init__(self, loop, persist_dir='tasks', persist_interval=60, mode='single', digest_window=5, shared=False) -> None:
+        self.loop = loop
+        self.path = f'{persist_dir}/notifications.index'
+        self.notifications = {}
+        self.guilds = set()
+        self.channels = {}
+        self.mode = mode
+        self.digest_window = digest_window
+        self.digests = {}
+        self.pinned_messages = {}
+        self.scheduler = NotificationScheduler.get(loop)
+        self.persist_interval = persist_interval
+        self.persisted_fired = 0
+        self.persist_task = None
+        self.shared = shared
+        #Guilds this process handles, read from the file when has_guild() is first called
+        self.owned = set()
+        os.makedirs(persist_dir, exist_ok=True)
+        if not shared:
+            self.guilds, self.notifications, self.pinned_messages = self._read()
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return (set(), {}, {})
+        with open(self.path, 'rb') as file:
+            data = pickle.load(file)
+        return (data[0], data[1], data[2] if len(data) > 2 else {})
+
+    #Guilds whose tasks were never indexed have to be seeded with seed()
+    def has_guild(self, guild_id):
+        if self.shared and guild_id not in self.owned:
+            self._claim(guild_id)
+        return guild_id in self.guilds
+
+    #Takes the notifications of a guild from the shared file, another worker may have had the guild before
+    def _claim(self, guild_id):
+        with storage.file_lock(self.path):
+            guilds, notifications, pinned_messages = self._read()
+        self.owned.add(guild_id)
+        if guild_id in guilds:
+            self.guilds.add(guild_id)
+        for key, notification in notifications.items():
+            if key[0] == guild_id and key not in self.notifications:
+                self.notifications[key] = notification
+        self.pinned_messages = pinned_messages | self.pinned_messages
+
+    def seed(self, guild_id, tasks):
+        for task in tasks:
+            self._update(guild_id, task)
+        self.guilds.add(guild_id)
+        self.owned.add(guild_id)
+        self.persist()
+
+    #Method to start the notifications of a guild once its notification channel is known
+    def start(self, guild_id, channel):
+        self.channels[guild_id] = channel
+        if self.mode != 'single' and channel is not None:
+            self.digests[guild_id] = NotificationDigest(self.loop, channel, self.digest_window, self.mode == 'pinned', self.pinned_messages.get(channel.id, None), self.on_pinned)
+        for (guild, _), notification in self.notifications.items():
+            if guild == guild_id and not notification.is_running():
+                notification.run(self.loop, channel, self.digests.get(guild_id, None))
+        if self.persist_task is None:
+            self.persist_task = self.loop.create_task(self.persist_loop())
+
+    #Next fire times change every time a notification fires, they are saved every persist_interval seconds
+    async def persist_loop(self):
+        while True:
+            await asyncio.sleep(self.persist_interval)
+            if self.scheduler.fired != self.persisted_fired:
+                self.persist()
+
+    #Method to add, refresh or remove the notification of a task after it changes
+    def update(self, guild_id, task):
+        if self._update(guild_id, task):
+            self.persist()
+
+    def remove(self, guild_id, task_id):
+        notification = self.notifications.pop((guild_id, task_id), None)
+        if notification is not None:
+            notification.stop()
+            if guild_id in self.digests:
+                self.digests[guild_id].remove(task_id)
+            self.persist()
+
+    def _update(self, guild_id, task):
+        key = (guild_id, task.get_task_id())
+        current = self.notifications.get(key, None)
+        notification = task.get_notification()
+        digest = self.digests.get(guild_id, None)
+        if notification is None or task.is_done():
+            if current is None:
+                return False
+            current.stop()
+            self.notifications.pop(key)
+            if digest is not None:
+                digest.remove(key[1])
+            return True
+        if current is not None and (current.rate, current.measure) == (notification.rate, notification.measure):
+            current.task = self._copy_task(task)
+            if digest is not None:
+                digest.update(current.task)
+            return True
+        if current is not None:
+            current.stop()
+        current = Notification(notification.rate, notification.measure, self._copy_task(task), notification.start_date)
+        self.notifications[key] = current
+        if guild_id in self.channels:
+            current.run(self.loop, self.channels[guild_id], self.digests.get(guild_id, None))
+        return True
+
+    #Only the fields NotificationMessage needs
+    @staticmethod
+    def _copy_task(task):
+        copy = Task()
+        copy.task_id = task.get_task_id()
+        copy.title = task.get_title()
+        copy.description = task.get_description()
+        copy.done = task.is_done()
+        copy.start_date = task.get_start_date()
+        copy.end_date = task.get_end_date()
+        copy.trello_id = task.get_trello_id()
+        copy.assignees = task.get_assignees()
+        return copy
+
+    def on_pinned(self, channel_id, message_id):
+        self.pinned_messages[channel_id] = message_id
+        self.persist()
+
+    def persist(self):
+        self.persisted_fired = self.scheduler.fired
+        if not self.shared:
+            self._write(self.guilds, self.notifications, self.pinned_messages)
+            return
+        #The entries of the guilds of other workers are kept as they are in the file
+        with storage.file_lock(self.path):
+            guilds, notifications, pinned_messages = self._read()
+            channels = {i.id for i in self.channels.values() if i is not None}
+            notifications = {k: v for k, v in notifications.items() if k[0] not in self.owned} | self.notifications
+            pinned_messages = {k: v for k, v in pinned_messages.items() if k not in channels} | {k: v for k, v in self.pinned_messages.items() if k in channels}
+            self._write(guilds | self.guilds, notifications, pinned_messages)
+
+    def _write(self, guilds, notifications, pinned_messages):
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'wb') as file:
+            pickle.dump((guilds, notifications, pinned_messages), file)
+        os.replace(temp_path, self.path)
+
 class Task():
+    #Fields that exist in trello cards. Changes to them are tracked until they are pushed
+    TRELLO_FIELDS = ('title', 'description', 'done')
+    __slots__ = ('title', 'description', 'assignees', 'done', 'start_date', 'end_date', 'notification', 'trello_id', 'task_id', 'dirty_fields')
+    #Pickled as (PICKLE_VERSION, fields). Version 0 is the __dict__ of the tasks pickled before __slots__, with assignees as a list of strings
+    PICKLE_VERSION = 1
+
     def __init__(self) -> None:
-        self.title:str
-        self.assignees:str
-        self.description:str
+        self.title:str = ''
+        self.description:str = ''
+        self.assignees:frozenset[Assignee] = Assignee.freeze(())
         self.done:bool = False
         self.start_date=datetime.datetime.today()
         self.end_date=None
         self.notification:Notification|None = None
         self.trello_id = None
+        self.task_id = uuid.uuid4().hex
+        #Created when a field changes, most tasks are clean
+        self.dirty_fields:set|None = None
+
+    def __getstate__(self):
+        return (self.PICKLE_VERSION, {k: getattr(self, k) for k in self.__slots__})
+
+    def __setstate__(self, state):
+        fields = state if isinstance(state, dict) else state[1]
+        self.title = ''
+        self.description = ''
+        self.done = False
+        self.start_date = None
+        self.end_date = None
+        self.notification = None
+        self.trello_id = None
+        self.task_id = None
+        self.dirty_fields = None
+        for k, v in fields.items():
+            if k in self.__slots__ and k != 'assignees':
+                setattr(self, k, v)
+        self.assignees = Assignee.freeze(fields.get('assignees', None) or ())
 
     def format_if_date(self, value):
         try:
@@ -323,16 +1260,47 @@ class Task():
         for k,v in kwargs.items():
             if k == 'id':
                 k = 'trello_id'
+            if k == 'assignees':
+                self.set_assignees(v)
+                continue
             v = self.format_if_date(v)
-            setattr(self, k, v)
+            self._set_field(k, v)
+
+    def _set_field(self, field, value):
+        if field in self.TRELLO_FIELDS and getattr(self, field, None) != value:
+            self.get_dirty_fields().add(field)
+        setattr(self, field, value)
+
+    #Fields changed since the last push to trello
+    def get_dirty_fields(self):
+        if self.dirty_fields is None:
+            self.dirty_fields = set()
+        return self.dirty_fields
+
+    def has_dirty_fields(self):
+        return bool(self.dirty_fields)
+
+    #Method to mark fields as pushed. Without fields every field is clean
+    def clear_dirty(self, fields=None):
+        if self.dirty_fields is None:
+            return
+        if fields is None:
+            self.dirty_fields = None
+        else:
+            self.dirty_fields.difference_update(fields)
 
     def get_title(self):
         return self.title
 
-    def get_assignees(self):
-        if hasattr(self, 'assignees'):
-            return self.assignees
-        else: return []
+    def get_assignees(self) -> frozenset[Assignee]:
+        return self.assignees
+
+    #Assignees in a stable order, for messages
+    def get_sorted_assignees(self):
+        return sorted(self.assignees, key=Assignee.sort_key)
+
+    def has_assignee(self, assignee:Assignee|str):
+        return Assignee.parse(assignee) in self.assignees
     
     def get_description(self):
         return self.description
@@ -344,19 +1312,25 @@ class Task():
         return self.end_date
 
     def set_done(self, done):
-        self.done = done
+        self._set_field('done', done)
 
     def is_done(self):
         return self.done
 
     def set_title(self, title):
-        self.title = title
+        self._set_field('title', title)
+
+    def set_assignees(self, assignees:Iterable[Assignee|str]):
+        self.assignees = Assignee.freeze(assignees)
 
-    def set_assignees(self, assignees):
-        self.assignees = assignees
+    def add_assignees(self, assignees:Iterable[Assignee|str]):
+        self.set_assignees(self.assignees.union(Assignee.parse(i) for i in assignees))
+
+    def remove_assignees(self, assignees:Iterable[Assignee|str]):
+        self.set_assignees(self.assignees.difference(Assignee.parse(i) for i in assignees))
     
     def set_content(self, description):
-        self.description = description
+        self._set_field('description', description)
 
     def set_start_date(self, start_date:str|datetime.datetime):
         if isinstance(start_date, str):
@@ -382,164 +1356,686 @@ class Task():
     def get_trello_id(self):
         return self.trello_id
 
+    def get_task_id(self):
+        return self.task_id
+
+#Button of the persistent views. Its custom_id is task:<action>:<guild id>:<values>, the callback registered for the action is called
+#on the TaskManager of the guild with interaction.extras = {'values': [...]}. No view or callback is kept per message, so open menus
+#don't use memory and keep working after a restart. Values that don't fit in the 100 characters of a custom_id are the options of a
+#disabled select of the message and the custom_id ends with *
+class PersistentButton(discord.ui.DynamicItem[discord.ui.Button], template=r'task:(?P<action>[a-z_]+):(?P<guild_id>[0-9]+):(?P<values>.*)'):
+    MAX_CUSTOM_ID = 100
+    #Options a select holds, so values kept in the message
+    MAX_VALUES = 25
+    IN_MESSAGE = '*'
+    #action -> callback(taskmanager, interaction)
+    actions = {}
+    #Set by the bot, returns the TaskManager of a guild
+    get_taskmanager = None
+
+    def __init__(self, action, guild_id, values = '', label = None, style = discord.ButtonStyle.secondary) -> None:
+        super().__init__(discord.ui.Button(label=label, style=style, custom_id=f'task:{action}:{guild_id}:{values}'))
+        self.action = action
+        self.guild_id = int(guild_id)
+        self.values = values
+
+    @classmethod
+    def register(cls, action, callback):
+        cls.actions[action] = callback
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match['action'], match['guild_id'], match['values'], item.label, item.style)
+
+    @staticmethod
+    def encode(values):
+        return ','.join(urllib.parse.quote(str(i), safe=':') for i in values)
+
+    @staticmethod
+    def decode(values):
+        return [urllib.parse.unquote(i) for i in values.split(',')] if values != '' else []
+
+    #View with a button for every (action, label, style). values are given to the callback of every button, labels are shown for them if they go in a select.
+    #Raises ValueError when the values fit neither in the custom_ids nor in the select
+    @classmethod
+    def build_view(cls, guild_id, buttons, values = (), labels = None):
+        view = discord.ui.View(timeout = None)
+        encoded = cls.encode(values)
+        if any(len(f'task:{action}:{guild_id}:{encoded}') > cls.MAX_CUSTOM_ID for action, _, _ in buttons):
+            if len(values) > cls.MAX_VALUES:
+                raise ValueError(f'At most {cls.MAX_VALUES} assignees or tasks fit in a message, got {len(values)}')
+            encoded = cls.IN_MESSAGE
+            labels = labels if labels is not None else [str(i) for i in values]
+            view.add_item(PersistentValues([discord.SelectOption(label=str(label)[:100], value=str(value), default=True) for label, value in zip(labels, values)]))
+        for action, label, style in buttons:
+            view.add_item(cls(action, guild_id, encoded, label, style))
+        return view
+
+    def get_values(self):
+        if self.values != self.IN_MESSAGE:
+            return self.decode(self.values)
+        for item in self.view.children if self.view is not None else []:
+            if getattr(item, 'custom_id', None) == PersistentValues.CUSTOM_ID:
+                return [i.value for i in item.options]
+        return []
+
+    async def callback(self, interaction):
+        callback = self.actions.get(self.action, None)
+        if callback is None or interaction.guild is None or interaction.guild.id != self.guild_id or self.get_taskmanager is None:
+            await interaction.response.send_message('This menu is no longer available', ephemeral=True)
+            return
+        interaction.extras = {'values': self.get_values()}
+        await callback(self.get_taskmanager(interaction.guild), interaction)
+
+#Disabled select that holds the values of the PersistentButtons of a message. It's dynamic so the view isn't stored either
+class PersistentValues(discord.ui.DynamicItem[discord.ui.Select], template=r'task:values'):
+    CUSTOM_ID = 'task:values'
+
+    def __init__(self, options) -> None:
+        super().__init__(discord.ui.Select(custom_id=self.CUSTOM_ID, options=options, min_values=len(options), max_values=len(options), disabled=True))
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(item.options)
+
 class EditTaskMessage(Message):
-    def __init__(self, loop, channel=None):
+    def __init__(self, loop, channel=None, guild_id=None):
         super().__init__(loop, channel)
-        self.create_button = discord.ui.Button(label='Create', style = discord.ButtonStyle.primary)
-        self.edit_button = discord.ui.Button(label='Edit', style = discord.ButtonStyle.primary)
-        self.delete_button = discord.ui.Button(label='Delete', style=discord.ButtonStyle.danger)
-        self.cancel_button = discord.ui.Button(label='Cancel')
-    
-    def _build(self, task:Task|None):
-        self.view = discord.ui.View(timeout = None)
-        self.view.add_item(self.create_button)
-        self.view.add_item(self.edit_button)
-        self.view.add_item(self.delete_button)
-        self.view.add_item(self.cancel_button)
-        return Message.Content(view = self.view)
+        self.guild_id = guild_id
+
+    #The assignees of the created task go in the custom_ids of the buttons
+    def _build(self, assignees, labels = None):
+        buttons = [('create', 'Create', discord.ButtonStyle.primary), ('edit', 'Edit', discord.ButtonStyle.primary), ('delete', 'Delete', discord.ButtonStyle.danger), ('cancel', 'Cancel', discord.ButtonStyle.secondary)]
+        return Message.Content(view = PersistentButton.build_view(self.guild_id, buttons, assignees, labels))
 
-    def send(self, task:Task|None = None, delete_last=True):
-        self._send(self._build(task), delete_last)
+    def send(self, assignees = (), labels = None, delete_last=True):
+        self._send(self._build(assignees, labels), delete_last)
 
 class ConfirmMessage(Message):
-    def __init__(self, loop, channel=None):
+    def __init__(self, loop, channel=None, guild_id=None):
         super().__init__(loop, channel)
-        self.confirm_button = discord.ui.Button(label='Confirm', style=discord.ButtonStyle.primary)
-        self.cancel_button = discord.ui.Button(label='Cancel')
+        self.guild_id = guild_id
 
-    def _build(self, title, description):
-        self.view = discord.ui.View(timeout = None)
-        self.view.add_item(self.confirm_button)
-        self.view.add_item(self.cancel_button)
+    #action is the PersistentButton action of the confirm button, it gets values
+    def _build(self, action, values, title, description, labels = None):
+        buttons = [(action, 'Confirm', discord.ButtonStyle.primary), ('cancel', 'Cancel', discord.ButtonStyle.secondary)]
         content = f'# {title}\n{description}'
-        return Message.Content(content=content, view = self.view)
+        return Message.Content(content=content, view = PersistentButton.build_view(self.guild_id, buttons, values, labels))
 
-    def send(self, title, description = '', delete_last = False):
-        self._send(self._build(title, description), delete_last)
+    def send(self, action, values, title, description = '', labels = None, delete_last = False):
+        self._send(self._build(action, values, title, description, labels), delete_last)
+
+#Index of the task titles for the autocomplete of the slash commands. Texts shorter than 3 characters are searched as
+#the prefix of a word, longer ones through the trigrams of the titles. Results that start the title come first
+class TitleIndex():
+    def __init__(self) -> None:
+        self.titles = {}
+        #word -> task ids, and the words sorted for the prefix search. sorted_words is rebuilt on the next search when None
+        self.words = {}
+        self.sorted_words = None
+        self.trigrams = {}
+
+    @staticmethod
+    def _normalize(title):
+        return ' '.join((title or '').lower().split())
+
+    @staticmethod
+    def _trigrams(text):
+        return set(text[i:i+3] for i in range(len(text)-2))
+
+    def add(self, task_id, title):
+        title = self._normalize(title)
+        self.titles[task_id] = title
+        for word in set(title.split(' ')):
+            if word not in self.words:
+                self.words[word] = set()
+                if self.sorted_words is not None:
+                    bisect.insort(self.sorted_words, word)
+            self.words[word].add(task_id)
+        for trigram in self._trigrams(title):
+            self.trigrams.setdefault(trigram, set()).add(task_id)
+
+    def remove(self, task_id):
+        title = self.titles.pop(task_id, None)
+        if title is None:
+            return
+        for word in set(title.split(' ')):
+            self.words[word].discard(task_id)
+            if len(self.words[word]) == 0:
+                self.words.pop(word)
+                if self.sorted_words is not None:
+                    self.sorted_words.pop(bisect.bisect_left(self.sorted_words, word))
+        for trigram in self._trigrams(title):
+            self.trigrams[trigram].discard(task_id)
+            if len(self.trigrams[trigram]) == 0:
+                self.trigrams.pop(trigram)
+
+    def _rank(self, task_id, text):
+        title = self.titles[task_id]
+        return (0 if title.startswith(text) else 1 if f' {text}' in title else 2, title)
+
+    #Returns up to limit task ids whose title contains text
+    def search(self, text, limit = 25):
+        text = self._normalize(text)
+        if text == '':
+            return []
+        if len(text) < 3:
+            if self.sorted_words is None:
+                self.sorted_words = sorted(self.words.keys())
+            candidates = set()
+            for i in range(bisect.bisect_left(self.sorted_words, text), len(self.sorted_words)):
+                if not self.sorted_words[i].startswith(text):
+                    break
+                candidates.update(self.words[self.sorted_words[i]])
+        else:
+            candidates = self._containing(text)
+        return heapq.nsmallest(limit, candidates, key=lambda i: self._rank(i, text))
+
+    def _containing(self, text):
+        sets = sorted((self.trigrams.get(i, set()) for i in self._trigrams(text)), key=len)
+        return {i for i in set(sets[0]).intersection(*sets[1:]) if text in self.titles[i]}
+
+    #Every task id whose title contains text. Texts shorter than a trigram are looked for in every title
+    def matching(self, text):
+        text = self._normalize(text)
+        if len(text) < 3:
+            return {k for k, v in self.titles.items() if text in v}
+        return self._containing(text)
+
+#Filters and order of list_tasks, parsed once from arguments like
+#assignee:@user role:Name done:false due<25/12/2026 sort:end_date limit:10
+#Words without a key filter by title. TaskStore.select runs the query against its indexes
+class TaskQuery():
+    SORTS = ('created', 'end_date', 'title')
+    TOKEN = re.compile(r'^(\w+)(<=|>=|<|>|=|:)(.*)$')
+
+    def __init__(self) -> None:
+        self.assignees:list[Assignee] = []
+        self.done:bool|None = None
+        #due_after is inclusive, due_before exclusive
+        self.due_after:datetime.datetime|None = None
+        self.due_before:datetime.datetime|None = None
+        self.title:str|None = None
+        self.sort = 'created'
+        self.descending = False
+        self.limit:int|None = None
+
+    def has_due(self):
+        return self.due_after is not None or self.due_before is not None
+
+    #Names given to assignee filters, the members that aren't cached have to be loaded before parse()
+    @classmethod
+    def assignee_names(cls, args:Iterable[str]):
+        matches = [cls.TOKEN.match(i) for i in args]
+        return [i.group(3) for i in matches if i is not None and i.group(1).lower() == 'assignee' and MemberResolver.is_name(i.group(3))]
+
+    #Raises ValueError with a message for the user when an argument can't be read
+    @classmethod
+    def parse(cls, args:Iterable[str], guild = None, author = None):
+        query = cls()
+        words = []
+        for arg in args:
+            match = cls.TOKEN.match(arg)
+            if match is None:
+                words.append(arg)
+                continue
+            key, operator, value = match.group(1).lower(), match.group(2), match.group(3).strip()
+            if key != 'due' and operator not in (':', '='):
+                raise ValueError(f'"{arg}": only due can be compared with < and >')
+            if key == 'assignee':
+                assignee = Assignee.from_target(author) if value.lower() == 'me' and author is not None else TaskFilterModal.parse_assignee(value, guild)
+                if assignee is None:
+                    raise ValueError(f'"{arg}": unknown assignee')
+                query.assignees.append(assignee)
+            elif key == 'role':
+                role = TaskFilterModal.parse_role(value, guild)
+                if role is None:
+                    raise ValueError(f'"{arg}": unknown role')
+                query.assignees.append(role)
+            elif key == 'done':
+                if value.lower() not in ('true', 'false', 'yes', 'no'):
+                    raise ValueError(f'"{arg}": done must be true or false')
+                query.done = value.lower() in ('true', 'yes')
+            elif key == 'due':
+                try:
+                    date = datetime.datetime.strptime(value, '%d/%m/%Y')
+                except ValueError:
+                    raise ValueError(f'"{arg}": the date must be dd/mm/yyyy')
+                day = datetime.timedelta(days=1)
+                if operator in ('<', '<='):
+                    query.due_before = date + day if operator == '<=' else date
+                elif operator in ('>', '>='):
+                    query.due_after = date + day if operator == '>' else date
+                else:
+                    query.due_after, query.due_before = date, date + day
+            elif key == 'sort':
+                query.descending = value.startswith('-')
+                query.sort = value.lstrip('-').lower()
+                if query.sort not in cls.SORTS:
+                    raise ValueError(f'"{arg}": sort must be one of {", ".join(cls.SORTS)}')
+            elif key == 'limit':
+                if not value.isdigit() or int(value) == 0:
+                    raise ValueError(f'"{arg}": limit must be a positive number')
+                query.limit = int(value)
+            elif key == 'title':
+                words.append(value)
+            else:
+                raise ValueError(f'"{arg}": unknown filter {key}')
+        query.title = ' '.join(words).lower() if len(words) > 0 else None
+        return query
+
+#Tasks of a guild by task_id, in creation order, with indexes by trello id, assignee, done state and end date.
+#Indexes are refreshed by reindex(task), the TaskManager calls it every time a task is persisted
+class TaskStore():
+    def __init__(self, tasks:Iterable = ()) -> None:
+        self.tasks = {}
+        #task_id -> (trello_id, assignees, done, end_date) the task is indexed with
+        self.keys = {}
+        self.order = {}
+        self.sequence = itertools.count()
+        self.by_trello_id = {}
+        self.by_assignee = {}
+        self.by_done = {True: set(), False: set()}
+        #Sorted (end_date, order, task_id), only tasks with an end date
+        self.by_end_date = []
+        self.by_title = TitleIndex()
+        for task in tasks:
+            self.add(task)
+
+    def __iter__(self):
+        return iter(self.tasks.values())
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __contains__(self, task_id):
+        return task_id in self.tasks
+
+    def get(self, task_id):
+        return self.tasks.get(task_id, None)
+
+    def add(self, task):
+        if task.get_task_id() in self.tasks:
+            self.reindex(task)
+            return
+        self.tasks[task.get_task_id()] = task
+        self.order[task.get_task_id()] = next(self.sequence)
+        self._index(task)
+
+    def remove(self, task_id):
+        task = self.tasks.pop(task_id, None)
+        if task is not None:
+            self._unindex(task_id)
+            self.order.pop(task_id)
+        return task
+
+    def reindex(self, task):
+        if task.get_task_id() in self.tasks:
+            self._unindex(task.get_task_id())
+            self._index(task)
+
+    def _index(self, task):
+        task_id = task.get_task_id()
+        end_date = task.get_end_date() if isinstance(task.get_end_date(), datetime.datetime) else None
+        keys = (task.get_trello_id(), task.get_assignees(), bool(task.is_done()), end_date, task.get_title())
+        self.keys[task_id] = keys
+        if keys[0] is not None:
+            self.by_trello_id[keys[0]] = task_id
+        for assignee in keys[1]:
+            self.by_assignee.setdefault(assignee, set()).add(task_id)
+        self.by_done[keys[2]].add(task_id)
+        if end_date is not None:
+            bisect.insort(self.by_end_date, (end_date, self.order[task_id], task_id))
+        self.by_title.add(task_id, keys[4])
+
+    def _unindex(self, task_id):
+        trello_id, assignees, done, end_date, _ = self.keys.pop(task_id)
+        if trello_id is not None and self.by_trello_id.get(trello_id, None) == task_id:
+            self.by_trello_id.pop(trello_id)
+        for assignee in assignees:
+            self.by_assignee[assignee].discard(task_id)
+            if len(self.by_assignee[assignee]) == 0:
+                self.by_assignee.pop(assignee)
+        self.by_done[done].discard(task_id)
+        if end_date is not None:
+            entry = (end_date, self.order[task_id], task_id)
+            i = bisect.bisect_left(self.by_end_date, entry)
+            if i < len(self.by_end_date) and self.by_end_date[i] == entry:
+                self.by_end_date.pop(i)
+        self.by_title.remove(task_id)
+
+    def get_by_trello_id(self, trello_id):
+        task_id = self.by_trello_id.get(trello_id, None)
+        return self.tasks[task_id] if task_id is not None else None
+
+    def with_trello_id(self):
+        return [self.tasks[i] for i in self.by_trello_id.values()]
+
+    #Tasks matching every filter given, in creation order. title is a case insensitive substring of the title
+    def filter(self, done:bool|None = None, assignee:Assignee|str|None = None, title:str|None = None):
+        ids = None
+        if done is not None:
+            ids = self.by_done[bool(done)]
+        if assignee is not None:
+            assigned = self.by_assignee.get(Assignee.parse(assignee), set())
+            ids = assigned if ids is None else ids & assigned
+        tasks = list(self.tasks.values()) if ids is None else [self.tasks[i] for i in sorted(ids, key=self.order.__getitem__)]
+        if title is not None:
+            title = title.lower()
+            tasks = [i for i in tasks if title in (i.get_title() or '').lower()]
+        return tasks
+
+    #Generates the tasks matching a TaskQuery in the order it asks for. Sorting by end date, or filtering by it without
+    #other indexed filters, walks the end date index. Otherwise the smallest index set, the title index included, drives the search
+    def select(self, query:TaskQuery):
+        sets = ([self.by_done[query.done]] if query.done is not None else []) + [self.by_assignee.get(i, set()) for i in query.assignees]
+        if query.title is not None:
+            sets.append(self.by_title.matching(query.title))
+        sets.sort(key=len)
+        from_end_dates = query.sort == 'end_date' or (query.has_due() and len(sets) == 0)
+        if from_end_dates:
+            low = 0 if query.due_after is None else bisect.bisect_left(self.by_end_date, (query.due_after,))
+            high = len(self.by_end_date) if query.due_before is None else bisect.bisect_left(self.by_end_date, (query.due_before,))
+            entries = self.by_end_date[low:high]
+            ids = (i[2] for i in (reversed(entries) if query.descending else entries))
+            if query.sort == 'end_date' and not query.has_due():
+                #Tasks without an end date go last
+                ids = itertools.chain(ids, (k for k, v in self.keys.items() if v[3] is None))
+            elif query.sort != 'end_date':
+                ids = sorted(ids, key=self.order.__getitem__, reverse=query.descending)
+        elif len(sets) > 0:
+            ids = sorted(sets[0], key=self.order.__getitem__, reverse=query.descending)
+        else:
+            ids = reversed(self.tasks.keys()) if query.descending else self.tasks.keys()
+        #The candidates are taken when the query runs, only reading the tasks is left for the pages. Tasks deleted since are skipped
+        ids = list(ids)
+        tasks = (self.tasks[i] for i in ids if i in self.tasks and self._matches(i, query, sets, not from_end_dates))
+        if query.sort == 'title':
+            tasks = iter(sorted(tasks, key=lambda i: (i.get_title() or '').lower(), reverse=query.descending))
+        return itertools.islice(tasks, query.limit)
+
+    def _matches(self, task_id, query, sets, check_due):
+        if not all(task_id in i for i in sets):
+            return False
+        if check_due and query.has_due():
+            end_date = self.keys[task_id][3]
+            if end_date is None or (query.due_after is not None and end_date < query.due_after) or (query.due_before is not None and end_date >= query.due_before):
+                return False
+        return True
+
+    #Tasks whose title contains text, the ones starting with it first
+    def search_titles(self, text, limit = 25):
+        return [self.tasks[i] for i in self.by_title.search(text, limit)]
+
+    #Tasks ending between start and end (both optional, end excluded), sorted by end date
+    def ending_between(self, start:datetime.datetime|None = None, end:datetime.datetime|None = None):
+        low = 0 if start is None else bisect.bisect_left(self.by_end_date, (start,))
+        high = len(self.by_end_date) if end is None else bisect.bisect_left(self.by_end_date, (end,))
+        return [self.tasks[i[2]] for i in self.by_end_date[low:high]]
 
 class TaskManager():
-    def __init__(self, loop, guild_id, notification_channel, trello:trello.Trello|None, persist_dir = 'tasks') -> None:
-        self.tasks = []
+    def __init__(self, loop, guild_id, notification_channel, trello:trello.Trello|None, persist_dir = 'tasks', task_storage:storage.Storage|None = None, notification_index:NotificationIndex|None = None) -> None:
         self.loop = loop
         self.guild_id = guild_id
         self.trello = trello
         self.notification_channel = notification_channel
-        self.persist_dir = persist_dir if persist_dir[-1] != '/' else persist_dir[:len(persist_dir)-1]
-        try:
-            os.makedirs(self.persist_dir)
-        except:
-            pass
-        if f'{self.guild_id}.tasks' in os.listdir(self.persist_dir):
-            with open(f'{self.persist_dir}/{self.guild_id}.tasks', 'rb') as file:
-                self.tasks = pickle.load(file)
-        for i in self.tasks:
-            notification = i.get_notification()
-            if notification is not None:
-                notification.run(self.loop, self.notification_channel)
+        self.storage = task_storage if task_storage is not None else storage.PickleStorage(guild_id, persist_dir)
+        self._tasks = None
+        self.last_used = time.monotonic()
+        #Syncs running now, by name. A second call joins the running one
+        self.running_syncs = {}
+        self.renderer = TaskListRenderer()
+        #Without a shared index the TaskManager indexes and starts its own notifications
+        if notification_index is None:
+            notification_index = NotificationIndex(loop, persist_dir)
+            if not notification_index.has_guild(guild_id):
+                notification_index.seed(guild_id, self.tasks)
+            notification_index.start(guild_id, notification_channel)
+        self.notification_index = notification_index
+
+    #Tasks are loaded on first use and dropped by unload(). Every use counts as activity for the eviction of idle guilds
+    @property
+    def tasks(self):
+        self.touch()
+        if self._tasks is None:
+            self._tasks = TaskStore(self.storage.load())
+        return self._tasks
+
+    #Work done with background priority, like the scheduled syncs, doesn't count as activity
+    def touch(self):
+        if trello.RequestScheduler.current_priority.get() != trello.RequestScheduler.BACKGROUND:
+            self.last_used = time.monotonic()
+
+    def is_loaded(self):
+        return self._tasks is not None
+
+    def is_syncing(self):
+        return any(not i.done() for i in self.running_syncs.values())
+
+    def loaded_count(self):
+        return len(self._tasks) if self._tasks is not None else 0
+
+    #Method to drop the tasks from memory once every change is persisted. Menus still open reload them when used
+    async def unload(self):
+        await self.storage.drain()
+        self.storage.close()
+        self._tasks = None
+        self.renderer.clear()
+        if self.trello is not None:
+            self.trello.clear()
     
     def set_trello(self, trello:trello.Trello|None):
         self.trello = trello
 
-    def sync_local(self):
-        if self.trello is not None:
-            self.trello.sync()
-            tasks = self.trello.get_tasks()
-            ids = [i.get_trello_id() for i in self.tasks]
-            for task in tasks:
-                if not task.get_id() in ids:
-                    t = Task()
-                    t.update(**vars(task))
-                    self.tasks.append(t)
-                else:
-                    self.tasks[ids.index(task.get_id())].update(**vars(task))
-        self.persist_tasks()
+    async def _run_once(self, name, function):
+        task = self.running_syncs.get(name, None)
+        if task is None or task.done():
+            task = self.loop.create_task(function())
+            self.running_syncs[name] = task
+        await asyncio.shield(task)
 
+    #Pulls the cards changed since the last sync. Tasks of deleted or archived cards are deleted.
+    #A sync_local called while another one runs waits for it instead of pulling again
+    async def sync_local(self):
+        await self._run_once('sync_local', self._sync_local)
 
-    def sync_trello(self):
+    async def _sync_local(self):
         if self.trello is not None:
-            self.trello.sync()
-            tasks = self.trello.get_tasks()
-            ids = [i.get_trello_id() for i in self.tasks]
-            for task in tasks:
-                if task.get_id() in ids:
-                    task.update(**vars(self.tasks[ids.index(task.get_trello_id())]))
-                    self.trello.update_task(task)
+            cards, removed, full, since = await self.trello.pull()
+            for card in cards:
+                t = self.tasks.get_by_trello_id(card.get_id())
+                if t is None:
+                    t = Task()
+                    self.tasks.add(t)
+                t.update(**card.get_task_kwargs())
+                t.clear_dirty()
+                self.persist_task(t)
+            if full:
+                board = set(card.get_id() for card in cards)
+                removed = removed + [i for i in self.tasks.by_trello_id.keys() if i not in board]
+            for card_id in removed:
+                t = self.tasks.get_by_trello_id(card_id)
+                if t is not None:
+                    self.delete_task(t.get_task_id())
+            #Only moved forward once the changes are written, a pull that fails to apply is pulled again
+            await self.storage.drain()
+            if not self.storage.is_dirty():
+                self.trello.commit_pull(since)
+
+    #Applies an action posted by the trello webhook. Cards created in trello become new tasks
+    def apply_trello_action(self, action):
+        change = trello.TrelloTask.from_action(action)
+        if change is None:
+            return
+        card_id, fields, removed = change
+        task = self.get_trello_task(card_id)
+        if removed:
+            if task is not None:
+                self.delete_task(task.get_task_id())
+            return
+        if task is None:
+            task = Task()
+            fields = {'title': '', 'description': '', 'done': False} | fields
+            self.tasks.add(task)
+        task.update(id=card_id, **fields)
+        task.clear_dirty(fields.keys())
+        self.persist_task(task)
+
+    def get_trello_task(self, trello_id):
+        return self.tasks.get_by_trello_id(trello_id)
+
+    #Pushes the changed fields of the tasks linked to a card, max_concurrency requests at a time. Joins a sync_trello already running
+    async def sync_trello(self, max_concurrency = 5):
+        await self._run_once('sync_trello', lambda: self._sync_trello(max_concurrency))
+
+    async def _sync_trello(self, max_concurrency):
+        if self.trello is not None:
+            semaphore = asyncio.Semaphore(max_concurrency)
+            tasks = [i for i in self.tasks.with_trello_id() if i.has_dirty_fields()]
+            results = await asyncio.gather(*[self._push_task(task, semaphore) for task in tasks], return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    print(result)
+
+    async def _push_task(self, task, semaphore):
+        fields = {i: getattr(task, i) for i in task.get_dirty_fields()}
+        async with semaphore:
+            await self.trello.update_card(task.get_trello_id(), fields)
+        #Fields changed again while the request was running stay dirty
+        task.clear_dirty([k for k, v in fields.items() if getattr(task, k) == v])
+        self.persist_task(task)
+
+    @staticmethod
+    def assignee_key(target):
+        return Assignee.from_target(target)
 
     def create_task(self, ctx, assignees):
-        assignees = [i.__class__.__name__+':'+str(i.name if isinstance(i, discord.Role) else i.id) for i in assignees] if len(assignees)>0 else ['User:'+str(ctx.author.id),]
-        edit_message = EditTaskMessage(self.loop, ctx.channel)
-        edit_message.bind_button(('create', 'edit', 'delete', 'cancel'), (self.create_button_callback, self.edit_button_callback, self.delete_button_callback, self.cancel_button_callback))
-        edit_message.set_extra(assignees = assignees)
-        edit_message.send()
+        targets = assignees if len(assignees)>0 else [ctx.author,]
+        edit_message = EditTaskMessage(self.loop, ctx.channel, self.guild_id)
+        edit_message.send([self.assignee_key(i) for i in targets], [getattr(i, 'name', None) or str(self.assignee_key(i)) for i in targets])
 
     def assign_task(self, ctx, assignees):
-        assignees = [i.__class__.__name__+':'+str(i.name if isinstance(i, discord.Role) else i.id) for i in assignees] if len(assignees)>0 else ['User:'+str(ctx.author.id),]
-        self.send_select_message(ctx.channel, [(v.get_title(),k) for k,v in enumerate(self.tasks)], self.assign_task_callback, assignees=assignees)
+        assignees = [self.assignee_key(i) for i in assignees] if len(assignees)>0 else [Assignee.user(ctx.author.id),]
+        self.send_select_message(ctx.channel, self.assign_task_callback, assignees=assignees)
 
     def unassign_task(self, ctx, assignees):
-        assignees = [i.__class__.__name__+':'+str(i.name if isinstance(i, discord.Role) else i.id) for i in assignees] if len(assignees)>0 else ['User:'+str(ctx.author.id),]
-        self.send_select_message(ctx.channel, [(v.get_title(),k) for k,v in enumerate(self.tasks)], self.unassign_task_callback, assignees=assignees)
+        assignees = [self.assignee_key(i) for i in assignees] if len(assignees)>0 else [Assignee.user(ctx.author.id),]
+        self.send_select_message(ctx.channel, self.unassign_task_callback, assignees=assignees)
+
+    #The tasks of the query are generated while the pages are rendered
+    def list_tasks(self, ctx, query:TaskQuery|None = None):
+        task_list_message = TaskListMessage(self.loop, ctx.channel, self.renderer)
+        task_list_message.send(self.tasks.select(query if query is not None else TaskQuery()))
 
-    def list_tasks(self, ctx):
-        task_list_message = TaskListMessage(self.loop, ctx.channel)
-        task_list_message.send(self.tasks)
+    async def respond_task_list(self, interaction, query:TaskQuery|None = None):
+        task_list_message = TaskListMessage(self.loop, interaction.channel, self.renderer)
+        await task_list_message.respond(interaction, self.tasks.select(query if query is not None else TaskQuery()))
 
     def set_done(self, ctx, is_done):
-        tasks = [(v.get_title(), k) for k,v in enumerate(self.tasks) if not v.is_done() == is_done]
-        self.send_select_message(ctx.channel, tasks, self.set_done_callback, is_done = is_done)
+        self.send_select_message(ctx.channel, self.set_done_callback, done = not is_done, is_done = is_done)
 
     def persist_tasks(self):
-        with open(f'{self.persist_dir}/{self.guild_id}.tasks', 'bw') as file:
-            pickle.dump(self.tasks, file)
+        self.storage.dump(self.tasks)
+
+    def persist_task(self, task):
+        self.tasks.reindex(task)
+        self.storage.put(task, self.tasks)
+        self.notification_index.update(self.guild_id, task)
+
+    def delete_task(self, task_id):
+        task = self.tasks.remove(task_id)
+        if task is not None:
+            self.storage.delete(task, self.tasks)
+            self.notification_index.remove(self.guild_id, task_id)
+            self.renderer.forget(task_id)
+
+    def get_task(self, task_id):
+        return self.tasks.get(task_id)
+
+    #Returns (task_id, title) pairs in creation order, limit of them from offset on. title filters by a case insensitive substring.
+    #Indexed storages answer without loading the tasks, otherwise the TaskStore indexes do
+    def query_tasks(self, done:bool|None = None, assignee:Assignee|str|None = None, title:str|None = None, offset:int = 0, limit:int|None = None):
+        rows = self.storage.query(done=done, assignee=assignee, title=title, offset=offset, limit=limit)
+        if rows is None:
+            query = TaskQuery()
+            query.done = done
+            query.assignees = [Assignee.parse(assignee)] if assignee is not None else []
+            query.title = title.lower() if title is not None else None
+            query.limit = offset + limit if limit is not None else None
+            rows = [(v.get_task_id(), v.get_title()) for v in itertools.islice(self.tasks.select(query), offset, None)]
+        return rows
+
+    #Returns (task_id, title) pairs of the tasks whose title contains text, for the autocomplete of the slash commands
+    def search_tasks(self, text, limit = 25):
+        tasks = self.tasks.search_titles(text, limit) if text.strip() != '' else itertools.islice(self.tasks, limit)
+        return [(i.get_task_id(), i.get_title()) for i in tasks]
+
+    #Task of a slash command argument, the task_id chosen in the autocomplete or the exact title
+    def resolve_task(self, value):
+        task = self.get_task(value)
+        if task is None:
+            for i in self.tasks.search_titles(value, 25):
+                if (i.get_title() or '').lower() == value.strip().lower():
+                    return i
+        return task
+
+    #Returns (label, value) pairs for a page of the task select menus
+    def task_options(self, done:bool|None = None, assignee:Assignee|str|None = None, title:str|None = None, offset:int = 0, limit:int|None = None):
+        return [(label, task_id) for task_id, label in self.query_tasks(done, assignee, title, offset, limit)]
 
-    def delete_task(self, id):
-        self.tasks.pop(id)
+    def close(self):
+        self.storage.close()
 
     def create_notification(self, ctx, rate, measure):
-        self.send_select_message(ctx.channel, [(v.get_title(),k) for k,v in enumerate(self.tasks)], self.create_notification_callback, rate = rate, measure = measure)
+        self.send_select_message(ctx.channel, self.create_notification_callback, rate = rate, measure = measure)
 
     def set_start_date(self, ctx, date):
-        self.send_select_message(ctx.channel, [(v.get_title(),k) for k,v in enumerate(self.tasks)], self.set_start_date_callback, date=date)
+        self.send_select_message(ctx.channel, self.set_start_date_callback, date=date)
 
     def set_end_date(self, ctx, date):
-        self.send_select_message(ctx.channel, [(v.get_title(),k) for k,v in enumerate(self.tasks)], self.set_end_date_callback, date=date)
+        self.send_select_message(ctx.channel, self.set_end_date_callback, date=date)
 
+    #Callbacks of the persistent buttons, extras['values'] has the values of the button
     async def create_button_callback(self, interaction):
         await interaction.message.delete()
-        modal = TaskModal(title='CREATE TASK')
-        modal.set_extra(assignees = interaction.extras['assignees'])
-        modal.set_submit_callback(self.create_modal_callback)
-        await interaction.response.send_modal(modal)
+        await interaction.response.send_modal(self.create_modal([Assignee.parse(i) for i in interaction.extras['values']]))
         return
 
     async def edit_button_callback(self, interaction):
         await interaction.message.delete()
-        self.send_select_message(interaction.channel, [(v.get_title(),k) for k,v in enumerate(self.tasks)], self.task_select_edit_callback, 1)
+        self.send_select_message(interaction.channel, self.task_select_edit_callback, 1)
         return
 
     async def delete_button_callback(self, interaction):
         await interaction.message.delete()
-        self.send_select_message(interaction.channel, [(v.get_title(),k) for k,v in enumerate(self.tasks)], self.task_select_delete_callback)
+        self.send_select_message(interaction.channel, self.task_select_delete_callback)
         return
 
-    def send_select_message(self, channel, items, callback, max_values=25, **extra):
-        task_select_message = TaskSelectMessage(self.loop, channel, max_values)
+    #done preselects the done filter of the menu
+    def send_select_message(self, channel, callback, max_values=25, done:bool|None = None, **extra):
+        task_select_message = TaskSelectMessage(self.loop, channel, max_values, self.task_options)
         task_select_message.bind_button(('task_selector'), (callback), '_select')
         task_select_message.bind_button(('cancel'), (self.cancel_button_callback))
         task_select_message.set_extra(**extra)
-        task_select_message.send(items)
+        task_select_message.set_filters(done=done)
+        task_select_message.send()
 
     async def create_modal_callback(self, interaction):
         t = Task()
         t = self._modal_data_insert(interaction, t)
-        self.tasks.append(t)
-        self.persist_tasks()
+        self.tasks.add(t)
+        self.persist_task(t)
         await interaction.response.defer()
         return
 
+    #The task is looked up again, it may have been deleted or unloaded with the guild while the modal was open
     async def edit_modal_callback(self, interaction):
-        self._modal_data_insert(interaction, interaction.extras['task'])
-        self.persist_tasks()
+        task = self.get_task(interaction.extras['task_id'])
+        if task is None:
+            await interaction.response.send_message('Task no longer exists', ephemeral=True)
+            return
+        self._modal_data_insert(interaction, task)
+        self.persist_task(task)
         await interaction.response.defer()
         return
 
@@ -553,7 +2049,10 @@ class TaskManager():
                     kwargs[j.get('custom_id')] = datetime.datetime(year=today.year, month=today.month, day=today.day)
                 if j.get('custom_id') == 'end_date' and j.get('value', '').strip() == '':
                     kwargs[j.get('custom_id')] = None
-        kwargs.update(interaction.extras)
+        #The edit modal keeps the id of the task it edits in the extras, it isn't a field to change
+        extras = dict(interaction.extras)
+        extras.pop('task_id', None)
+        kwargs.update(extras)
         task.update(**kwargs)
         return task
 
@@ -562,86 +2061,105 @@ class TaskManager():
 
     async def task_select_edit_callback(self, interaction):
         await interaction.message.delete()
-        task = self.tasks[int(interaction.data['values'][0])]
-        data = vars(task).copy()
+        tasks = await self._selected_tasks(interaction)
+        if len(tasks) > 0:
+            await interaction.response.send_modal(self.edit_modal(tasks[0]))
+
+    #Tasks of the options chosen in a select menu. The ones deleted since the menu was sent are left out and the user is told so
+    async def _selected_tasks(self, interaction):
+        tasks = [self.get_task(i) for i in interaction.data['values']]
+        missing = tasks.count(None)
+        if missing > 0:
+            await interaction.response.send_message('Task no longer exists' if len(tasks) == 1 else f'{missing} of the chosen tasks no longer exist', ephemeral=True)
+        return [i for i in tasks if i is not None]
+
+    def edit_modal(self, task):
         modal = TaskModal(title='EDIT TASK')
-        modal_ids = modal.get_items_id()
-        for k in list(data.keys()).copy():
-            if k not in modal_ids:
-                data.pop(k)
-        modal.set_data(**data)
+        modal.set_data(task.get_title(), task.get_description(), task.get_start_date(), task.get_end_date())
         modal.set_submit_callback(self.edit_modal_callback)
-        modal.set_extra(task = task)
-        await interaction.response.send_modal(modal)
+        modal.set_extra(task_id = task.get_task_id())
+        return modal
+
+    def create_modal(self, assignees):
+        modal = TaskModal(title='CREATE TASK')
+        modal.set_extra(assignees = assignees)
+        modal.set_submit_callback(self.create_modal_callback)
+        return modal
 
     async def task_select_delete_callback(self, interaction):
         await interaction.message.delete()
         task = interaction.data['values']
-        confirm = ConfirmMessage(self.loop, interaction.channel)
-        confirm.bind_button('confirm', self.delete_confirm_callback)
-        confirm.set_extra(task = task)
-        confirm.send('DELETE TASK?', f'task "{self.tasks[task[0]].title}" will be deleted') if len(task) == 1 else confirm.send('DELETE TASKS?', 'Multiple tasks will be deleted') 
+        confirm = ConfirmMessage(self.loop, interaction.channel, self.guild_id)
+        labels = [(self.get_task(i).get_title() if self.get_task(i) is not None else '') or i for i in task]
+        confirm.send('delete_confirm', task, 'DELETE TASK?', f'task "{labels[0]}" will be deleted', labels) if len(task) == 1 else confirm.send('delete_confirm', task, 'DELETE TASKS?', 'Multiple tasks will be deleted', labels)
 
     async def delete_confirm_callback(self, interaction):
         await interaction.message.delete()
-        tasks = [int(i) for i in interaction.extras['task']]
-        tasks = sorted(tasks, reverse=True)
-        for task in tasks:
-            self.delete_task(task)
-        self.persist_tasks()
+        for task_id in interaction.extras['values']:
+            self.delete_task(task_id)
 
     async def set_done_callback(self, interaction):
         await interaction.message.delete()
-        for i in interaction.data['values']:
-            task = self.tasks[int(i)]
-            task.set_done(interaction.extras['is_done'])
-        self.persist_tasks()
+        for task in await self._selected_tasks(interaction):
+            self.set_task_done(task, interaction.extras['is_done'])
 
     async def create_notification_callback(self, interaction):
         await interaction.message.delete()
-        for i in interaction.data['values']:
-            task = self.tasks[int(i)]
-            notification = Notification(interaction.extras['rate'], getattr(TimeMeasure, interaction.extras['measure']), task, None)
-            task.set_notification(notification)
-            notification.run(self.loop, self.notification_channel)
-        self.persist_tasks()
+        for task in await self._selected_tasks(interaction):
+            self.notify_task(task, interaction.extras['rate'], interaction.extras['measure'])
 
     async def assign_task_callback(self, interaction):
         await interaction.message.delete()
-        for i in interaction.data['values']:
-            task = self.tasks[int(i)]
-            assignees = task.get_assignees()
-            for assignee in interaction.extras.get('assignees', []):
-                if assignee not in assignees:
-                    assignees.append(assignee)
-            task.set_assignees(assignees)
-        self.persist_tasks()
+        for task in await self._selected_tasks(interaction):
+            self.assign(task, interaction.extras.get('assignees', []))
                                          
     async def unassign_task_callback(self, interaction):
         await interaction.message.delete()
-        for i in interaction.data['values']:
-            task = self.tasks[int(i)]
-            assignees = task.get_assignees()
-            for assignee in interaction.extras.get('assignees', []):
-                if assignee in assignees:
-                    assignees.pop(assignees.index(assignee))
-            task.set_assignees(assignees)
-        self.persist_tasks()
+        for task in await self._selected_tasks(interaction):
+            self.unassign(task, interaction.extras.get('assignees', []))
 
     # Can rewrite in 1 function
     async def set_start_date_callback(self, interaction):
         await interaction.message.delete()
-        for i in interaction.data['values']:
-            task = self.tasks[int(i)]
-            task.set_start_date(interaction.extras['date'])
-        self.persist_tasks()
+        for task in await self._selected_tasks(interaction):
+            self.set_task_start_date(task, interaction.extras['date'])
 
     async def set_end_date_callback(self, interaction):
         await interaction.message.delete()
-        for i in interaction.data['values']:
-            task = self.tasks[int(i)]
-            task.set_end_date(interaction.extras['date'])
-        self.persist_tasks()
+        for task in await self._selected_tasks(interaction):
+            self.set_task_end_date(task, interaction.extras['date'])
+
+    #Changes to a single task, used by the select menu callbacks and the slash commands
+    def set_task_done(self, task, is_done):
+        task.set_done(is_done)
+        self.persist_task(task)
+
+    def notify_task(self, task, rate, measure):
+        notification = Notification(rate, getattr(TimeMeasure, measure), task, None)
+        task.set_notification(notification)
+        self.persist_task(task)
+
+    def assign(self, task, assignees):
+        task.add_assignees(assignees)
+        self.persist_task(task)
+
+    def unassign(self, task, assignees):
+        task.remove_assignees(assignees)
+        self.persist_task(task)
+
+    def set_task_start_date(self, task, date):
+        task.set_start_date(date)
+        self.persist_task(task)
+
+    def set_task_end_date(self, task, date):
+        task.set_end_date(date)
+        self.persist_task(task)
+
+PersistentButton.register('create', TaskManager.create_button_callback)
+PersistentButton.register('edit', TaskManager.edit_button_callback)
+PersistentButton.register('delete', TaskManager.delete_button_callback)
+PersistentButton.register('cancel', TaskManager.cancel_button_callback)
+PersistentButton.register('delete_confirm', TaskManager.delete_confirm_callback)
 
 class Tag():
     
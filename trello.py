@@ -1,11 +1,22 @@
-import requests
+import aiohttp
+import asyncio
+import contextlib
+import contextvars
+import datetime
+import heapq
+import itertools
 import json
+import os
+import random
+import storage
+import time
 class TrelloTask():
-    def __init__(self, title:str = '', description:str='', id:str='', done:bool=False) -> None:
+    def __init__(self, title:str = '', description:str='', id:str='', done:bool=False, closed:bool=False) -> None:
         self.title = title
         self.description = description
         self.id = id
         self.done = done
+        self.closed = closed
 
     def set_title(self, title):
         self.title = title
@@ -28,56 +39,394 @@ class TrelloTask():
     def is_done(self):
         return self.done
 
+    #Archived card
+    def is_closed(self):
+        return self.closed
+
+    #Fields a local Task takes from the card
+    def get_task_kwargs(self):
+        return {'title': self.title, 'description': self.description, 'id': self.id, 'done': self.done}
+
     def update(self, **kwargs):
         for k,v in kwargs.items():
             if hasattr(self, k) and k != 'id':
                 setattr(self, k, v)
 
+    #Card field of every TrelloTask field
+    TRELLO_FIELDS = {
+        'title' : 'name',
+        'description' : 'desc',
+        'done' : 'dueComplete'
+    }
+
     def get_trello_kwargs(self):
-        kwargs = {
-            'name' : self.title,
-            'desc' : self.description,
-            'dueComplete' : str(self.done).lower()
-        }
+        return self.to_trello_kwargs({k: getattr(self, k) for k in self.TRELLO_FIELDS.keys()})
+
+    #Converts {'title': ..., 'done': ...} to the query parameters of a card update
+    @classmethod
+    def to_trello_kwargs(cls, fields):
+        kwargs = {}
+        for k, v in fields.items():
+            if k in cls.TRELLO_FIELDS:
+                kwargs[cls.TRELLO_FIELDS[k]] = str(v).lower() if isinstance(v, bool) else ('' if v is None else v)
         return kwargs
+
+    #Reads a webhook action. Returns (card id, changed fields with TrelloTask names, removed) or None if the action doesn't change a card.
+    #Trello only sends the card fields the action changed
+    @classmethod
+    def from_action(cls, action):
+        card = action.get('data', {}).get('card', None)
+        if card is None or card.get('id', None) is None or action.get('type') not in Trello.CARD_ACTIONS.split(','):
+            return None
+        if action.get('type') in ('deleteCard', 'moveCardFromBoard') or card.get('closed', False):
+            return card.get('id'), {}, True
+        fields = {k: card[v] for k, v in cls.TRELLO_FIELDS.items() if v in card}
+        return card.get('id'), fields, False
+
+#Last sync point of every board, stored as json so a restart keeps pulling incrementally.
+#Workers of a cluster share the file, set() only writes the key of its board
+class SyncState():
+    def __init__(self, path:str|None = 'trello_sync.json') -> None:
+        self.path = path
+        self.state = {}
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as file:
+                self.state = json.loads(file.read())
+
+    def get(self, board_id):
+        return self.state.get(board_id, None)
+
+    def set(self, board_id, since):
+        self.state[board_id] = since
+        if self.path is not None:
+            self.state = storage.update_json(self.path, board_id, since)
+
+#limit requests every period seconds. After a 429 the bucket is empty until pause() ends
+class TokenBucket():
+    def __init__(self, limit, period) -> None:
+        self.capacity = limit
+        self.rate = limit/period
+        self.tokens = limit
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now-self.updated)*self.rate)
+            self.updated = now
+
+    #Seconds until a token is available
+    def delay(self):
+        self._refill()
+        if self.updated > time.monotonic():
+            return self.updated - time.monotonic() + max(0, 1-self.tokens)/self.rate
+        return max(0, 1-self.tokens)/self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        self._refill()
+        self.tokens = 0
+        self.updated = max(self.updated, time.monotonic() + seconds)
+
+#Process wide queue for trello requests. Trello allows 300 requests every 10 seconds per api key and 100 per token,
+#every request waits for a token of both buckets. Waiting requests are served by priority, INTERACTIVE before BACKGROUND.
+#The priority of the requests of a coroutine is set with trello.priority(RequestScheduler.BACKGROUND)
+class RequestScheduler():
+    INTERACTIVE = 0
+    BACKGROUND = 1
+    current_priority = contextvars.ContextVar('trello_priority', default=INTERACTIVE)
+
+    def __init__(self, key_limit=(300, 10), token_limit=(100, 10), max_retries=5, backoff=1, max_backoff=60) -> None:
+        self.key_limit = key_limit
+        self.token_limit = token_limit
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.buckets = {}
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.wakeup = None
+        self.dispatcher = None
+        self.counters = {'requests': 0, 'throttled': 0, 'retried': 0, 'rate_limited': 0, 'failed': 0}
+
+    def get_buckets(self, api_key, token):
+        if ('key', api_key) not in self.buckets:
+            self.buckets[('key', api_key)] = TokenBucket(*self.key_limit)
+        if ('token', token) not in self.buckets:
+            self.buckets[('token', token)] = TokenBucket(*self.token_limit)
+        return (self.buckets[('key', api_key)], self.buckets[('token', token)])
+
+    #Method to wait for the turn of a request
+    async def acquire(self, api_key, token):
+        buckets = self.get_buckets(api_key, token)
+        self.counters['requests'] += 1
+        if len(self.waiting) == 0 and max(i.delay() for i in buckets) == 0:
+            for i in buckets:
+                i.take()
+            return
+        self.counters['throttled'] += 1
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (self.current_priority.get(), next(self.sequence), future, buckets))
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        self.wakeup.set()
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        while len(self.waiting) > 0:
+            _, _, future, buckets = self.waiting[0]
+            if future.cancelled():
+                heapq.heappop(self.waiting)
+                continue
+            delay = max(i.delay() for i in buckets)
+            if delay > 0:
+                #A request with a higher priority may arrive while waiting
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self.waiting)
+            for i in buckets:
+                i.take()
+            future.set_result(None)
+
+    #Seconds to wait before retrying. Retry-After wins, otherwise exponential backoff with jitter
+    def retry_delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return min(self.max_backoff, self.backoff * 2**attempt) * (0.5 + random.random()/2)
+
+    def rate_limited(self, api_key, token, seconds):
+        self.counters['rate_limited'] += 1
+        for i in self.get_buckets(api_key, token):
+            i.pause(seconds)
+
+    def get_counters(self):
+        return self.counters.copy()
+
+#Sets the priority of the trello requests made inside the with block
+@contextlib.contextmanager
+def priority(value):
+    reset = RequestScheduler.current_priority.set(value)
+    try:
+        yield
+    finally:
+        RequestScheduler.current_priority.reset(reset)
+
+#HTTP client shared by every Trello instance. Connections are kept alive in one pool for all guilds.
+#Responses bigger than executor_threshold bytes are decoded in an executor so big boards don't block the event loop.
+#Every request goes through the RequestScheduler, 429, 5xx and connection errors are retried
+class TrelloSession():
+    def __init__(self, timeout=30, max_connections=20, executor_threshold=256*1024, scheduler:RequestScheduler|None = None) -> None:
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.executor_threshold = executor_threshold
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler()
+        self.session = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    async def request_json(self, method, url, params):
+        api_key, token = params.get('key'), params.get('token')
+        attempt = 0
+        while True:
+            await self.scheduler.acquire(api_key, token)
+            try:
+                async with self.get_session().request(method, url, params=params) as response:
+                    body = await response.read()
+                    if response.status == 429 or response.status >= 500:
+                        delay = self.scheduler.retry_delay(attempt, response.headers.get('Retry-After', None))
+                        if response.status == 429:
+                            self.scheduler.rate_limited(api_key, token, delay)
+                        if attempt < self.scheduler.max_retries:
+                            attempt += 1
+                            self.scheduler.counters['retried'] += 1
+                            await asyncio.sleep(delay)
+                            continue
+                    if response.status >= 400:
+                        self.scheduler.counters['failed'] += 1
+                    response.raise_for_status()
+                break
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= self.scheduler.max_retries:
+                    self.scheduler.counters['failed'] += 1
+                    raise
+                await asyncio.sleep(self.scheduler.retry_delay(attempt))
+                attempt += 1
+                self.scheduler.counters['retried'] += 1
+        if len(body) > self.executor_threshold:
+            return await asyncio.get_running_loop().run_in_executor(None, json.loads, body)
+        return json.loads(body)
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
 class Trello():
-    def __init__(self, api_key, token, board_id, *args, **kwargs) -> None:
+    #Only the card fields TrelloTask uses are requested
+    CARD_FIELDS = 'name,desc,dueComplete,closed'
+    #Actions that create, change or remove cards of a board
+    CARD_ACTIONS = 'createCard,updateCard,deleteCard,copyCard,moveCardToBoard,moveCardFromBoard,convertToCardFromCheckItem'
+    PAGE_SIZE = 1000
+    #Changed cards are fetched one by one up to this amount, more than that is cheaper as a full pull
+    MAX_CHANGED_CARDS = 100
+    #The next pull starts a bit before the last one to cover clock differences with trello
+    SYNC_OVERLAP = datetime.timedelta(minutes=1)
+
+    def __init__(self, api_key, token, board_id, *args, session:TrelloSession|None = None, sync_state:SyncState|None = None, base_url:str = 'https://api.trello.com/1', **kwargs) -> None:
         self.api_key = api_key
         self.token = token
         self.board_id = board_id
-        self.base_url = 'https://api.trello.com/1/'
+        self.base_url = base_url.rstrip('/')
         self.tasks = []
-        print(vars(self))
-    
-    def sync(self):
+        self.session = session if session is not None else TrelloSession()
+        self.sync_state = sync_state if sync_state is not None else SyncState(None)
+
+    @staticmethod
+    def _card_task(card):
+        return TrelloTask(card.get('name'), card.get('desc'), card.get('id'), card.get('dueComplete', False), card.get('closed', False))
+
+    #Every open card of the board, one page of PAGE_SIZE cards at a time
+    async def _get_cards(self):
         url = f'{self.base_url}/boards/{self.board_id}/cards'
-        data = self.request_json('GET', url)
-        self.tasks = []
-        for card in data:
-            self.tasks.append(TrelloTask(card.get('name'), card.get('desc'), card.get('id'), card.get('badges').get('dueComplete')))
+        cards = {}
+        before = None
+        while True:
+            params = {'fields': self.CARD_FIELDS, 'limit': self.PAGE_SIZE}
+            if before is not None:
+                params['before'] = before
+            page = await self.request_json('GET', url, **params)
+            for card in page:
+                cards[card.get('id')] = card
+            if len(page) < self.PAGE_SIZE:
+                break
+            before = min(card.get('id') for card in page)
+        return list(cards.values())
+
+    #Ids of the cards changed and removed since a date, newest actions first, paging backwards
+    async def _get_changed_cards(self, since):
+        url = f'{self.base_url}/boards/{self.board_id}/actions'
+        changed = set()
+        removed = set()
+        before = None
+        while True:
+            params = {'filter': self.CARD_ACTIONS, 'since': since, 'limit': self.PAGE_SIZE, 'fields': 'type,data'}
+            if before is not None:
+                params['before'] = before
+            page = await self.request_json('GET', url, **params)
+            #Actions are processed from newest to oldest, so the newest one decides between changed and removed
+            for action in page:
+                card_id = action.get('data', {}).get('card', {}).get('id', None)
+                if card_id is None or card_id in changed or card_id in removed:
+                    continue
+                if action.get('type') in ('deleteCard', 'moveCardFromBoard'):
+                    removed.add(card_id)
+                else:
+                    changed.add(card_id)
+            if len(page) < self.PAGE_SIZE:
+                break
+            before = page[-1].get('id')
+        return changed, removed
+
+    async def _get_card(self, card_id, semaphore):
+        async with semaphore:
+            try:
+                return await self.request_json('GET', f'{self.base_url}/cards/{card_id}', fields=self.CARD_FIELDS)
+            except aiohttp.ClientResponseError as e:
+                if e.status == 404:
+                    return None
+                raise
+
+    #Method to pull the board. Returns (cards, removed card ids, full, since). When full is True cards are every open card of the board,
+    #otherwise only the cards changed since the last pull. Archived cards are returned as removed.
+    #since is the new sync point, the caller gives it to commit_pull once the cards are applied and persisted
+    async def pull(self):
+        started = datetime.datetime.now(datetime.timezone.utc)
+        since = self.sync_state.get(self.board_id)
+        changed = None
+        removed = set()
+        if since is not None:
+            changed, removed = await self._get_changed_cards(since)
+        if changed is None or len(changed) > self.MAX_CHANGED_CARDS:
+            cards = [self._card_task(card) for card in await self._get_cards()]
+            full = True
+        else:
+            semaphore = asyncio.Semaphore(5)
+            results = await asyncio.gather(*[self._get_card(card_id, semaphore) for card_id in changed])
+            cards = []
+            for card_id, card in zip(changed, results):
+                if card is None:
+                    removed.add(card_id)
+                else:
+                    cards.append(self._card_task(card))
+            full = False
+        removed.update(card.get_id() for card in cards if card.is_closed())
+        cards = [card for card in cards if not card.is_closed()]
+        return cards, list(removed), full, (started - self.SYNC_OVERLAP).isoformat()
+
+    #The next pull only asks for the changes after since
+    def commit_pull(self, since):
+        self.sync_state.set(self.board_id, since)
+
+    async def sync(self):
+        self.tasks = [self._card_task(card) for card in await self._get_cards()]
         
-    def request_json(self, method, url, **kwargs):
+    async def request_json(self, method, url, **kwargs):
         query = {'key': self.api_key, 'token': self.token}
         query.update(kwargs)
-        response = requests.request(method, url, params=query)
-        return response.json()
+        return await self.session.request_json(method, url, query)
 
     def get_tasks(self):
         return self.tasks
 
-    def update_task(self, task:TrelloTask):
+    def clear(self):
+        self.tasks = []
+
+    async def update_task(self, task:TrelloTask):
         url = f'{self.base_url}/cards/{task.get_id()}'
-        self.request_json('PUT', url, **task.get_trello_kwargs())
+        await self.request_json('PUT', url, **task.get_trello_kwargs())
+
+    #Method to update only some fields of a card. fields uses TrelloTask names: {'title': 'new title'}
+    async def update_card(self, card_id, fields):
+        kwargs = TrelloTask.to_trello_kwargs(fields)
+        if len(kwargs) > 0:
+            await self.request_json('PUT', f'{self.base_url}/cards/{card_id}', **kwargs)
+
+    #Method to make trello post the actions of the board to callback_url. A webhook already registered for the same url is reused.
+    #Returns the full id of the board, the one sent in the webhook requests
+    async def register_webhook(self, callback_url, description = 'tasks_bot'):
+        board = await self.request_json('GET', f'{self.base_url}/boards/{self.board_id}', fields='id')
+        webhooks = await self.request_json('GET', f'{self.base_url}/tokens/{self.token}/webhooks')
+        for webhook in webhooks:
+            if webhook.get('idModel') == board.get('id') and webhook.get('callbackURL') == callback_url:
+                return board.get('id')
+        await self.request_json('POST', f'{self.base_url}/webhooks', callbackURL=callback_url, idModel=board.get('id'), description=description)
+        return board.get('id')
 
 
 
-def main():
+async def main():
     cfg = json.loads(open('./cfg.json', 'r').read())
     t = Trello(cfg.get('trello_api_key'), cfg.get('trello_token'), 'w2ViRfAv')
-    t.sync()
+    await t.sync()
+    await t.session.close()
 
     for i in t.get_tasks():
         print(vars(i))
     #print(t.get_tasks())
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+from aiohttp import web
+import base64
+import hashlib
+import hmac
+import json
+import urllib.parse
+
+#Receives the actions trello posts for the boards of every guild.
+#Trello checks callback_url with a HEAD request when the webhook is registered, then posts {'action': ..., 'model': ...} for every change.
+#With api_secret the X-Trello-Webhook signature of every request is checked
+class TrelloWebhookServer():
+    def __init__(self, host:str, port:int, callback_url:str, on_action, api_secret:str|None = None) -> None:
+        self.host = host
+        self.port = port
+        self.callback_url = callback_url
+        self.on_action = on_action
+        self.api_secret = api_secret
+        #Full board id -> guild id
+        self.boards = {}
+        self.runner = None
+
+    async def start(self):
+        app = web.Application()
+        path = urllib.parse.urlsplit(self.callback_url).path or '/'
+        app.router.add_route('HEAD', path, self.head)
+        app.router.add_post(path, self.post)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    #Method to register the webhook of the board of a guild. The previous board of the guild stops being handled
+    async def register(self, guild_id, trello):
+        board_id = await trello.register_webhook(self.callback_url)
+        self.unregister(guild_id)
+        self.boards[board_id] = guild_id
+
+    def unregister(self, guild_id):
+        for board_id in [k for k, v in self.boards.items() if v == guild_id]:
+            self.boards.pop(board_id)
+
+    def verify(self, body, signature):
+        if not self.api_secret:
+            return True
+        if signature is None:
+            return False
+        digest = hmac.new(self.api_secret.encode(), body + self.callback_url.encode(), hashlib.sha1).digest()
+        return hmac.compare_digest(base64.b64encode(digest).decode(), signature)
+
+    async def head(self, request):
+        return web.Response()
+
+    async def post(self, request):
+        body = await request.read()
+        if not self.verify(body, request.headers.get('X-Trello-Webhook', None)):
+            return web.Response(status=401)
+        try:
+            event = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        action = event.get('action', {})
+        board_id = event.get('model', {}).get('id', None) or action.get('data', {}).get('board', {}).get('id', None)
+        guild_id = self.boards.get(board_id, None)
+        if guild_id is not None:
+            try:
+                await self.on_action(guild_id, action)
+            except Exception as e:
+                print(e)
+        #Anything but 2xx makes trello retry, unknown boards are acknowledged too
+        return web.Response()